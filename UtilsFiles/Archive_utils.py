@@ -0,0 +1,98 @@
+import os
+import cv2
+import shutil
+import multiprocessing as mp
+import pandas as pd
+
+from UtilsFiles.Fight_utils import loadModel, predict_on_video, alert_folder_check, write_csv_atomic
+
+# Model loaded once per worker process by _init_worker.
+_worker_model = None
+
+
+def shard_ranges(video_path, shards, SEQUENCE_LENGTH=16, skip=2):
+    '''
+    Split a video into shards (start_frame, end_frame) of about the same length.
+    Every shard starts on a multiple of SEQUENCE_LENGTH * skip, where predict_on_video starts a window,
+    so the shards together score exactly the windows of a single run.
+    '''
+    video_reader = cv2.VideoCapture(video_path)
+    frames = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+    video_reader.release()
+    span = SEQUENCE_LENGTH * skip
+    per_shard = max(span, -(-frames // (shards * span)) * span)
+    return [(start, min(start + per_shard, frames)) for start in range(0, frames, per_shard)]
+
+
+def _init_worker(modelPath, threads):
+    import torch
+    global _worker_model
+    torch.set_num_threads(threads)
+    _worker_model = loadModel(modelPath)
+
+
+def _run_shard(args):
+    video_path, shard_folder, SEQUENCE_LENGTH, skip, start_frame, end_frame, checkpoint_every = args
+    predict_on_video(video_path, shard_folder, _worker_model, SEQUENCE_LENGTH, skip, start_frame=start_frame,
+                     end_frame=end_frame, checkpoint_every=checkpoint_every)
+    return shard_folder
+
+
+def merge_shards(shard_folders, output_folder):
+    '''
+    Merge the alert folders of the shards of one video into a single report.
+    Alerts are ordered by frame and renumbered, their images are copied next to the merged Report.csv,
+    and segments.txt lists the output video segments in order (an ffmpeg concat list).
+    Returns:
+        The merged alerts as a DataFrame.
+    '''
+    alert_folder_check(output_folder)
+    reports = []
+    segments = []
+    for folder in shard_folders:
+        csv_file_path = f"{folder}/Report.csv"
+        if os.path.isfile(csv_file_path):
+            report = pd.read_csv(csv_file_path)
+            for image_name in report["Image_Name"]:
+                shutil.copy2(f"{folder}/{image_name}.jpg", f"{output_folder}/{image_name}.jpg")
+            reports.append(report)
+        segments += [os.path.abspath(os.path.join(folder, f)) for f in sorted(os.listdir(folder))
+                     if f.startswith("Output_video") and f.endswith(".mp4")]
+
+    columns = ["S_No", "Image_Name", "Time_stamp", "Feature", "Frame"]
+    merged = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=columns)
+    merged = merged.sort_values("Frame", kind="stable").reset_index(drop=True)
+    merged["S_No"] = range(1, len(merged) + 1)
+    write_csv_atomic(merged, f"{output_folder}/Report.csv")
+    with open(f"{output_folder}/segments.txt", "w") as f:
+        for segment in segments:
+            f.write(f"file '{segment}'\n")
+    return merged
+
+
+def process_archive(modelPath, video_path, output_folder, SEQUENCE_LENGTH=16, skip=2, shards=1, workers=None,
+                    checkpoint_every=100):
+    '''
+    This function will run predict_on_video over a long recording in time shards, in parallel worker processes,
+    with checkpoints, then merge the shards into one report in output_folder.
+    Each shard works in output_folder/shard_<i> and checkpoints every checkpoint_every windows, so running the
+    same command again after a crash or pre-emption resumes every shard where it stopped and skips finished ones.
+    Args:
+        modelPath: Path of the model weights, loaded once per worker.
+        shards: Number of time shards of the video.
+        workers: Number of worker processes, defaults to one per shard up to the number of cores.
+    Returns:
+        The merged alerts as a DataFrame.
+    '''
+    ranges = shard_ranges(video_path, shards, SEQUENCE_LENGTH, skip)
+    shard_folders = [os.path.join(output_folder, f"shard_{i:03d}") for i in range(len(ranges))]
+    workers = min(workers or os.cpu_count() or 1, len(ranges))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Processing {len(ranges)} shards with {workers} workers")
+    jobs = [(video_path, folder, SEQUENCE_LENGTH, skip, start, end, checkpoint_every)
+            for folder, (start, end) in zip(shard_folders, ranges)]
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(modelPath, threads)) as pool:
+        for done, folder in enumerate(pool.imap_unordered(_run_shard, jobs), 1):
+            print(f"{done}/{len(jobs)} shards done ({folder})")
+    return merge_shards(shard_folders, output_folder)
@@ -0,0 +1,107 @@
+import os
+import cv2
+import json
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from UtilsFiles.Metrics_utils import METRICS
+
+
+def clip_hash(clips, size=28):
+    '''
+    Near-exact key of a window. Every frame, in color, is area-downsampled to size x size (4x4 pixel cells of a
+    112x112 clip), rounded to whole uint8 levels (1/64 for the normalized float frames of transform_()), and
+    the window is hashed with blake2b.
+    Only windows whose frames are identical at that resolution share a key: frozen cameras, looped feeds and
+    re-submitted files decoded the same way. Motion anywhere in the view, a fight in a corner included, changes
+    cells and so the key, and re-encoding noise usually does too, which costs a model call and never hides an
+    alert. Two different windows collide only if every cell of every frame rounds to the same value.
+    Args:
+        clips: Sequence of [height, width, 3] frames, uint8 or normalized float.
+        size: Side of the downsampled frames.
+    Returns:
+        Hex string of the hash.
+    '''
+    scale = 1.0 if np.asarray(clips[0]).dtype == np.uint8 else 64.0
+    digest = hashlib.blake2b(digest_size=16)
+    for frame in clips:
+        small = cv2.resize(np.asarray(frame, dtype=np.float32), (size, size), interpolation=cv2.INTER_AREA)
+        digest.update(np.round(small * scale).astype(np.int16).tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    '''
+    LRU cache of window probabilities keyed by clip_hash(), the model version and the window length,
+    so frozen cameras, looped feeds and re-submitted files do not run the model again for the same window.
+    Only (nearly) pixel-identical windows hit, see clip_hash().
+    Args:
+        model_version: Checksum of the model weights, see model_version() in Fight_utils.
+        max_entries: Memory bound, the least recently used entries are evicted past this size
+                     (an entry takes roughly 300 bytes).
+        path: Optional JSON file the cache is loaded from and saved to with save().
+    '''
+
+    def __init__(self, model_version, max_entries=100000, path=None):
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                saved = json.load(f)
+            # Entries of another model version can never be hit, skip them.
+            for key, probs in saved.get("entries", []):
+                if key.startswith(model_version + ":"):
+                    self.entries[key] = np.array(probs, dtype=np.float32)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def key(self, clips):
+        return f"{self.model_version}:{len(clips)}:{clip_hash(clips)}"
+
+    def get_or_compute(self, clips, compute):
+        '''
+        Return the cached probabilities of the window, or call compute() and cache its result.
+        '''
+        key = self.key(clips)
+        with self.lock:
+            probs = self.entries.get(key)
+            if probs is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if probs is not None:
+            METRICS.inc("fight_cache_hits_total")
+            return probs
+
+        probs = np.asarray(compute(), dtype=np.float32)
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = probs
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        METRICS.inc("fight_cache_misses_total")
+        return probs
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries),
+                    "hit_rate": self.hits / total if total else 0.0}
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half written cache.
+        if not self.path:
+            return
+        with self.lock:
+            entries = [[key, probs.tolist()] for key, probs in self.entries.items()]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": entries}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,114 @@
+import time
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset, DataLoader
+from torchvision.models.video.resnet import BasicBlock, Conv2Plus1D
+
+from UtilsFiles.Fight_utils import device, train_model, CLASSES_LIST
+from UtilsFiles.Prune_utils import count_flops, cpu_latency, accuracy, split_dataset
+
+
+class R2Plus1DStudent(nn.Module):
+    '''
+    Small (2+1)D residual network used as the distillation student of mc3_18.
+    It has the layout of torchvision's r2plus1d_18 with one block per stage and stage widths
+    width, 2*width, 4*width, 8*width (mc3_18 uses 64..512). Longer clips are subsampled to frames
+    frames, so the student is a drop-in replacement for the teacher in predict_on_video and streaming.
+    Args:
+        width: Channels of the first stage.
+        frames: Number of frames the network looks at.
+    '''
+
+    def __init__(self, width=16, frames=8, num_classes=len(CLASSES_LIST)):
+        super().__init__()
+        self.width = width
+        self.frames = frames
+        self.stem = nn.Sequential(
+            nn.Conv3d(3, width, kernel_size=(1, 7, 7), stride=(1, 2, 2), padding=(0, 3, 3), bias=False),
+            nn.BatchNorm3d(width),
+            nn.ReLU(inplace=True),
+            nn.Conv3d(width, width, kernel_size=(3, 1, 1), padding=(1, 0, 0), bias=False),
+            nn.BatchNorm3d(width),
+            nn.ReLU(inplace=True),
+        )
+        layers = []
+        inplanes = width
+        for i, planes in enumerate([width, width * 2, width * 4, width * 8]):
+            stride = 1 if i == 0 else 2
+            downsample = None
+            if stride != 1 or inplanes != planes:
+                downsample = nn.Sequential(
+                    nn.Conv3d(inplanes, planes, kernel_size=1, stride=stride, bias=False),
+                    nn.BatchNorm3d(planes),
+                )
+            layers.append(BasicBlock(inplanes, planes, Conv2Plus1D, stride, downsample))
+            inplanes = planes
+        self.layers = nn.Sequential(*layers)
+        self.avgpool = nn.AdaptiveAvgPool3d(1)
+        self.fc = nn.Linear(inplanes, num_classes)
+
+    def forward(self, x):
+        if x.shape[2] > self.frames:
+            index = torch.linspace(0, x.shape[2] - 1, self.frames, device=x.device).round().long()
+            x = x.index_select(2, index)
+        x = self.layers(self.stem(x))
+        return self.fc(self.avgpool(x).flatten(1))
+
+
+def distill_student(teacher, features, labels, width=16, frames=8, num_epochs=10, lr=1e-3, batch_size=4,
+                    temperature=4.0, alpha=0.5):
+    '''
+    This function will train an R2Plus1DStudent on the soft targets of the fine-tuned teacher with train_model.
+    Args:
+        teacher: The fine-tuned mc3_18.
+        features, labels: The dataset, as returned by create_dataset.
+        width, frames: Size of the student, see R2Plus1DStudent.
+        temperature, alpha: Softening of the teacher outputs and weight of the distillation loss.
+    Returns:
+        student: The trained student, its best validation epoch.
+        test: The held-out (features, labels) split, not used to pick that epoch, for distill_report.
+    '''
+    train, val, test = split_dataset(features, labels)
+    dataloaders = {
+        'train': DataLoader(TensorDataset(*train), batch_size=batch_size, shuffle=True),
+        'val': DataLoader(TensorDataset(*val), batch_size=batch_size),
+    }
+    student = R2Plus1DStudent(width, frames).to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    student, _ = train_model(device, student, dataloaders, criterion, optimizer, num_epochs=num_epochs,
+                             teacher=teacher, temperature=temperature, alpha=alpha)
+    return student.eval(), test
+
+
+def save_student(student, path):
+    # architecture plus weights, loadModel rebuilds the student from the "arch" name
+    torch.save({"arch": "r2plus1d_student", "width": student.width, "frames": student.frames,
+                "state_dict": student.state_dict()}, path)
+
+
+def distill_report(models, test, SEQUENCE_LENGTH=16, batch_size=4):
+    '''
+    Compare the throughput and accuracy of models on the held-out split.
+    Args:
+        models: dict name -> model, e.g. {"teacher": teacher, "student": student}.
+    Returns:
+        rows: One dict per model with params, GFLOPs per clip, CPU clips/s at batch 1 and batch_size,
+              and test accuracy.
+    '''
+    rows = []
+    for name, model in models.items():
+        model.eval()
+        start = time.time()
+        test_accuracy = accuracy(model, *test)
+        rows.append({
+            "model": name,
+            "params": sum(p.numel() for p in model.parameters()),
+            "gflops": count_flops(model, SEQUENCE_LENGTH) / 1e9,
+            "cpu_clips_per_s": 1 / cpu_latency(model, SEQUENCE_LENGTH),
+            f"cpu_clips_per_s_batch{batch_size}": batch_size / cpu_latency(model, SEQUENCE_LENGTH, batch_size),
+            "test_accuracy": test_accuracy,
+            "test_seconds": time.time() - start,
+        })
+        print(rows[-1])
+    return rows
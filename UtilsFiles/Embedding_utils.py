@@ -0,0 +1,155 @@
+import os
+import cv2
+import copy
+import torch
+import numpy as np
+import pandas as pd
+from torch.utils.data import TensorDataset, DataLoader
+
+from UtilsFiles.Fight_utils import (device, frames_extraction_uint8, normalize_clips,
+                                    PredBatchProbsEmbeddings, model_version, train_model)
+
+
+def video_segments(video_path, clips_per_video):
+    '''
+    Split a video into clips_per_video equal [start_frame, end_frame) segments.
+    '''
+    video_reader = cv2.VideoCapture(video_path)
+    video_frames_count = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+    video_reader.release()
+    bounds = np.linspace(0, video_frames_count, clips_per_video + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def cache_embeddings(DATASET_DIR, CLASSES_LIST, SEQUENCE_LENGTH, model, cache_dir, clips_per_video=1, batch_size=8):
+    '''
+    This function will run the backbone once per clip of every video in the dataset and keep the pooled
+    features that go into model.fc (512-d for mc3_18) on disk, so the head can be retrained without touching
+    the backbone again.
+    The cache lives in cache_dir/<backbone checksum>_T<SEQUENCE_LENGTH>_K<clips_per_video>/ as
+        embeddings.npy  float16 array of shape [num_videos, clips_per_video, model.fc.in_features].
+        clips.csv       one row per video: key, path, label, size and mtime of the file.
+    Videos already in the cache with the same size and mtime are not decoded again.
+    Args:
+        DATASET_DIR: Folder with one sub folder of videos per class.
+        CLASSES_LIST: Names of the class sub folders, the index is the label.
+        SEQUENCE_LENGTH: Number of frames per clip.
+        model: The loaded model, only its backbone is used.
+        cache_dir: Root folder of the embedding caches.
+        clips_per_video: Number of clips sampled at spread out offsets in every video.
+    Returns:
+        features: float32 tensor of shape [num_videos, clips_per_video, model.fc.in_features], with no rows
+                  when no video of the dataset is long enough.
+        labels: int64 tensor of shape [num_videos].
+        keys: List of the video keys, relative to DATASET_DIR.
+    '''
+    folder = os.path.join(cache_dir, f"{model_version(model, exclude=('fc.',))}_T{SEQUENCE_LENGTH}_K{clips_per_video}")
+    os.makedirs(folder, exist_ok=True)
+    embeddings_path = os.path.join(folder, "embeddings.npy")
+    index_path = os.path.join(folder, "clips.csv")
+
+    # Load what is already cached.
+    cached = {}
+    if os.path.isfile(index_path) and os.path.isfile(embeddings_path):
+        index = pd.read_csv(index_path)
+        embeddings = np.load(embeddings_path)
+        for row, vectors in zip(index.itertuples(index=False), embeddings):
+            cached[row.key] = (row, vectors)
+
+    rows = []
+    vectors = []
+    pending = []
+
+    def flush():
+        # Run the backbone over the pending clips in batches.
+        if not pending:
+            return
+        clips = np.stack([clip for _, clip in pending])
+        for start in range(0, len(clips), batch_size):
+            _, batch = PredBatchProbsEmbeddings(normalize_clips(clips[start:start + batch_size]), model)
+            for (slot, _), vector in zip(pending[start:start + batch_size], batch):
+                vectors[slot[0]][slot[1]] = vector
+        pending.clear()
+
+    for class_index, class_name in enumerate(CLASSES_LIST):
+        for file_name in sorted(os.listdir(os.path.join(DATASET_DIR, class_name))):
+            video_file_path = os.path.join(DATASET_DIR, class_name, file_name)
+            if not os.path.isfile(video_file_path) or file_name.endswith('.txt'):
+                continue
+            key = os.path.join(class_name, file_name)
+            stat = os.stat(video_file_path)
+            row = {"key": key, "path": video_file_path, "label": class_index,
+                   "size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+            hit = cached.get(key)
+            if hit is not None and hit[0].size == row["size"] and hit[0].mtime == row["mtime"]:
+                rows.append(row)
+                vectors.append(hit[1].astype(np.float32))
+                continue
+
+            # Skip the videos having frames less than the SEQUENCE_LENGTH, like create_dataset does.
+            clips = [frames_extraction_uint8(video_file_path, SEQUENCE_LENGTH, start, end)
+                     for start, end in video_segments(video_file_path, clips_per_video)]
+            if any(len(clip) != SEQUENCE_LENGTH for clip in clips):
+                continue
+            rows.append(row)
+            vectors.append([None] * clips_per_video)
+            pending.extend(((len(rows) - 1, i), clip) for i, clip in enumerate(clips))
+            if len(pending) >= 4 * batch_size:
+                flush()
+    flush()
+
+    # an empty dataset still has the feature size of the model
+    features = np.array(vectors, dtype=np.float32).reshape(len(rows), clips_per_video, model.fc.in_features)
+    np.save(embeddings_path, features.astype(np.float16))
+    pd.DataFrame(rows, columns=["key", "path", "label", "size", "mtime"]).to_csv(index_path, index=False)
+    print(f"Cached embeddings of {len(rows)} videos in {folder}")
+    return torch.from_numpy(features), torch.tensor([row["label"] for row in rows]), [row["key"] for row in rows]
+
+
+class PooledHead(torch.nn.Module):
+    '''
+    Averages the clip embeddings of a video and applies a copy of model.fc, so the trained weights
+    can be put straight back into the full model.
+    '''
+
+    def __init__(self, fc):
+        super().__init__()
+        self.fc = copy.deepcopy(fc)
+
+    def forward(self, features):
+        return self.fc(features.mean(dim=1))
+
+
+def train_head(model, features, labels, num_epochs=50, lr=1e-3, batch_size=32, val_split=0.2, seed=0):
+    '''
+    This function will train the fc head on cached embeddings with the existing train_model loop and put
+    the best weights back into model.fc.
+    Args:
+        model: The loaded model, model.fc is replaced by the trained head.
+        features, labels: Output of cache_embeddings.
+        val_split: Fraction of the videos kept for validation.
+    Returns:
+        model: The model with the retrained head.
+        val_acc_history: Validation accuracy of every epoch.
+    '''
+    if len(labels) < 2:
+        raise ValueError(f"Need at least 2 videos to train the head with a validation split, got {len(labels)}")
+    generator = torch.Generator().manual_seed(seed)
+    order = torch.randperm(len(labels), generator=generator)
+    n_val = min(len(labels) - 1, max(1, int(len(labels) * val_split)))
+    val_idx, train_idx = order[:n_val], order[n_val:]
+    dataloaders = {
+        'train': DataLoader(TensorDataset(features[train_idx], labels[train_idx]), batch_size=batch_size,
+                            shuffle=True, generator=generator),
+        'val': DataLoader(TensorDataset(features[val_idx], labels[val_idx]), batch_size=batch_size),
+    }
+
+    head = PooledHead(model.fc).to(device)
+    criterion = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(head.parameters(), lr=lr)
+    head, val_acc_history = train_model(device, head, dataloaders, criterion, optimizer, num_epochs=num_epochs)
+
+    model.fc.load_state_dict(head.fc.state_dict())
+    model.eval()
+    return model, val_acc_history
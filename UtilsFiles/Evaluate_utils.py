@@ -0,0 +1,229 @@
+import os
+import cv2
+import json
+import time
+import hashlib
+import numpy as np
+import multiprocessing as mp
+
+from UtilsFiles.Fight_utils import (loadModel, transform_uint8_, normalize_clips, PredBatchProbs, read_clip_uint8,
+                                    CLASSES_LIST)
+
+# Model loaded once per worker process by _init_worker.
+_worker_model = None
+
+
+def file_checksum(path):
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()[:12]
+
+
+def list_labeled_videos(DATASET_DIR, CLASSES_LIST):
+    '''
+    List (video_path, label) pairs from a tree with one sub folder of videos per class.
+    '''
+    videos = []
+    for class_index, class_name in enumerate(CLASSES_LIST):
+        folder = os.path.join(DATASET_DIR, class_name)
+        for file_name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, file_name)
+            if os.path.isfile(path) and not file_name.endswith('.txt'):
+                videos.append((path, class_index))
+    return videos
+
+
+def _init_worker(modelPath, threads):
+    import torch
+    global _worker_model
+    torch.set_num_threads(threads)
+    _worker_model = loadModel(modelPath)
+
+
+def _read_video_clips(path, SEQUENCE_LENGTH, skip, clips_per_video):
+    # clips_per_video full clips spread over the video, fewer when it is too short
+    video_reader = cv2.VideoCapture(path)
+    video_frames_count = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+    skip = max(1, min(skip, video_frames_count // SEQUENCE_LENGTH))
+    span = SEQUENCE_LENGTH * skip
+    transform = transform_uint8_()
+    starts = np.unique(np.linspace(0, max(video_frames_count - span, 0), clips_per_video).astype(int))
+    clips = [read_clip_uint8(video_reader, s, SEQUENCE_LENGTH, skip, transform) for s in starts]
+    video_reader.release()
+    return [clip for clip in clips if len(clip) == SEQUENCE_LENGTH]
+
+
+def _score_videos(args):
+    '''
+    Score a chunk of videos in a worker: the clips of consecutive videos are stacked into batches of up to
+    batch_size clips (a video is never split over two batches) and each batch is one forward pass.
+    Returns a list of (path, class probabilities averaged over the video's clips or None, seconds), where seconds
+    is the time spent reading the video plus its share of its batch's forward pass.
+    '''
+    paths, SEQUENCE_LENGTH, skip, clips_per_video, batch_size = args
+    results = []
+    batch, owners = [], []
+
+    def flush():
+        start = time.time()
+        probs = PredBatchProbs(normalize_clips(np.stack(batch)), _worker_model)
+        share = (time.time() - start) / len(batch)
+        first = 0
+        for path, count, seconds in owners:
+            results.append((path, probs[first:first + count].mean(axis=0).tolist(), seconds + share * count))
+            first += count
+        batch.clear()
+        owners.clear()
+
+    for path in paths:
+        start = time.time()
+        clips = _read_video_clips(path, SEQUENCE_LENGTH, skip, clips_per_video)
+        if not clips:
+            results.append((path, None, time.time() - start))
+            continue
+        if batch and len(batch) + len(clips) > batch_size:
+            flush()
+        batch += clips
+        owners.append((path, len(clips), time.time() - start))
+    if batch:
+        flush()
+    return results
+
+
+def predict_dataset(modelPath, videos, cache_dir, SEQUENCE_LENGTH=16, skip=2, clips_per_video=1, workers=None,
+                    batch_size=8):
+    '''
+    This function will return the class probabilities of every video, running the model only for the videos
+    missing from the prediction cache. The cache is one JSON file per model checksum and sampling setting, keyed
+    by video path, size and mtime, so re-evaluating with a new threshold needs no model call at all.
+    Args:
+        modelPath: Path of the model weights, its checksum keys the cache.
+        videos: List of (video_path, label) pairs.
+        cache_dir: Folder of the prediction caches.
+        SEQUENCE_LENGTH, skip, clips_per_video: How the clips of a video are sampled.
+        workers: Number of worker processes, each loads its own model. Defaults to one per core.
+        batch_size: Clips per forward pass, filled with the clips of several videos.
+    Returns:
+        predictions: dict video_path -> {"probs": [...], "seconds": latency}.
+        model_calls: Number of videos that went through the model.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"predictions_{file_checksum(modelPath)}_T{SEQUENCE_LENGTH}"
+                                         f"_S{skip}_K{clips_per_video}.json")
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    def key(path):
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}|{stat.st_size}|{int(stat.st_mtime)}"
+
+    missing = [path for path, _ in videos if key(path) not in cache]
+    if missing:
+        workers = workers or os.cpu_count() or 1
+        # every job is enough videos to fill a batch, spread so no worker is left idle
+        per_job = max(1, batch_size // max(clips_per_video, 1))
+        per_job = min(per_job, -(-len(missing) // workers))
+        chunks = [missing[i:i + per_job] for i in range(0, len(missing), per_job)]
+        workers = min(workers, len(chunks))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        print(f"Scoring {len(missing)} videos with {workers} workers")
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(modelPath, threads)) as pool:
+            jobs = [(chunk, SEQUENCE_LENGTH, skip, clips_per_video, batch_size) for chunk in chunks]
+            done = 0
+            for results in pool.imap_unordered(_score_videos, jobs):
+                for path, probs, seconds in results:
+                    cache[key(path)] = {"probs": probs, "seconds": seconds}
+                reported = done // 20
+                done += len(results)
+                if done // 20 > reported or done == len(missing):
+                    print(f"{done}/{len(missing)} videos scored")
+                    # Save as we go so an interrupted run keeps its work.
+                    tmp_path = cache_path + ".tmp"
+                    with open(tmp_path, "w") as f:
+                        json.dump(cache, f)
+                    os.replace(tmp_path, cache_path)
+    else:
+        print("All predictions found in the cache, no model calls")
+
+    return {path: cache[key(path)] for path, _ in videos}, len(missing)
+
+
+def evaluation_report(videos, predictions, threshold=0.5, positive='fight'):
+    '''
+    Compute accuracy, precision, recall, F1, the confusion matrix and latency from cached predictions.
+    A video is predicted positive when its positive class probability is >= threshold.
+    Videos too short to give a full clip are counted in "skipped".
+    '''
+    positive_index = CLASSES_LIST.index(positive)
+    confusion = np.zeros((len(CLASSES_LIST), len(CLASSES_LIST)), dtype=int)
+    latencies = []
+    skipped = 0
+    for path, label in videos:
+        prediction = predictions[path]
+        if prediction["probs"] is None:
+            skipped += 1
+            continue
+        probs = np.array(prediction["probs"])
+        if probs[positive_index] >= threshold:
+            predicted = positive_index
+        else:
+            others = [i for i in range(len(CLASSES_LIST)) if i != positive_index]
+            predicted = others[int(np.argmax(probs[others]))]
+        confusion[label, predicted] += 1
+        latencies.append(prediction["seconds"])
+
+    tp = confusion[positive_index, positive_index]
+    fp = confusion[:, positive_index].sum() - tp
+    fn = confusion[positive_index].sum() - tp
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        "threshold": threshold,
+        "videos": int(confusion.sum()),
+        "skipped": skipped,
+        "accuracy": float(np.trace(confusion) / max(confusion.sum(), 1)),
+        "precision": float(precision),
+        "recall": float(recall),
+        "f1": float(2 * precision * recall / (precision + recall)) if precision + recall else 0.0,
+        "confusion_matrix": confusion.tolist(),
+        "latency_mean_s": float(latencies.mean()),
+        "latency_p50_s": float(np.percentile(latencies, 50)),
+        "latency_p95_s": float(np.percentile(latencies, 95)),
+    }
+
+
+def save_confusion_matrix(confusion, path):
+    '''
+    Save the confusion matrix as <path>.csv and, when matplotlib is installed, as a <path>.png heatmap.
+    '''
+    confusion = np.array(confusion)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".csv", "w") as f:
+        f.write("true\\predicted," + ",".join(CLASSES_LIST) + "\n")
+        for name, row in zip(CLASSES_LIST, confusion):
+            f.write(name + "," + ",".join(str(v) for v in row) + "\n")
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return
+    fig, ax = plt.subplots(figsize=(4, 4))
+    ax.imshow(confusion, cmap="Blues")
+    ax.set_xticks(range(len(CLASSES_LIST)), CLASSES_LIST)
+    ax.set_yticks(range(len(CLASSES_LIST)), CLASSES_LIST)
+    ax.set_xlabel("Predicted")
+    ax.set_ylabel("True")
+    for i in range(confusion.shape[0]):
+        for j in range(confusion.shape[1]):
+            ax.text(j, i, str(confusion[i, j]), ha="center", va="center",
+                    color="white" if confusion[i, j] > confusion.max() / 2 else "black")
+    fig.tight_layout()
+    fig.savefig(path + ".png")
+    plt.close(fig)
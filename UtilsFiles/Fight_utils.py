@@ -10,17 +10,21 @@ import cv2
 import time
 import copy
 import glob
+import hashlib
+import json
 import torch
 import argparse
 import statistics
 import threading
 import torchvision
+import urllib.parse
 import numpy as np
 import pandas as pd
 import torch.nn as nn
 from moviepy.editor import *
 import albumentations as A
 from collections import deque
+from UtilsFiles.Metrics_utils import METRICS
 #from google.colab.patches import cv2_imshow
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -29,14 +33,43 @@ CLASSES_LIST = ['fight','noFight']
 SEQUENCE_LENGTH = 16
 predicted_class_name = ""
 
+# Kinetics-400 normalization used by the torchvision video models.
+MEAN = [0.43216, 0.394666, 0.37645]
+STD = [0.22803, 0.22145, 0.216989]
+
 # Define the transforms
 def transform_():
     transform = A.Compose(
     [A.Resize(128, 171, always_apply=True),A.CenterCrop(112, 112, always_apply=True),
-     A.Normalize(mean = [0.43216, 0.394666, 0.37645],std = [0.22803, 0.22145, 0.216989], always_apply=True)]
+     A.Normalize(mean = MEAN,std = STD, always_apply=True)]
+     )
+    return transform
+
+def transform_uint8_():
+    '''
+    Same resize and center crop as transform_() but without the normalization, so the frames stay uint8
+    (4x smaller than float32) until they reach the model. Use normalize_clips() on the batch afterwards.
+    '''
+    transform = A.Compose(
+    [A.Resize(128, 171, always_apply=True),A.CenterCrop(112, 112, always_apply=True)]
      )
     return transform
 
+def normalize_clips(clips):
+    '''
+    This function will normalize a batch of uint8 RGB clips on the inference device.
+    Args:
+        clips: uint8 tensor or array of shape [batch, num_frames, height, width, 3].
+    Returns:
+        input_frames: float32 tensor of shape [batch, 3, num_frames, height, width] ready for the model.
+    '''
+    if isinstance(clips, np.ndarray):
+        clips = torch.from_numpy(clips)
+    input_frames = clips.to(device).permute(0, 4, 1, 2, 3).float().div_(255.0)
+    mean = torch.tensor(MEAN, device=device).view(1, 3, 1, 1, 1)
+    std = torch.tensor(STD, device=device).view(1, 3, 1, 1, 1)
+    return input_frames.sub_(mean).div_(std)
+
 
 def frames_extraction(video_path,SEQUENCE_LENGTH):
     '''
@@ -89,6 +122,36 @@ def frames_extraction(video_path,SEQUENCE_LENGTH):
     return frames_list
 
 
+def frames_extraction_uint8(video_path, SEQUENCE_LENGTH, start_frame=0, end_frame=None):
+    '''
+    Same sampling as frames_extraction() but restricted to [start_frame, end_frame) and without the normalization.
+    Args:
+        video_path: The path of the video in the disk.
+        SEQUENCE_LENGTH: The number of Frames we want.
+        start_frame: First frame of the segment.
+        end_frame: Frame after the last frame of the segment, None for the end of the video.
+    Returns:
+        frames: uint8 array of shape [num_frames, 112, 112, 3], may hold less than SEQUENCE_LENGTH frames.
+    '''
+    video_reader = cv2.VideoCapture(video_path)
+    video_frames_count = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+    if end_frame is None or end_frame > video_frames_count:
+        end_frame = video_frames_count
+    skip_frames_window = max(int((end_frame - start_frame)/SEQUENCE_LENGTH), 1)
+    transform = transform_uint8_()
+
+    frames_list = []
+    for frame_counter in range(SEQUENCE_LENGTH):
+        video_reader.set(cv2.CAP_PROP_POS_FRAMES, start_frame + frame_counter * skip_frames_window)
+        success, frame = video_reader.read()
+        if not success:
+            break
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frames_list.append(transform(image=frame)['image'])
+    video_reader.release()
+    return np.array(frames_list, dtype=np.uint8).reshape(-1, 112, 112, 3)
+
+
 def create_dataset(DATASET_DIR,CLASSES_LIST,SEQUENCE_LENGTH):
     '''
     This function will extract the data of the selected classes and create the required dataset.
@@ -142,8 +205,17 @@ def create_dataset(DATASET_DIR,CLASSES_LIST,SEQUENCE_LENGTH):
     return  torch.stack(features), torch.stack(labels)
 
 # Function To Train the Model From Pytorch Documentation
-def train_model(device,model, dataloaders, criterion, optimizer, num_epochs=25, is_inception=False):
+def train_model(device,model, dataloaders, criterion, optimizer, num_epochs=25, is_inception=False,
+                teacher=None, temperature=4.0, alpha=0.5):
+    '''
+    Train and validate the model, keeping the weights of the best validation epoch.
+    With a teacher model the loss becomes the knowledge distillation loss:
+        alpha * T^2 * KL(softmax(teacher / T) || softmax(model / T)) + (1 - alpha) * criterion
+    so a small student learns the soft targets of the fine-tuned mc3_18 (see UtilsFiles/Distill_utils.py).
+    '''
     since = time.time()
+    if teacher is not None:
+        teacher.eval()
 
     val_acc_history = []
 
@@ -188,6 +260,12 @@ def train_model(device,model, dataloaders, criterion, optimizer, num_epochs=25,
                     else:
                         outputs = model(inputs)
                         loss = criterion(outputs, labels)
+                        if teacher is not None:
+                            with torch.no_grad():
+                                soft_targets = torch.softmax(teacher(inputs) / temperature, dim=1)
+                            distill = nn.functional.kl_div(torch.log_softmax(outputs / temperature, dim=1),
+                                                           soft_targets, reduction='batchmean')
+                            loss = alpha * temperature ** 2 * distill + (1 - alpha) * loss
 
                     _, preds = torch.max(outputs, 1)
 
@@ -222,17 +300,104 @@ def train_model(device,model, dataloaders, criterion, optimizer, num_epochs=25,
     model.load_state_dict(best_model_wts)
     return model, val_acc_history
 
-def loadModel(modelPath):
+def mc3_18_blocks(model):
+  # residual blocks of an mc3_18, in order
+  return [block for layer in (model.layer1, model.layer2, model.layer3, model.layer4) for block in layer]
+
+
+def build_pruned_mc3_18(channels):
+  '''
+  Rebuild an mc3_18 whose residual blocks keep channels[i] inner channels (conv1 outputs / conv2 inputs),
+  as produced by UtilsFiles/Prune_utils.py. The weights are loaded afterwards.
+  '''
+  model_ft = torchvision.models.video.mc3_18(pretrained=False, progress=False)
+  model_ft.fc = torch.nn.Linear(model_ft.fc.in_features, len(CLASSES_LIST))
+  for block, c in zip(mc3_18_blocks(model_ft), channels):
+      conv1, conv2 = block.conv1[0], block.conv2[0]
+      block.conv1[0] = nn.Conv3d(conv1.in_channels, c, conv1.kernel_size, conv1.stride, conv1.padding, bias=False)
+      block.conv1[1] = nn.BatchNorm3d(c)
+      block.conv2[0] = nn.Conv3d(c, conv2.out_channels, conv2.kernel_size, conv2.stride, conv2.padding, bias=False)
+  return model_ft
+
+
+def buildModel(checkpoint):
+  '''
+  Build the model described by an architecture-plus-weights checkpoint {"arch": ..., "state_dict": ..., ...}.
+  '''
+  arch = checkpoint['arch']
+  if arch == 'mc3_18_pruned':
+      model_ft = build_pruned_mc3_18(checkpoint['channels'])
+  elif arch == 'r2plus1d_student':
+      # imported here, Distill_utils imports this module
+      from UtilsFiles.Distill_utils import R2Plus1DStudent
+      model_ft = R2Plus1DStudent(checkpoint['width'], checkpoint['frames'])
+  else:
+      raise ValueError(f"Unknown model architecture: {arch}")
+  model_ft.load_state_dict(checkpoint['state_dict'])
+  return model_ft
+
+
+def compileModel(model_ft, SEQUENCE_LENGTH=16, batch_size=1, cache_dir='compile_cache'):
+  '''
+  This function will compile the model with torch.compile (inductor backend) for static
+  [batch_size, 3, SEQUENCE_LENGTH, 112, 112] inputs, with conv/bn folding (inductor freezing).
+  The compiled kernels are kept in cache_dir, so a later process start reuses them instead of recompiling.
+  Falls back to the eager model when compilation fails.
+  Args:
+      model_ft: The loaded model, in eval mode.
+      SEQUENCE_LENGTH, batch_size: Shape the model is compiled for, other shapes recompile.
+      cache_dir: Folder of the persisted inductor cache.
+  Returns:
+      The compiled model, or model_ft itself on failure.
+  '''
+  # read by inductor when it compiles, must be set before the first compilation of the process
+  os.makedirs(cache_dir, exist_ok=True)
+  os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+  os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+  os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+  try:
+      import torch._inductor.config as inductor_config
+      since = time.time()
+      compiled = torch.compile(model_ft, backend='inductor', dynamic=False)
+      # compile now rather than on the first window, on an input laid out like the ones of clipsToTensor and
+      # normalize_clips (a permuted channels-last view): a contiguous tensor has other strides and would make
+      # the first real window recompile. Freezing is only enabled for this compilation, not process wide.
+      with torch.no_grad(), inductor_config.patch(freezing=True):
+          compiled(normalize_clips(torch.zeros(batch_size, SEQUENCE_LENGTH, 112, 112, 3, dtype=torch.uint8)))
+      print(f"Model compiled in {time.time()-since:.1f}s (cache: {os.environ['TORCHINDUCTOR_CACHE_DIR']})")
+      return compiled
+  except Exception as e:
+      print(f"torch.compile failed, running in eager mode: {e}")
+      return model_ft
+
+
+def loadModel(modelPath, compile=False, SEQUENCE_LENGTH=16, batch_size=1, compile_cache_dir='compile_cache'):
+  '''
+  Load a saved model for inference. With compile=True the model goes through compileModel
+  for [batch_size, 3, SEQUENCE_LENGTH, 112, 112] clips.
+  '''
   PATH=modelPath
-  model_ft = torchvision.models.video.mc3_18(pretrained=True, progress=False)
-  num_ftrs = model_ft.fc.in_features         #in_features
-  model_ft.fc = torch.nn.Linear(num_ftrs, 2) #nn.Linear(in_features, out_features)
-  model_ft.load_state_dict(torch.load(PATH,map_location=torch.device(device)))
+  checkpoint = torch.load(PATH,map_location=torch.device(device))
+  if 'arch' in checkpoint:
+      # architecture plus weights artifact, e.g. a pruned model or a distilled student
+      model_ft = buildModel(checkpoint)
+  else:
+      model_ft = torchvision.models.video.mc3_18(pretrained=True, progress=False)
+      num_ftrs = model_ft.fc.in_features         #in_features
+      model_ft.fc = torch.nn.Linear(num_ftrs, 2) #nn.Linear(in_features, out_features)
+      model_ft.load_state_dict(checkpoint)
   model_ft.to(device)
   model_ft.eval()
+  if compile:
+      model_ft = compileModel(model_ft, SEQUENCE_LENGTH, batch_size, compile_cache_dir)
   return model_ft
 
-def PredTopKClass(k, clips, model):
+def PredTopKClass(k, clips, model, cache=None):
+  if cache is not None:
+      # identical windows (frozen cameras, looped feeds) are answered from the ResultCache
+      probs = cache.get_or_compute(clips, lambda: PredBatchProbs(clipsToTensor(clips), model)[0])
+      return topKFromProbs(k, probs)[0][0]
+
   with torch.no_grad(): # we do not want to backprop any gradients
 
       input_frames = np.array(clips)
@@ -262,7 +427,11 @@ def PredTopKClass(k, clips, model):
   return Classes_nameTop_k[0]    #list(zip(Classes_nameTop_k,ProbTop_k))
 
 
-def PredTopKProb(k,clips,model):
+def PredTopKProb(k,clips,model,cache=None):
+  if cache is not None:
+      probs = cache.get_or_compute(clips, lambda: PredBatchProbs(clipsToTensor(clips), model)[0])
+      return topKFromProbs(k, probs)
+
   with torch.no_grad(): # we do not want to backprop any gradients
 
       input_frames = np.array(clips)
@@ -291,6 +460,76 @@ def PredTopKProb(k,clips,model):
   ProbTop_k = [round(elem, 5) for elem in ProbTop_k]
   return list(zip(Classes_nameTop_k,ProbTop_k))
 
+def clipsToTensor(clips):
+  '''
+  Stack one clip of normalized frames, as built by transform_(), into a [1, 3, num_frames, height, width] tensor.
+  '''
+  input_frames = np.expand_dims(np.array(clips), axis=0)
+  input_frames = np.transpose(input_frames, (0, 4, 1, 2, 3))
+  return torch.tensor(input_frames, dtype=torch.float32)
+
+
+def PredBatchProbs(input_frames, model):
+  '''
+  This function will run one forward pass over a batch of clips and return the class probabilities.
+  Args:
+      input_frames: float tensor of shape [batch, 3, num_frames, height, width].
+      model: The loaded model.
+  Returns:
+      probs: numpy array of shape [batch, len(CLASSES_LIST)].
+  '''
+  with torch.no_grad():
+      outputs = model(input_frames.to(device))
+      probs = torch.nn.functional.softmax(outputs, dim=1)
+  return probs.cpu().numpy()
+
+
+def PredBatchProbsEmbeddings(input_frames, model):
+  '''
+  Same as PredBatchProbs but also returns the pooled backbone features that go into model.fc,
+  taken from the same forward pass.
+  Returns:
+      probs: numpy array of shape [batch, len(CLASSES_LIST)].
+      embeddings: numpy array of shape [batch, model.fc.in_features] (512 for mc3_18).
+  '''
+  # the hook does not fire inside a torch.compile graph, run the original model (see compileModel)
+  model = getattr(model, '_orig_mod', model)
+  captured = []
+  handle = model.fc.register_forward_pre_hook(lambda module, inputs: captured.append(inputs[0]))
+  try:
+      with torch.no_grad():
+          outputs = model(input_frames.to(device))
+          probs = torch.nn.functional.softmax(outputs, dim=1)
+  finally:
+      handle.remove()
+  return probs.cpu().numpy(), captured[0].cpu().numpy()
+
+
+def model_version(model, exclude=()):
+  '''
+  Short checksum of the model weights, used to key cached predictions and features.
+  Args:
+      model: The loaded model.
+      exclude: Prefixes of parameter names to leave out, e.g. ("fc.",) to key only on the backbone.
+  '''
+  checksum = hashlib.sha1()
+  # a compiled model prefixes its state_dict with _orig_mod., key on the original model
+  model = getattr(model, '_orig_mod', model)
+  for name, tensor in sorted(model.state_dict().items()):
+      if name.startswith(tuple(exclude)):
+          continue
+      checksum.update(name.encode())
+      checksum.update(tensor.detach().cpu().numpy().tobytes())
+  return checksum.hexdigest()[:12]
+
+
+def topKFromProbs(k, probs):
+  '''
+  Turn one row of class probabilities into the same [(class_name, prob), ...] list that PredTopKProb returns.
+  '''
+  Top_k = np.argsort(probs)[::-1][:k]
+  return [(CLASSES_LIST[item].strip(), round(float(probs[item]), 5)) for item in Top_k]
+
 def downloadYouTube(videourl, path):
 
     yt = YouTube(videourl)
@@ -325,15 +564,178 @@ def FightInference_Time(video_path,model,SEQUENCE_LENGTH=64):
   return class_
 
 
-
-
-def predict_on_video(video_file_path, output_folder_path, model, SEQUENCE_LENGTH,skip=2,showInfo=False):
+def read_clip_uint8(video_reader, start_frame, SEQUENCE_LENGTH, skip, transform):
+  '''
+  Seek once to start_frame and read SEQUENCE_LENGTH frames, one every skip frames, as a uint8
+  [num_frames, 112, 112, 3] array. The frames in between are only grabbed, not decoded to BGR.
+  '''
+  video_reader.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+  frames_list = []
+  while len(frames_list) < SEQUENCE_LENGTH:
+      success, frame = video_reader.read()
+      if not success:
+          break
+      frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+      frames_list.append(transform(image=frame)['image'])
+      for _ in range(skip - 1):
+          video_reader.grab()
+  return np.array(frames_list, dtype=np.uint8).reshape(-1, 112, 112, 3)
+
+
+def spread_order(n):
+  '''
+  Order the indices 0..n-1 so that every prefix is spread over the whole range (bit-reversed / van der Corput),
+  e.g. 8 -> [0, 4, 2, 6, 1, 5, 3, 7].
+  '''
+  bits = max(1, (n - 1).bit_length())
+  keys = [int(format(i, f"0{bits}b")[::-1], 2) for i in range(2 ** bits)]
+  return [i for _, i in sorted(zip(keys, range(2 ** bits))) if i < n]
+
+
+class TimestampSampler:
+  '''
+  Select frames by their timestamp instead of their index, so a window always covers the same time and
+  costs the same compute whatever the camera FPS: at 10 Hz a 30 fps camera gives one frame in 3, a 15 fps
+  camera one frame in 1.5 (the frame closest after each 100 ms tick).
+  Args:
+      sample_hz: Frames selected per second of video.
+  '''
+
+  def __init__(self, sample_hz, next_ms=None):
+      self.period_ms = 1000.0 / sample_hz
+      self.next_ms = next_ms
+
+  def select(self, pts_ms):
+      # 1 ms of tolerance for the rounding of container timestamps
+      if self.next_ms is None or pts_ms + 1.0 >= self.next_ms:
+          self.next_ms = (pts_ms if self.next_ms is None else self.next_ms) + self.period_ms
+          # after a gap in the stream, restart the ticks from this frame
+          if self.next_ms <= pts_ms:
+              self.next_ms = pts_ms + self.period_ms
+          return True
+      return False
+
+
+def window_length(sample_hz, window_seconds, SEQUENCE_LENGTH):
+  # Frames per window for a target duration, SEQUENCE_LENGTH when no duration is given.
+  if sample_hz and window_seconds:
+      return max(1, int(round(sample_hz * window_seconds)))
+  return SEQUENCE_LENGTH
+
+
+def frame_time_ms(video_reader, counter, fps):
+  '''
+  Timestamp of the frame just read, from the container (CAP_PROP_POS_MSEC), or from its index and the FPS
+  for sources that do not report timestamps.
+  '''
+  pts_ms = video_reader.get(cv2.CAP_PROP_POS_MSEC)
+  if pts_ms <= 0 and counter > 0:
+      pts_ms = counter * 1000.0 / (fps or 25.0)
+  return pts_ms
+
+
+def stream_name(source):
+  '''
+  Name of a stream source in the metrics, the logs and the window store: the URL of a stream without its
+  user:password@ credentials, query string and fragment (which can hold tokens), e.g. rtsp://10.0.0.7:554/cam12.
+  Local files and camera indices are named as given.
+  '''
+  text = str(source)
+  parts = urllib.parse.urlsplit(text)
+  if not parts.scheme or not parts.netloc:
+      return text
+  host = parts.hostname or ""
+  if ":" in host:
+      host = f"[{host}]"
+  if parts.port:
+      host += f":{parts.port}"
+  return urllib.parse.urlunsplit((parts.scheme, host, parts.path, "", ""))
+
+
+def FightInference_EarlyStop(video_path, model, SEQUENCE_LENGTH=16, skip=2, threshold=0.5, batch_size=4,
+                             max_clips=32, z=2.0, margin=0.05):
+  '''
+  This function will classify a whole video from several clips at spread out offsets, scored batch_size at a time.
+  It stops as soon as the mean fight probability is confidently above or below threshold, i.e. when
+  |mean - threshold| > z * standard error + margin (sample standard deviation, from at least 2 clips),
+  and otherwise keeps sampling up to max_clips.
+  Clear-cut short clips are decided from the first batch while ambiguous long videos get more coverage.
+  Args:
+      video_path: The path of the video in the disk.
+      SEQUENCE_LENGTH: Number of frames per clip.
+      skip: Frame step inside a clip, a clip spans SEQUENCE_LENGTH*skip frames (less for videos that are too short).
+      threshold: Decision threshold on the fight probability.
+      batch_size: Number of clips scored per forward pass.
+      max_clips: Budget of clips per video.
+      z, margin: Width of the confidence band around the threshold.
+  Returns:
+      class_name: The predicted class.
+      prob: The mean fight probability over the scored clips.
+      clips_used: The number of clips scored.
+  '''
+  video_reader = cv2.VideoCapture(video_path)
+  video_frames_count = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+  transform = transform_uint8_()
+
+  # candidate clip starts over the whole video, visited in a spread out order
+  skip = max(1, min(skip, video_frames_count // SEQUENCE_LENGTH))
+  span = SEQUENCE_LENGTH * skip
+  starts = np.unique(np.linspace(0, max(video_frames_count - span, 0), max_clips).astype(int))
+  starts = starts[spread_order(len(starts))]
+
+  fight_index = CLASSES_LIST.index('fight')
+  fight_probs = []
+  for batch_start in range(0, len(starts), batch_size):
+      clips = [read_clip_uint8(video_reader, start, SEQUENCE_LENGTH, skip, transform)
+               for start in starts[batch_start:batch_start + batch_size]]
+      clips = [clip for clip in clips if len(clip) == SEQUENCE_LENGTH]
+      if not clips:
+          continue
+      probs = PredBatchProbs(normalize_clips(np.stack(clips)), model)
+      fight_probs.extend(probs[:, fight_index].tolist())
+
+      # the spread of a single clip is unknown, never stop on fewer than 2
+      if len(fight_probs) < 2:
+          continue
+      mean = float(np.mean(fight_probs))
+      stderr = float(np.std(fight_probs, ddof=1) / np.sqrt(len(fight_probs)))
+      if abs(mean - threshold) > z * stderr + margin:
+          break
+  video_reader.release()
+
+  if not fight_probs:
+      return '', 0.0, 0
+  mean = float(np.mean(fight_probs))
+  class_name = 'fight' if mean >= threshold else 'noFight'
+  return class_name, round(mean, 5), len(fight_probs)
+
+
+
+
+def predict_on_video(video_file_path, output_folder_path, model, SEQUENCE_LENGTH,skip=2,showInfo=False,on_window=None,
+                     embedding_index=None,cache=None,recorder=None,start_frame=0,end_frame=None,checkpoint_every=0,
+                     sample_hz=None,window_seconds=None,window_store=None,camera=None,time_origin=None):
     '''
     This function will perform action recognition on a video using the LRCN model.
     Args:
     video_file_path:  The path of the video stored in the disk on which the action recognition is to be performed.
     output_file_path: The path where the ouput video with the predicted action being performed overlayed will be stored.
     SEQUENCE_LENGTH:  The fixed number of frames of a video that can be passed to the model as one sequence.
+    on_window:        Optional callback(frame_index, predicted_class_name) called after every window.
+    embedding_index:  Optional EmbeddingIndex receiving the backbone embedding of every scored window.
+    cache:            Optional ResultCache, windows already seen are not run through the model again.
+                      Not used together with embedding_index, which needs the embedding of every window.
+    recorder:         Optional IncidentRecorder, every alert also saves a clip with the frames around it.
+    start_frame, end_frame: Only process this frame range, e.g. one time shard of a long video
+                      (see UtilsFiles/Archive_utils.py). Shards should start on a multiple of SEQUENCE_LENGTH*skip.
+    checkpoint_every: Save a checkpoint every this many windows, 0 disables checkpoints. With checkpoints the
+                      output video is written as Output_video_<segment>.mp4 segments closed at every checkpoint,
+                      and a restart resumes from checkpoint.json in the output folder instead of frame 0.
+    sample_hz:        Select frames by timestamp at this rate instead of every skip-th frame (see TimestampSampler).
+    window_seconds:   With sample_hz, window duration in seconds, it sets SEQUENCE_LENGTH = sample_hz * window_seconds.
+    window_store:     Optional WindowStore receiving the probabilities of every window (UtilsFiles/Store_utils.py).
+    camera:           Camera name of the windows in the store, defaults to the video file name.
+    time_origin:      Epoch seconds of the first frame of the video, defaults to the start of the run.
     '''
 
     # Initialize the VideoCapture object to read from the video file.
@@ -349,38 +751,93 @@ def predict_on_video(video_file_path, output_folder_path, model, SEQUENCE_LENGTH
     # if it does'nt, then make the folder
     alert_folder_check(output_folder_path)
 
-    # output video path inside the output folder
-    output_video_path = f"{output_folder_path}/Output_video.mp4"
+    # progress saved at the checkpoints, resumed when a previous run left one
+    checkpoint_path = f"{output_folder_path}/checkpoint.json"
+    state = {"frame": start_frame, "s_no": 1, "segment": 0, "label": "", "done": False, "next_ms": None}
+    if checkpoint_every and os.path.isfile(checkpoint_path):
+        state = load_checkpoint(checkpoint_path)
+        if state["done"]:
+            print(f"{video_file_path} already processed, see {output_folder_path}")
+            video_reader.release()
+            return
+        # alerts raised after the checkpoint are raised again by this run
+        drop_alerts_after(output_folder_path, state["s_no"])
+        print(f"Resuming from frame {state['frame']}")
+
+    def open_video_writer(segment):
+        # output video path inside the output folder
+        if checkpoint_every:
+            output_video_path = f"{output_folder_path}/Output_video_{segment:04d}.mp4"
+        else:
+            output_video_path = f"{output_folder_path}/Output_video.mp4"
+
+        # Initialize the VideoWriter Object to store the output video in the disk.
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        return cv2.VideoWriter(output_video_path, fourcc,
+                               video_reader.get(cv2.CAP_PROP_FPS), (original_video_width, original_video_height))
 
-    # Initialize the VideoWriter Object to store the output video in the disk.
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video_writer = cv2.VideoWriter(output_video_path, fourcc, 
-                                   video_reader.get(cv2.CAP_PROP_FPS), (original_video_width, original_video_height))
+    video_writer = open_video_writer(state["segment"])
 
     # Declare a queue to store video frames.
+    SEQUENCE_LENGTH = window_length(sample_hz, window_seconds, SEQUENCE_LENGTH)
     frames_queue = deque(maxlen = SEQUENCE_LENGTH)
+    sampler = TimestampSampler(sample_hz, state.get("next_ms")) if sample_hz else None
+    if window_store is not None:
+        camera = camera or os.path.basename(video_file_path)
+        time_origin = time.time() if time_origin is None else time_origin
+        # an InferencePool carries the version of its replicas
+        version = getattr(model, 'version', None) or model_version(model)
     transform= transform_()
     # Initialize a variable to store the predicted action being performed in the video.
-    predicted_class_name = ''
+    predicted_class_name = state["label"]
 
     # Iterate until the video is accessed successfully.
-    counter=0
-    s_no = 1
+    counter = state["frame"]
+    s_no = state["s_no"]
+    segment = state["segment"]
+    if counter:
+        video_reader.set(cv2.CAP_PROP_POS_FRAMES, counter)
+    windows = 0
+    checkpoint_due = False
+    stream = os.path.basename(video_file_path)
     while video_reader.isOpened():
 
+        if end_frame is not None and counter >= end_frame:
+            break
+
+        # Checkpoints are taken between windows, so there is no partly filled window to save.
+        # The current segment is closed first, a crash never leaves a checkpointed segment half written.
+        if checkpoint_due:
+            video_writer.release()
+            segment += 1
+            video_writer = open_video_writer(segment)
+            save_checkpoint(checkpoint_path, {"frame": counter, "s_no": s_no, "segment": segment,
+                                              "label": predicted_class_name, "done": False,
+                                              "next_ms": sampler.next_ms if sampler else None})
+            checkpoint_due = False
+
         # Read the frame.
-        ok, frame = video_reader.read()
+        with METRICS.timer("fight_decode_seconds", stream=stream):
+            ok, frame = video_reader.read()
         
         # Check if frame is not read properly then break the loop.
         if not ok:
             break
+        METRICS.inc("fight_frames_total", stream=stream)
 
-        image = frame.copy()
-        framee = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        framee = transform(image=framee)['image']
-        if counter % skip==0:
+        if sampler is not None:
+            selected = sampler.select(frame_time_ms(video_reader, counter, fps))
+        else:
+            selected = counter % skip == 0
+        if selected:
+          # only the sampled frames are converted, resized and normalized
+          with METRICS.timer("fight_preprocess_seconds", stream=stream), torch.profiler.record_function("preprocess"):
+              framee = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+              framee = transform(image=framee)['image']
           # Appending the pre-processed frame into the frames list.
           frames_queue.append(framee)
+          if len(frames_queue) == 1:
+              window_start_ms = frame_time_ms(video_reader, counter, fps)
          
         # changing the predicted class name to blank before the prediction
         # this will make sure to only print the label on the first frame of the bunch
@@ -388,9 +845,29 @@ def predict_on_video(video_file_path, output_folder_path, model, SEQUENCE_LENGTH
 
         # Check if the number of frames in the queue are equal to the fixed sequence length.
         if len(frames_queue) == SEQUENCE_LENGTH:
-            predicted_class_name= PredTopKClass(1,frames_queue, model)
+            with METRICS.timer("fight_forward_seconds", stream=stream), torch.profiler.record_function("forward"):
+                if embedding_index is None and window_store is None:
+                    predicted_class_name= PredTopKClass(1,frames_queue, model, cache)
+                elif embedding_index is None:
+                    # the probabilities of every window go to the store
+                    if cache is not None:
+                        probs = cache.get_or_compute(frames_queue, lambda: PredBatchProbs(clipsToTensor(frames_queue), model)[0])
+                    else:
+                        probs = PredBatchProbs(clipsToTensor(frames_queue), model)[0]
+                    predicted_class_name = topKFromProbs(1, probs)[0][0]
+                    probs = probs[None]
+                else:
+                    # keep the embedding of the same forward pass for similar incident search
+                    probs, embeddings = PredBatchProbsEmbeddings(clipsToTensor(frames_queue), model)
+                    predicted_class_name, prob = topKFromProbs(1, probs[0])[0]
+            METRICS.inc("fight_windows_total", stream=stream)
+            if window_store is not None:
+                window_store.append(camera, time_origin + window_start_ms / 1000.0,
+                                    time_origin + frame_time_ms(video_reader, counter, fps) / 1000.0, probs[0], version)
             if showInfo:
                 print(predicted_class_name)
+            if on_window is not None:
+                on_window(counter, predicted_class_name)
 
             # checking if the bunch has "fight" as the predicted class 
             if predicted_class_name=="fight":
@@ -400,10 +877,24 @@ def predict_on_video(video_file_path, output_folder_path, model, SEQUENCE_LENGTH
 
                 # save the last frame where "fight" label is detected
                 # and also add the timestamp and other info in the cvs file
-                save_alert_image_csv(frame, s_no, output_folder_path)
+                with METRICS.timer("fight_alert_write_seconds", stream=stream):
+                    image_name = save_alert_image_csv(frame, s_no, output_folder_path, counter)
+                s_no += 1
+                if recorder is not None:
+                    recorder.trigger()
+                METRICS.inc("fight_alerts_total", stream=stream)
+            else:
+                image_name = ""
+
+            if embedding_index is not None:
+                embedding_index.add(embeddings, [{"video": video_file_path, "frame": counter,
+                                                  "timestamp": video_reader.get(cv2.CAP_PROP_POS_MSEC) / 1000.0,
+                                                  "label": predicted_class_name, "prob": prob, "image": image_name}])
             
             # reset the queue
             frames_queue = deque(maxlen = SEQUENCE_LENGTH)
+            windows += 1
+            checkpoint_due = checkpoint_every > 0 and windows % checkpoint_every == 0
     
         # Write predicted class name on top of the frame.
         if predicted_class_name=="fight":
@@ -416,12 +907,53 @@ def predict_on_video(video_file_path, output_folder_path, model, SEQUENCE_LENGTH
         
         # Write The frame into the disk using the VideoWriter Object.
         video_writer.write(frame)
+        if recorder is not None:
+            recorder.push(frame)
         # time.sleep(2)
     if showInfo:
         print(f"Counter: {counter}")
     # Release the VideoCapture and VideoWriter objects.
     video_reader.release()
     video_writer.release()
+    if checkpoint_every:
+        save_checkpoint(checkpoint_path, {"frame": counter, "s_no": s_no, "segment": segment,
+                                          "label": predicted_class_name, "done": True,
+                                          "next_ms": sampler.next_ms if sampler else None})
+
+
+def save_checkpoint(path, state):
+    # write then rename, a crash while saving keeps the previous checkpoint
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def drop_alerts_after(path_, s_no):
+    '''
+    Remove the alerts numbered s_no and later (CSV rows and images) from an alert folder,
+    they were raised after the checkpoint a run resumes from.
+    '''
+    csv_file_path = f"{path_}/Report.csv"
+    if not os.path.isfile(csv_file_path):
+        return
+    df = pd.read_csv(csv_file_path)
+    dropped = df[df["S_No"] >= s_no]
+    for image_name in dropped["Image_Name"]:
+        image_path = f"{path_}/{image_name}.jpg"
+        if os.path.isfile(image_path):
+            os.remove(image_path)
+    write_csv_atomic(df[df["S_No"] < s_no], csv_file_path)
+
+
+def write_csv_atomic(df, csv_file_path):
+    # a crash while writing leaves the previous report rather than a half written one
+    df.to_csv(csv_file_path + ".tmp", index=False)
+    os.replace(csv_file_path + ".tmp", csv_file_path)
 
 def alert_folder_check(path_):
     '''
@@ -439,13 +971,14 @@ def alert_folder_check(path_):
         print(f"Folder '{path_}' already exists.")
         # pass
 
-def save_alert_image_csv(frame, s_no, path_):
+def save_alert_image_csv(frame, s_no, path_, frame_index=None):
     '''
     This function will save the alert images in a folder and save the alert info in a csv file in the alert folder.
     Args:
     frame: The alert frame which on which alert is raised.
     s_no: The counter to serialise the alerts in the csv file.
     path_:  The path of the folder stored in the disk on where the output is supposed to be saved.
+    frame_index: Optional position of the frame in the video, used to order the alerts of merged shards.
     '''
 
     # get the current time 
@@ -465,7 +998,7 @@ def save_alert_image_csv(frame, s_no, path_):
 
     # column details to save
     # serial no, alert image name, time stamp and detection in a csv file
-    columns = ["S_No", "Image_Name", "Time_stamp", "Feature"]
+    columns = ["S_No", "Image_Name", "Time_stamp", "Feature", "Frame"]
 
     try:
         # Try to read the existing CSV file into a DataFrame
@@ -478,10 +1011,8 @@ def save_alert_image_csv(frame, s_no, path_):
         df = pd.DataFrame(columns=columns)
 
     # save the details in the csv column
-    new_data = {"S_No": s_no, "Image_Name": timestamp, "Time_stamp": timestamp, "Feature": "Fight"}
-
-    # increase the serial number counter
-    s_no+=1
+    new_data = {"S_No": s_no, "Image_Name": timestamp, "Time_stamp": timestamp, "Feature": "Fight",
+                "Frame": frame_index}
 
     # Convert new_data to a DataFrame
     new_data_df = pd.DataFrame([new_data])
@@ -490,7 +1021,10 @@ def save_alert_image_csv(frame, s_no, path_):
     df = pd.concat([df, new_data_df], ignore_index=True)
 
     # Save the updated DataFrame back to the CSV file
-    df.to_csv(csv_file_path, index=False)
+    write_csv_atomic(df, csv_file_path)
+
+    # return the alert image name so callers can link to it
+    return timestamp
 
 def showIference(model, sequence,skip,input_video_file_path,output_video_file_path,showInfo):
     # Perform Accident Detection on the Test Video.
@@ -503,45 +1037,202 @@ def Fight_PipeLine(modelPath,inputPath,seq,skip,outputPath,showInfo=False):
     predict_on_video(inputPath, outputPath, model,seq,skip,showInfo)
     return outputPath
 
-def streaming_framesInference(frames, model):
-    clips = []
-    transform = transform_()
-    for frame in frames:
-        image = frame.copy()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame = transform(image=frame)['image']
-
-        # Append the normalized frame into the frames list
-        clips.append(frame)
-    first = PredTopKClass(1, clips, model)
-    print(first)
-    print(PredTopKProb(2, clips, model))
-    return first
-
-
-def streaming_predict(frames, model):
-    prediction = streaming_framesInference(frames, model)
-    global predicted_class_name
-    predicted_class_name = prediction
-
-
-def start_streaming(model,streamingPath):
+class StreamRing:
+  '''
+  Preallocated uint8 buffer of the windows of one stream.
+  Frames are downscaled to the model resolution as they are captured (resize and center crop of transform_(),
+  written straight into the ring), so a 4K camera holds 112x112 frames in flight instead of full frames,
+  and the memory of a stream is fixed: slots * SEQUENCE_LENGTH * 112 * 112 * 3 bytes.
+  A full window is handed to an inference thread by its slot index and normalized only in the model batch.
+  Args:
+      SEQUENCE_LENGTH: Frames per window.
+      slots: Windows that can be filled or in inference at once, frames are dropped while all are busy.
+  '''
+
+  def __init__(self, SEQUENCE_LENGTH=16, slots=2, size=112):
+      self.clips = np.zeros((slots, SEQUENCE_LENGTH, size, size, 3), dtype=np.uint8)
+      # resize target of transform_(), reused for every frame
+      self.scratch = np.empty((128, 171, 3), dtype=np.uint8)
+      self.top, self.left = (128 - size) // 2, (171 - size) // 2
+      self.size = size
+      self.busy = [False] * slots
+      # capture time of the first and last frame of every window
+      self.times = [[0.0, 0.0] for _ in range(slots)]
+      self.slot = None
+      self.position = 0
+      self.dropped_frames = 0
+      self.lock = threading.Lock()
+
+  @property
+  def nbytes(self):
+      return self.clips.nbytes + self.scratch.nbytes
+
+  def push(self, frame):
+      '''
+      Downscale one BGR frame into the window being filled.
+      Returns the slot of the window when this frame completes it, otherwise None.
+      '''
+      if self.slot is None:
+          with self.lock:
+              free = [i for i, busy in enumerate(self.busy) if not busy]
+              if not free:
+                  # inference is behind, drop the frame rather than buffer more
+                  self.dropped_frames += 1
+                  return None
+              self.slot = free[0]
+              self.busy[self.slot] = True
+          self.position = 0
+          self.times[self.slot][0] = time.time()
+      cv2.resize(frame, (171, 128), dst=self.scratch, interpolation=cv2.INTER_LINEAR)
+      crop = self.scratch[self.top:self.top + self.size, self.left:self.left + self.size]
+      cv2.cvtColor(crop, cv2.COLOR_BGR2RGB, dst=self.clips[self.slot, self.position])
+      self.position += 1
+      if self.position < self.clips.shape[1]:
+          return None
+      self.times[self.slot][1] = time.time()
+      slot, self.slot = self.slot, None
+      return slot
+
+  def release(self, slot):
+      with self.lock:
+          self.busy[slot] = False
+
+
+def streaming_predict(ring, slot, model, stream="stream", cache=None, recorder=None, window_store=None, version=None):
+    '''
+    Classify the full window in slot of the StreamRing on a background thread, then free the slot.
+    With a WindowStore the probabilities are stored with the capture times of the window.
+    Returns:
+        The predicted class name of the window.
+    '''
+    METRICS.add("fight_inference_in_flight", 1, stream=stream)
+    try:
+        clip = ring.clips[slot]
+        with METRICS.timer("fight_forward_seconds", stream=stream):
+            if cache is not None:
+                probs = cache.get_or_compute(clip, lambda: PredBatchProbs(normalize_clips(clip[None]), model)[0])
+            else:
+                probs = PredBatchProbs(normalize_clips(clip[None]), model)[0]
+        if window_store is not None:
+            window_store.append(stream, ring.times[slot][0], ring.times[slot][1], probs, version)
+    finally:
+        ring.release(slot)
+        METRICS.add("fight_inference_in_flight", -1, stream=stream)
+    METRICS.inc("fight_windows_total", stream=stream)
+    top = topKFromProbs(2, probs)
+    prediction = top[0][0]
+    print(f"{stream}: {prediction} {top}")
+    if prediction == "fight" and recorder is not None:
+        recorder.trigger()
+    return prediction
+
+
+class StreamPipeline:
+  '''
+  Windowing and inference of one live stream, shared by start_streaming and the StreamSupervisor
+  (UtilsFiles/Supervisor_utils.py).
+  Every frame goes to the IncidentRecorder, the selected ones are downscaled into a StreamRing and every full
+  window is classified by streaming_predict on a background thread. Frames are selected by timestamp with
+  sample_hz (see TimestampSampler), otherwise as windows of SEQUENCE_LENGTH consecutive frames starting
+  2.5 s of stream time after the previous window.
+  label is the class of the last classified window of this stream.
+  Call close() before closing the recorder, the window store or the model: it waits for the windows in flight.
+  Args:
+      stream: Name of the stream in the metrics and the window store.
+      version: Model version stored with the windows, computed from the model when a store is given.
+  '''
+
+  def __init__(self, model, stream="stream", SEQUENCE_LENGTH=16, cache=None, recorder=None, sample_hz=None,
+               window_seconds=None, buffer_windows=2, window_store=None, version=None):
+      self.model = model
+      self.stream = stream
+      self.cache = cache
+      self.recorder = recorder
+      self.window_store = window_store
+      if window_store is not None and version is None:
+          version = getattr(model, 'version', None) or model_version(model)
+      self.version = version
+      self.SEQUENCE_LENGTH = window_length(sample_hz, window_seconds, SEQUENCE_LENGTH)
+      self.sampler = TimestampSampler(sample_hz) if sample_hz else None
+      self.ring = StreamRing(self.SEQUENCE_LENGTH, buffer_windows)
+      self.last_ms = None
+      self.threads = []
+      self.label = ""
+      METRICS.set("fight_stream_buffer_bytes", self.ring.nbytes, stream=stream)
+
+  def push(self, frame, pts_ms):
+      '''
+      Take the next BGR frame of the stream and its timestamp in ms.
+      '''
+      if self.recorder is not None:
+          self.recorder.push(frame)
+      if self.sampler is not None:
+          selected = self.sampler.select(pts_ms)
+      else:
+          # keep filling the current window, or start one 2.5 s after the last
+          selected = self.ring.slot is not None or self.last_ms is None or pts_ms - self.last_ms >= 2500
+      if not selected:
+          return
+      with METRICS.timer("fight_preprocess_seconds", stream=self.stream):
+          slot = self.ring.push(frame)
+      if slot is None:
+          return
+      self.last_ms = pts_ms
+      thread = threading.Thread(target=self._predict, args=(slot,))
+      thread.start()
+      self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+
+  def _predict(self, slot):
+      self.label = streaming_predict(self.ring, slot, self.model, self.stream, self.cache, self.recorder,
+                                     self.window_store, self.version)
+
+  def close(self):
+      # wait for the windows in flight and report the frames dropped while inference was behind
+      for thread in self.threads:
+          thread.join()
+      self.threads = []
+      if self.ring.dropped_frames:
+          METRICS.inc("fight_ring_dropped_frames_total", self.ring.dropped_frames, stream=self.stream)
+          print(f"Dropped frames on {self.stream} (inference behind): {self.ring.dropped_frames}")
+          self.ring.dropped_frames = 0
+
+
+def start_streaming(model,streamingPath,cache=None,recorder=None,sample_hz=None,window_seconds=None,SEQUENCE_LENGTH=16,
+                    buffer_windows=2,window_store=None,camera=None):
+    '''
+    Read a stream, classify SEQUENCE_LENGTH frames every few seconds on a background thread and show the live label.
+    With an IncidentRecorder every frame is buffered and a fight saves a clip around it.
+    With sample_hz the frames are selected by timestamp (see TimestampSampler) into back to back windows of
+    window_seconds, instead of SEQUENCE_LENGTH consecutive frames every 2.5 s of stream time.
+    Sampled frames are downscaled at capture into a StreamRing of buffer_windows windows, which bounds the
+    memory of the stream, reported at start and as the fight_stream_buffer_bytes gauge.
+    With a WindowStore the probabilities of every window are stored under camera (default: the stream URL
+    without its credentials, see stream_name), which also labels the metrics of the stream.
+    Returns once the windows in flight are classified (see StreamPipeline).
+    '''
     video = cv2.VideoCapture(streamingPath)
-    l = []
-    last_time = time.time() - 3
+    stream = camera or stream_name(streamingPath)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    pipeline = StreamPipeline(model, stream, SEQUENCE_LENGTH, cache, recorder, sample_hz, window_seconds,
+                              buffer_windows, window_store)
+    print(f"Stream buffer: {pipeline.ring.nbytes / 1e6:.2f} MB ({buffer_windows} windows of "
+          f"{pipeline.SEQUENCE_LENGTH} frames)")
+    counter = 0
     while True:
-        _, frame = video.read()
-        if last_time+2.5 < time.time():
-            l.append(frame)
-        if len(l) == 16:
-            last_time = time.time()
-            x = threading.Thread(target=streaming_predict, args=(l,model))
-            x.start()
-            l = []
-        if predicted_class_name == "fight":
-            cv2.putText(frame, predicted_class_name, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+        with METRICS.timer("fight_decode_seconds", stream=stream):
+            ok, frame = video.read()
+        if not ok or frame is None:
+            # a dropped connection, stop instead of drawing on an empty frame (StreamSupervisor reconnects)
+            METRICS.inc("fight_dropped_frames_total", stream=stream)
+            print(f"Stream {stream} ended or dropped after {counter} frames")
+            break
+        METRICS.inc("fight_frames_total", stream=stream)
+        pipeline.push(frame, frame_time_ms(video, counter, fps))
+        counter += 1
+        if pipeline.label == "fight":
+            cv2.putText(frame, pipeline.label, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
         else:
-            cv2.putText(frame, predicted_class_name, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            cv2.putText(frame, pipeline.label, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
         cv2.imshow("RTSP", frame)
         k = cv2.waitKey(1)
         if k == ord('q'):
@@ -549,6 +1240,7 @@ def start_streaming(model,streamingPath):
 
     video.release()
     cv2.destroyAllWindows()
+    pipeline.close()
 
 # def predict_on_video(video_file_path, output_file_path, CLASSES_LIST, model, device,T=0.25, SEQUENCE_LENGTH=64):
 #     '''
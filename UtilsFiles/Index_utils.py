@@ -0,0 +1,328 @@
+import os
+import io
+import csv
+import json
+import numpy as np
+
+# Rows added to the memory-mapped matrix every time it runs out of space.
+GROW_ROWS = 4096
+
+
+def _kmeans(vectors, k, iterations=20, seed=0):
+    '''
+    Plain Lloyd k-means on the rows of vectors, returns the [k, dim] float32 centroids.
+    '''
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=len(vectors) < k)].copy()
+    for _ in range(iterations):
+        distances = (vectors ** 2).sum(1)[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(1)[None]
+        assignment = distances.argmin(1)
+        for c in range(k):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = members.mean(0)
+    return centroids
+
+
+class EmbeddingIndex:
+    '''
+    Append-only index of clip embeddings for similar incident search.
+    On disk, in folder:
+        vectors.f16   memory-mapped float16 matrix of L2 normalized embeddings, grown in GROW_ROWS chunks.
+        ids.csv       one row per embedding: id, video, frame, timestamp, label, prob, alert image.
+        ids.offsets   int64 byte offset of the end of the header and of every row of ids.csv, so records()
+                      reads only the rows it is asked for.
+        meta.json     dimension and number of rows written. Rows past it in the other files were appended by an
+                      add() that did not finish and are truncated when the index is opened.
+        ivfpq.npz     optional IVF/PQ quantizers built by build_ivfpq() for millions of rows.
+        ivfpq.lists, ivfpq.codes   int32 IVF list and uint8 PQ codes of every row, appended as rows are added.
+    Args:
+        folder: Folder of the index, created if needed.
+        dim: Embedding size, e.g. 512 for mc3_18. By default the size of the first embeddings added, an existing
+             index keeps its own.
+    '''
+
+    def __init__(self, folder, dim=None):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.meta_path = os.path.join(folder, "meta.json")
+        self.vectors_path = os.path.join(folder, "vectors.f16")
+        self.ids_path = os.path.join(folder, "ids.csv")
+        self.offsets_path = os.path.join(folder, "ids.offsets")
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            self.dim, self.count, self.capacity = meta["dim"], meta["count"], meta["capacity"]
+        else:
+            self.dim, self.count, self.capacity = dim, 0, 0
+        self.vectors = None
+        if self.capacity:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r+", shape=(self.capacity, self.dim))
+        self.ivfpq = None
+        self.inverted = None
+        # codes of the rows added since the last search, concatenated once by the next search
+        self.new_codes = []
+        self.ivfpq_path = os.path.join(folder, "ivfpq.npz")
+        self.lists_path = os.path.join(folder, "ivfpq.lists")
+        self.codes_path = os.path.join(folder, "ivfpq.codes")
+        if os.path.isfile(self.ivfpq_path):
+            self.ivfpq = dict(np.load(self.ivfpq_path))
+            if "lists" in self.ivfpq:
+                # older index with the codes inside ivfpq.npz, move them to the append-only files
+                self._write_codes(self.ivfpq.pop("lists"), self.ivfpq.pop("codes"), "wb")
+                np.savez(self.ivfpq_path, **self.ivfpq)
+            m = self.ivfpq["codebooks"].shape[0]
+            # rows past count were appended by an add that did not finish, the next add appends after count
+            os.truncate(self.lists_path, self.count * 4)
+            os.truncate(self.codes_path, self.count * m)
+            self.ivfpq["lists"] = np.fromfile(self.lists_path, dtype=np.int32)
+            self.ivfpq["codes"] = np.fromfile(self.codes_path, dtype=np.uint8).reshape(-1, m)
+        # end of the last row of ids.csv
+        self.ids_end = 0
+        if os.path.isfile(self.ids_path):
+            if not os.path.isfile(self.offsets_path) or os.path.getsize(self.offsets_path) < (self.count + 1) * 8:
+                # older index without ids.offsets
+                self._scan_offsets()
+            os.truncate(self.offsets_path, (self.count + 1) * 8)
+            with open(self.offsets_path, "rb") as f:
+                f.seek(self.count * 8)
+                self.ids_end = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+            os.truncate(self.ids_path, self.ids_end)
+        elif os.path.isfile(self.offsets_path):
+            os.remove(self.offsets_path)
+
+    def _scan_offsets(self):
+        offsets = []
+        with open(self.ids_path, "rb") as f:
+            position = len(f.readline())
+            offsets.append(position)
+            while len(offsets) <= self.count:
+                line = f.readline()
+                # a quoted field can hold a line break, a row ends where its quotes are balanced
+                while line.count(b'"') % 2:
+                    more = f.readline()
+                    if not more:
+                        break
+                    line += more
+                if not line:
+                    break
+                position += len(line)
+                offsets.append(position)
+        np.asarray(offsets, dtype=np.int64).tofile(self.offsets_path)
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self, rows):
+        capacity = self.capacity
+        while capacity < self.count + rows:
+            capacity += GROW_ROWS
+        if capacity == self.capacity:
+            return
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        # Extending the file keeps the rows already written in place.
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * self.dim * 2)
+        self.capacity = capacity
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r+", shape=(capacity, self.dim))
+
+    def add(self, embeddings, records):
+        '''
+        Append embeddings with one record dict per row (video, frame, timestamp, label, prob, image).
+        Returns the ids given to the new rows.
+        '''
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            self.dim = embeddings.shape[-1]
+        if embeddings.shape[-1] != self.dim:
+            raise ValueError(f"Embeddings of size {embeddings.shape[-1]} do not fit an index of size {self.dim}")
+        embeddings = embeddings.reshape(-1, self.dim)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+        self._grow(len(embeddings))
+        ids = list(range(self.count, self.count + len(embeddings)))
+        self.vectors[self.count:self.count + len(embeddings)] = embeddings.astype(np.float16)
+        self.vectors.flush()
+
+        new_file = not os.path.isfile(self.ids_path)
+        rows = [["id", "video", "frame", "timestamp", "label", "prob", "image"]] if new_file else []
+        rows += [[id_, record.get("video", ""), record.get("frame", ""), record.get("timestamp", ""),
+                  record.get("label", ""), record.get("prob", ""), record.get("image", "")]
+                 for id_, record in zip(ids, records)]
+        text = io.StringIO()
+        writer = csv.writer(text)
+        lines = []
+        for row in rows:
+            writer.writerow(row)
+            lines.append(text.getvalue().encode())
+            text.seek(0)
+            text.truncate()
+        ends = self.ids_end + np.cumsum([len(line) for line in lines])
+        data = b"".join(lines)
+        with open(self.ids_path, "ab") as f:
+            f.write(data)
+        with open(self.offsets_path, "ab") as f:
+            np.asarray(ends, dtype=np.int64).tofile(f)
+        self.ids_end += len(data)
+
+        if self.ivfpq is not None:
+            self._encode(embeddings, ids)
+        # Only count the rows once both files have them.
+        self.count += len(embeddings)
+        with open(self.meta_path, "w") as f:
+            json.dump({"dim": self.dim, "count": self.count, "capacity": self.capacity}, f)
+        return ids
+
+    def records(self, ids=None):
+        '''
+        Read the id table, optionally only the given ids, as a list of dicts.
+        The given ids are read at their offsets in ids.csv, without reading the rest of the table.
+        '''
+        if not os.path.isfile(self.ids_path):
+            return []
+        if ids is None:
+            with open(self.ids_path, newline="") as f:
+                return [row for row in csv.DictReader(f) if int(row["id"]) < self.count]
+        rows = []
+        with open(self.offsets_path, "rb") as offsets, open(self.ids_path, "rb") as f:
+            header = next(csv.reader([f.readline().decode()]))
+            for id_ in ids:
+                id_ = int(id_)
+                if not 0 <= id_ < self.count:
+                    continue
+                # the header end is the first offset, row id_ spans offsets id_ to id_ + 1
+                offsets.seek(id_ * 8)
+                start, end = np.frombuffer(offsets.read(16), dtype=np.int64)
+                f.seek(start)
+                row = next(csv.reader(io.StringIO(f.read(end - start).decode(), newline="")))
+                rows.append(dict(zip(header, row)))
+        return rows
+
+    def search(self, queries, k=10, chunk_rows=262144, nprobe=8, refine=10):
+        '''
+        Batched cosine top-k.
+        Args:
+            queries: Array of shape [num_queries, dim] or [dim].
+            k: Number of neighbours per query.
+            chunk_rows: Rows of the matrix scored at once, bounds the memory of the exact search.
+            nprobe: Number of IVF lists scanned per query when the IVF/PQ layer is built.
+            refine: The k * refine best PQ candidates are re-scored exactly from the matrix.
+        Returns:
+            ids: int64 array [num_queries, k], -1 where there are fewer than k rows.
+            scores: float32 array [num_queries, k] of cosine similarities, best first.
+        '''
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.dim is None:
+            # nothing added yet
+            queries = queries.reshape(-1, queries.shape[-1])
+            return (np.full((len(queries), k), -1, dtype=np.int64),
+                    np.full((len(queries), k), -np.inf, dtype=np.float32))
+        queries = queries.reshape(-1, self.dim)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True) + 1e-12
+        if self.ivfpq is not None:
+            return self._search_ivfpq(queries, k, nprobe, refine)
+
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for start in range(0, self.count, chunk_rows):
+            end = min(start + chunk_rows, self.count)
+            scores = queries @ np.asarray(self.vectors[start:end], dtype=np.float32).T
+            best_ids, best_scores = _merge_topk(best_ids, best_scores, scores, start, k)
+        return best_ids, best_scores
+
+    def build_ivfpq(self, nlist=256, m=16, train_rows=100000, seed=0):
+        '''
+        Train the optional IVF/PQ layer on a sample of the rows and encode every row.
+        Each row is assigned to one of nlist coarse centroids and its residual is stored as m one-byte
+        product-quantization codes, so a search only scores the nprobe closest lists from a lookup table.
+        Args:
+            nlist: Number of coarse IVF lists.
+            m: Number of PQ sub-vectors, dim must be divisible by m.
+            train_rows: Number of rows sampled to train the quantizers.
+        '''
+        if self.dim % m:
+            raise ValueError(f"dim {self.dim} is not divisible by m={m}")
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self.vectors[rng.choice(self.count, size=min(train_rows, self.count), replace=False)],
+                            dtype=np.float32)
+        coarse = _kmeans(sample, min(nlist, len(sample)), seed=seed)
+        residuals = sample - coarse[_nearest(sample, coarse)]
+        sub = self.dim // m
+        codebooks = np.stack([_kmeans(residuals[:, i * sub:(i + 1) * sub], min(256, len(sample)), seed=seed)
+                              for i in range(m)])
+        self.ivfpq = {"coarse": coarse, "codebooks": codebooks,
+                      "lists": np.zeros(0, dtype=np.int32), "codes": np.zeros((0, m), dtype=np.uint8)}
+        self.new_codes = []
+        self._write_codes(self.ivfpq["lists"], self.ivfpq["codes"], "wb")
+        for start in range(0, self.count, 65536):
+            end = min(start + 65536, self.count)
+            self._encode(np.asarray(self.vectors[start:end], dtype=np.float32), range(start, end))
+        np.savez(self.ivfpq_path, coarse=coarse, codebooks=codebooks)
+
+    def _write_codes(self, lists, codes, mode="ab"):
+        with open(self.lists_path, mode) as f:
+            np.asarray(lists, dtype=np.int32).tofile(f)
+        with open(self.codes_path, mode) as f:
+            np.asarray(codes, dtype=np.uint8).tofile(f)
+
+    def _encode(self, embeddings, ids):
+        # only the new rows are written, appended to ivfpq.lists and ivfpq.codes
+        coarse, codebooks = self.ivfpq["coarse"], self.ivfpq["codebooks"]
+        m, _, sub = codebooks.shape
+        lists = _nearest(embeddings, coarse).astype(np.int32)
+        residuals = embeddings - coarse[lists]
+        codes = np.stack([_nearest(residuals[:, i * sub:(i + 1) * sub], codebooks[i]) for i in range(m)],
+                         axis=1).astype(np.uint8)
+        self._write_codes(lists, codes)
+        self.new_codes.append((lists, codes))
+        self.inverted = None
+
+    def _search_ivfpq(self, queries, k, nprobe, refine):
+        if self.new_codes:
+            self.ivfpq["lists"] = np.concatenate([self.ivfpq["lists"]] + [lists for lists, _ in self.new_codes])
+            self.ivfpq["codes"] = np.concatenate([self.ivfpq["codes"]] + [codes for _, codes in self.new_codes])
+            self.new_codes = []
+        coarse, codebooks = self.ivfpq["coarse"], self.ivfpq["codebooks"]
+        lists, codes = self.ivfpq["lists"], self.ivfpq["codes"]
+        m, _, sub = codebooks.shape
+        if self.inverted is None:
+            # Row ids grouped by list, with the start offset of every list.
+            order = np.argsort(lists, kind="stable")
+            self.inverted = (order, np.searchsorted(lists[order], np.arange(len(coarse) + 1)))
+        order, offsets = self.inverted
+
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        probes = np.argsort(-(queries @ coarse.T), axis=1)[:, :nprobe]
+        for q, query in enumerate(queries):
+            candidates = np.concatenate([order[offsets[p]:offsets[p + 1]] for p in probes[q]])
+            if not len(candidates):
+                continue
+            # Inner product of the query with every codeword of every sub-vector.
+            table = np.einsum("ms,mcs->mc", query.reshape(m, sub), codebooks)
+            scores = coarse[lists[candidates]] @ query + table[np.arange(m), codes[candidates]].sum(1)
+            shortlist = candidates[np.argsort(-scores)[:k * refine]]
+            # Re-score the shortlist exactly, reading rows in file order.
+            shortlist.sort()
+            exact = np.asarray(self.vectors[shortlist], dtype=np.float32) @ query
+            top = np.argsort(-exact)[:k]
+            best_ids[q, :len(top)] = shortlist[top]
+            best_scores[q, :len(top)] = exact[top]
+        return best_ids, best_scores
+
+
+def _nearest(vectors, centroids):
+    distances = -2 * vectors @ centroids.T + (centroids ** 2).sum(1)[None]
+    return distances.argmin(1)
+
+
+def _merge_topk(best_ids, best_scores, scores, offset, k):
+    # Keep the k best of the previous best and the new chunk of scores.
+    take = min(k, scores.shape[1])
+    part = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+    ids = np.concatenate([best_ids, part + offset], axis=1)
+    all_scores = np.concatenate([best_scores, np.take_along_axis(scores, part, axis=1)], axis=1)
+    order = np.argsort(-all_scores, axis=1)[:, :k]
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(all_scores, order, axis=1)
@@ -0,0 +1,285 @@
+import os
+import cv2
+import json
+import time
+import socket
+import threading
+import numpy as np
+import pandas as pd
+
+from UtilsFiles.Fight_utils import transform_uint8_, normalize_clips, PredBatchProbs, CLASSES_LIST
+
+
+def write_json_atomic(path, data):
+    # write then rename, readers on other machines never see a half written file
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def plan_shards(shared_dir, videos, shard_size=10):
+    '''
+    Write the shard manifest of a scoring job into the shared directory: the videos split in shards of
+    shard_size. An existing manifest is kept, so every node can run the plan step safely.
+    Returns:
+        shards: List of lists of video paths.
+    '''
+    os.makedirs(os.path.join(shared_dir, "leases"), exist_ok=True)
+    os.makedirs(os.path.join(shared_dir, "results"), exist_ok=True)
+    manifest_path = os.path.join(shared_dir, "manifest.json")
+    if not os.path.isfile(manifest_path):
+        shards = [videos[i:i + shard_size] for i in range(0, len(videos), shard_size)]
+        tmp_path = f"{manifest_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"shards": shards}, f)
+        try:
+            # link fails if the manifest exists: when two nodes plan at once only the first one is published,
+            # and it appears complete, a node that loses the race never reads a half written manifest
+            os.link(tmp_path, manifest_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    return load_shards(shared_dir)
+
+
+def load_shards(shared_dir):
+    manifest_path = os.path.join(shared_dir, "manifest.json")
+    if not os.path.isfile(manifest_path):
+        raise FileNotFoundError(f"No manifest in {shared_dir}, run the plan step first")
+    with open(manifest_path) as f:
+        return json.load(f)["shards"]
+
+
+class ShardLease:
+    '''
+    Lease on one shard held through files in <shared_dir>/leases, with no central service.
+    A lease is the file <shard>.lease.<generation> created with O_CREAT | O_EXCL, which only one worker can
+    create. A crashed worker stops renewing its lease, once it expires any worker takes the shard over by
+    creating the next generation, again with O_EXCL, so two workers never both win the same generation.
+    The lease is renewed by a heartbeat thread every ttl / 3 seconds while the shard is processed.
+    Clocks of the workers are assumed to agree within much less than ttl.
+    Args:
+        shared_dir: The shared directory of the job.
+        shard: Index of the shard.
+        worker: Name of this worker, written in the lease.
+        ttl: Seconds a lease stays valid without renewal.
+    '''
+
+    def __init__(self, shared_dir, shard, worker, ttl=60.0):
+        self.folder = os.path.join(shared_dir, "leases")
+        self.prefix = f"{shard:05d}.lease."
+        self.worker = worker
+        self.ttl = ttl
+        self.path = None
+        self.generation = None
+        self.stop_event = threading.Event()
+        self.heartbeat = None
+
+    def _generations(self):
+        return sorted(int(name[len(self.prefix):]) for name in os.listdir(self.folder)
+                      if name.startswith(self.prefix) and name[len(self.prefix):].isdigit())
+
+    def _expired(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)["expires"] < time.time()
+        except (ValueError, KeyError):
+            # created but not written yet: expired only if it stayed empty for a whole ttl
+            try:
+                return time.time() - os.path.getmtime(path) > self.ttl
+            except FileNotFoundError:
+                return True
+        except FileNotFoundError:
+            return True
+
+    def _record(self):
+        return {"worker": self.worker, "host": socket.gethostname(), "pid": os.getpid(),
+                "expires": time.time() + self.ttl}
+
+    def acquire(self):
+        '''
+        Try to take the shard. Returns True when this worker now holds the lease.
+        '''
+        generations = self._generations()
+        if generations and not self._expired(os.path.join(self.folder, self.prefix + str(generations[-1]))):
+            return False
+        generation = generations[-1] + 1 if generations else 0
+        path = os.path.join(self.folder, self.prefix + str(generation))
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._record(), f)
+        self.path = path
+        self.generation = generation
+        self.stop_event.clear()
+        self.heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self.heartbeat.start()
+        return True
+
+    def _renew(self):
+        while not self.stop_event.wait(self.ttl / 3):
+            write_json_atomic(self.path, self._record())
+
+    def held(self):
+        # False once another worker took the shard over after this lease expired
+        return self.generation is not None and self._generations()[-1] == self.generation
+
+    def release(self):
+        self.stop_event.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        self.heartbeat = None
+
+
+def score_video_windows(video_path, model, SEQUENCE_LENGTH=16, skip=2, threshold=0.5, batch_size=8):
+    '''
+    Score a video with the windows of predict_on_video (SEQUENCE_LENGTH frames, one every skip frames, back to
+    back), batched and without writing an output video.
+    Returns:
+        dict with the video, its frames, fps and windows, the max and mean fight probability, the video label
+        (fight when a window reaches threshold, like an alert of predict_on_video) and the alert frames.
+    '''
+    video_reader = cv2.VideoCapture(video_path)
+    if not video_reader.isOpened():
+        raise IOError(f"Cannot open {video_path}")
+    fps = video_reader.get(cv2.CAP_PROP_FPS)
+    transform = transform_uint8_()
+    fight_index = CLASSES_LIST.index('fight')
+    # one preallocated batch scored as soon as it is full, memory does not grow with the video length
+    batch = np.empty((batch_size, SEQUENCE_LENGTH, 112, 112, 3), dtype=np.uint8)
+    fight, ends = [], []
+    filled = position = 0
+    counter = 0
+    while True:
+        if counter % skip == 0:
+            ok, frame = video_reader.read()
+            if ok:
+                batch[filled, position] = transform(image=cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))['image']
+                position += 1
+        else:
+            # frames that are not sampled are not decoded to BGR
+            ok = video_reader.grab()
+        if not ok:
+            break
+        if position == SEQUENCE_LENGTH:
+            ends.append(counter)
+            position = 0
+            filled += 1
+            if filled == batch_size:
+                fight.append(PredBatchProbs(normalize_clips(batch), model)[:, fight_index])
+                filled = 0
+        counter += 1
+    video_reader.release()
+    if filled:
+        fight.append(PredBatchProbs(normalize_clips(batch[:filled]), model)[:, fight_index])
+
+    fight = np.concatenate(fight) if fight else np.zeros(0)
+    return {"video": video_path, "frames": counter, "fps": fps, "windows": len(ends),
+            "fight_max": float(fight.max()) if len(fight) else None,
+            "fight_mean": float(fight.mean()) if len(fight) else None,
+            "label": ("fight" if fight.max() >= threshold else "noFight") if len(fight) else None,
+            "alert_frames": [int(end) for end, p in zip(ends, fight) if p >= threshold]}
+
+
+def run_worker(shared_dir, modelPath, worker=None, SEQUENCE_LENGTH=16, skip=2, threshold=0.5, ttl=60.0,
+               poll_seconds=5.0):
+    '''
+    This function will take shards of the manifest one at a time, score their videos and write
+    <shared_dir>/results/<shard>.json, until every shard has a result. Shards leased by live workers are
+    retried every poll_seconds in case their worker dies. Any number of workers can run on any number of
+    machines that see the shared directory.
+    Returns:
+        Indices of the shards this worker scored.
+    '''
+    from UtilsFiles.Fight_utils import loadModel
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    shards = load_shards(shared_dir)
+    results_dir = os.path.join(shared_dir, "results")
+    model = None
+    done = []
+    while True:
+        pending = [i for i in range(len(shards))
+                   if not os.path.isfile(os.path.join(results_dir, f"{i:05d}.json"))]
+        if not pending:
+            return done
+        claimed = False
+        # start at a worker dependent offset so workers do not all race for the same shard
+        offset = sum(map(ord, worker)) % len(pending)
+        for shard in pending[offset:] + pending[:offset]:
+            lease = ShardLease(shared_dir, shard, worker, ttl)
+            if not lease.acquire():
+                continue
+            claimed = True
+            try:
+                # another worker may have finished it between the listing and the lease
+                result_path = os.path.join(results_dir, f"{shard:05d}.json")
+                if os.path.isfile(result_path):
+                    continue
+                model = model or loadModel(modelPath)
+                start = time.time()
+                videos = []
+                for path in shards[shard]:
+                    try:
+                        videos.append(score_video_windows(path, model, SEQUENCE_LENGTH, skip, threshold))
+                    except Exception as e:
+                        # one corrupt or unreadable video must not fail the shard on every worker that takes it
+                        print(f"{worker}: {path} failed: {e}")
+                        videos.append({"video": path, "error": str(e)})
+                # results are the same whoever scores the shard, a late duplicate write is harmless
+                write_json_atomic(result_path, {"shard": shard, "worker": worker, "seconds": time.time() - start,
+                                                "lease_held": lease.held(), "videos": videos})
+                done.append(shard)
+                print(f"{worker}: shard {shard} scored in {time.time()-start:.1f}s")
+            finally:
+                lease.release()
+        if not claimed:
+            time.sleep(poll_seconds)
+
+
+def merge_results(shared_dir, output_path):
+    '''
+    Combine the per-shard result files into one CSV with a row per video.
+    Videos that could not be scored are rows with an error and no probabilities.
+    Returns:
+        The merged DataFrame, the list of shards still missing a result and the list of videos that failed.
+    '''
+    shards = load_shards(shared_dir)
+    rows, missing, failed = [], [], []
+    for shard in range(len(shards)):
+        result_path = os.path.join(shared_dir, "results", f"{shard:05d}.json")
+        if not os.path.isfile(result_path):
+            missing.append(shard)
+            continue
+        with open(result_path) as f:
+            result = json.load(f)
+        for video in result["videos"]:
+            if "error" in video:
+                failed.append(video["video"])
+                rows.append(dict(video, shard=shard, worker=result["worker"]))
+                continue
+            rows.append(dict(video, shard=shard, worker=result["worker"],
+                             alert_frames=" ".join(str(frame) for frame in video["alert_frames"])))
+    merged = pd.DataFrame(rows)
+    merged.to_csv(output_path + ".tmp", index=False)
+    os.replace(output_path + ".tmp", output_path)
+    return merged, missing, failed
+
+
+def run_local_workers(shared_dir, modelPath, workers=2, SEQUENCE_LENGTH=16, skip=2, threshold=0.5, ttl=60.0):
+    '''
+    Run several workers as local processes against one shared directory, e.g. a temp directory, to exercise
+    the lease protocol on one machine. The manifest must be planned first.
+    '''
+    import multiprocessing as mp
+    ctx = mp.get_context("spawn")
+    processes = [ctx.Process(target=run_worker, args=(shared_dir, modelPath, f"local-{i}", SEQUENCE_LENGTH, skip,
+                                                      threshold, ttl, min(5.0, ttl / 3)))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _NullTimer:
+    # Shared do-nothing context manager handed out while the registry is disabled.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    '''
+    Counters, gauges and latency histograms keyed by metric name and labels.
+    Every method returns immediately while the registry is disabled, so the instrumented code paths cost
+    one attribute check when nobody is collecting.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.enabled = False
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def add(self, name, value, **labels):
+        # Move a gauge up or down, e.g. the number of windows waiting for the model.
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            histogram["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def timer(self, name, **labels):
+        '''
+        Context manager observing the elapsed time of its block into the histogram name.
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        '''
+        Return a JSON friendly copy of every metric.
+        '''
+        def labelled(key):
+            return {"name": key[0], "labels": dict(key[1])}
+
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": [dict(labelled(key), value=value) for key, value in self.counters.items()],
+                "gauges": [dict(labelled(key), value=value) for key, value in self.gauges.items()],
+                "histograms": [dict(labelled(key), sum=h["sum"], count=h["count"],
+                                    buckets=dict(zip([str(b) for b in self.buckets] + ["+Inf"], h["buckets"])))
+                               for key, h in self.histograms.items()],
+            }
+
+    def prometheus_text(self):
+        '''
+        Render every metric in the Prometheus text exposition format.
+        '''
+        def label_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in items) + "}"
+
+        def escape(value):
+            # the text format escapes backslash, double quote and line feed in label values
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {name} {kind}")
+                        typed.add(name)
+                    lines.append(f"{name}{label_text(labels)} {value}")
+            typed = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip([str(b) for b in self.buckets] + ["+Inf"], h["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{label_text(labels)} {h['sum']}")
+                lines.append(f"{name}_count{label_text(labels)} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# Process wide registry used by the instrumented functions, disabled until enable() is called.
+METRICS = MetricsRegistry()
+
+
+def start_metrics_server(port, host="0.0.0.0", registry=METRICS):
+    '''
+    Serve the registry on http://host:port/metrics in the Prometheus text format from a daemon thread.
+    '''
+    registry.enable()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics.json":
+                data = json.dumps(registry.snapshot()).encode()
+                content_type = "application/json"
+            else:
+                data = registry.prometheus_text().encode()
+                content_type = "text/plain; version=0.0.4"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def start_json_dump(path, interval=10.0, registry=METRICS):
+    '''
+    Write a JSON snapshot of the registry to path every interval seconds from a daemon thread.
+    Each snapshot also carries the per second rate of every counter since the previous snapshot,
+    e.g. windows/sec per stream. The file is replaced atomically so readers never see half a dump.
+    Returns a function that writes the last snapshot and stops the dumps.
+    '''
+    registry.enable()
+    stop_event = threading.Event()
+
+    def dump(previous):
+        snapshot = registry.snapshot()
+        counters = {(c["name"], tuple(sorted(c["labels"].items()))): c["value"] for c in snapshot["counters"]}
+        if previous is not None:
+            elapsed = max(snapshot["time"] - previous[0], 1e-9)
+            snapshot["rates"] = [{"name": name + "_per_second", "labels": dict(labels),
+                                  "value": (value - previous[1].get((name, labels), 0)) / elapsed}
+                                 for (name, labels), value in counters.items()]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp_path, path)
+        return snapshot["time"], counters
+
+    def run():
+        previous = None
+        while not stop_event.wait(interval):
+            previous = dump(previous)
+        dump(previous)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        stop_event.set()
+        thread.join()
+    return stop
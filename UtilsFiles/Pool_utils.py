@@ -0,0 +1,249 @@
+import os
+import time
+import queue
+import itertools
+import threading
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import Future
+
+from UtilsFiles.Metrics_utils import METRICS
+
+
+def core_sets(replicas, threads_per_replica=None):
+    '''
+    Split the cores this process may run on into disjoint sets, one per replica.
+    Args:
+        replicas: Number of sets.
+        threads_per_replica: Cores per set, defaults to an even split of the available cores.
+    Returns:
+        List of replicas lists of core ids. Sets are reused round robin when there are fewer cores than asked.
+    '''
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    threads_per_replica = threads_per_replica or max(1, len(cores) // replicas)
+    sets = [cores[i:i + threads_per_replica] for i in range(0, len(cores), threads_per_replica)]
+    sets = [s for s in sets if len(s) == threads_per_replica] or [cores[:threads_per_replica]]
+    return [sets[i % len(sets)] for i in range(replicas)]
+
+
+def replica_process(replica_id, modelPath, cores, task_queue, result_queue, compile=False, SEQUENCE_LENGTH=16,
+                    compile_cache_dir='compile_cache', current_jobs=None):
+    '''
+    This function runs in its own process. It pins itself to cores, sizes the torch thread pool to match,
+    loads its own copy of the model and runs the jobs it takes from the shared task queue.
+    Args:
+        replica_id: Index of the replica, sent back with every result.
+        cores: Core ids this replica runs on.
+        task_queue: Queue of (job_id, inputs) jobs, None stops the replica. uint8 [B,T,H,W,3] clips are
+                    normalized here, float [B,3,T,H,W] inputs are run as they are.
+        result_queue: Queue receiving (job_id, replica_id, logits or exception, busy_seconds) messages.
+        current_jobs: Shared array where the replica records the job it is running (-1 when idle), so the
+                      pool can fail that job if the replica dies.
+    '''
+    import torch
+    from UtilsFiles.Fight_utils import loadModel, normalize_clips, model_version
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    model = loadModel(modelPath, compile, SEQUENCE_LENGTH, compile_cache_dir=compile_cache_dir)
+    result_queue.put((None, replica_id, model_version(model), 0.0))
+
+    while True:
+        job = task_queue.get()
+        if job is None:
+            break
+        job_id, inputs = job
+        if current_jobs is not None:
+            current_jobs[replica_id] = job_id
+        start = time.perf_counter()
+        try:
+            if inputs.dtype == np.uint8:
+                inputs = normalize_clips(inputs)
+            else:
+                # back to the channels-last layout of clipsToTensor the compiled model was warmed up on,
+                # the queue delivers contiguous arrays
+                inputs = torch.from_numpy(inputs).permute(0, 2, 3, 4, 1).contiguous().permute(0, 4, 1, 2, 3)
+            with torch.no_grad():
+                result = model(inputs.to(next(model.parameters()).device)).cpu().numpy()
+        except Exception as e:
+            result = e
+        result_queue.put((job_id, replica_id, result, time.perf_counter() - start))
+        if current_jobs is not None:
+            current_jobs[replica_id] = -1
+
+
+class InferencePool:
+    '''
+    N model replicas in their own processes, each pinned to a disjoint core set with its own torch thread count,
+    for more aggregate throughput than one model over-threaded across all cores.
+    Jobs go through one shared queue, so an idle replica always takes the next job.
+    The pool is callable like a model: pool(inputs) blocks and returns the logits tensor, so predict_on_video,
+    start_streaming and PredBatchProbs can use it unchanged. Several threads (videos, streams) calling the
+    pool at once are spread across the replicas.
+    A replica that fails to load its model makes the constructor raise, and a replica dying mid-run fails
+    the job it was running, all pending jobs fail once no replica is left. A replica can die after taking a
+    job from the queue but before recording it, so when one dies every pending job no live replica is
+    running is queued again. A job still in the queue then runs twice and the second result is dropped.
+    Args:
+        modelPath: Path of the model weights, loaded by every replica.
+        replicas: Number of replica processes.
+        threads_per_replica: Cores (and torch threads) per replica, defaults to an even split.
+        compile, SEQUENCE_LENGTH, compile_cache_dir: Passed to loadModel in every replica.
+    '''
+
+    def __init__(self, modelPath, replicas=2, threads_per_replica=None, compile=False, SEQUENCE_LENGTH=16,
+                 compile_cache_dir='compile_cache'):
+        ctx = mp.get_context("spawn")
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.cores = core_sets(replicas, threads_per_replica)
+        self.current_jobs = ctx.Array('q', [-1] * replicas)
+        self.processes = [ctx.Process(target=replica_process,
+                                      args=(i, modelPath, self.cores[i], self.task_queue, self.result_queue,
+                                            compile, SEQUENCE_LENGTH, compile_cache_dir, self.current_jobs),
+                                      daemon=True)
+                          for i in range(replicas)]
+        for process in self.processes:
+            process.start()
+
+        # Wait for every replica to load its model, they all report the same weights checksum.
+        versions = set()
+        loaded = 0
+        while loaded < replicas:
+            try:
+                _, _, version, _ = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                dead = [(i, p.exitcode) for i, p in enumerate(self.processes) if not p.is_alive()]
+                if dead:
+                    for process in self.processes:
+                        process.terminate()
+                    raise RuntimeError(f"Replica {dead[0][0]} exited with code {dead[0][1]} while loading "
+                                       f"{modelPath}")
+                continue
+            versions.add(version)
+            loaded += 1
+        self.version = versions.pop()
+        self.dead = set()
+        self.closing = False
+
+        self.futures = {}
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.clips = [0] * replicas
+        self.jobs = [0] * replicas
+        self.busy = [0.0] * replicas
+        self.started = time.time()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def submit(self, inputs):
+        '''
+        Queue a batch for the next free replica.
+        Args:
+            inputs: uint8 clips [B,T,H,W,3] (or one [T,H,W,3] clip), or a float tensor / array [B,3,T,H,W].
+        Returns:
+            Future resolving to the numpy logits [B, num_classes].
+        '''
+        if hasattr(inputs, "detach"):
+            inputs = inputs.detach().cpu().numpy()
+        inputs = np.ascontiguousarray(inputs)
+        if inputs.dtype == np.uint8 and inputs.ndim == 4:
+            inputs = inputs[None]
+        future = Future()
+        with self.lock:
+            if self.dead and len(self.dead) == len(self.processes):
+                raise RuntimeError("Every inference replica exited")
+            job_id = next(self.job_ids)
+            # the inputs are kept until the result arrives, to queue the job again if its replica dies
+            self.futures[job_id] = (future, len(inputs), inputs)
+        self.task_queue.put((job_id, inputs))
+        return future
+
+    def __call__(self, inputs):
+        import torch
+        return torch.from_numpy(self.submit(inputs).result())
+
+    def eval(self):
+        # replicas are always in eval mode, kept so the pool can stand in for a model
+        return self
+
+    def _check_replicas(self):
+        # fail the job of every replica that died, and everything pending once no replica is left
+        failed = []
+        requeue = []
+        with self.lock:
+            died = False
+            for i, process in enumerate(self.processes):
+                if i in self.dead or process.is_alive():
+                    continue
+                self.dead.add(i)
+                died = True
+                print(f"Replica {i} exited with code {process.exitcode}")
+                job_id = self.current_jobs[i]
+                if job_id in self.futures:
+                    failed.append(self.futures.pop(job_id)[0])
+            if len(self.dead) == len(self.processes):
+                failed += [future for future, _, _ in self.futures.values()]
+                self.futures.clear()
+            elif died:
+                # a job taken by a replica that died before recording it is in no slot and no longer queued
+                running = {self.current_jobs[i] for i in range(len(self.processes)) if i not in self.dead}
+                requeue = [(job_id, inputs) for job_id, (_, _, inputs) in self.futures.items()
+                           if job_id not in running]
+        for job in requeue:
+            self.task_queue.put(job)
+        for future in failed:
+            future.set_exception(RuntimeError("Inference replica exited while running the job"))
+
+    def _collect(self):
+        while True:
+            try:
+                message = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not self.closing:
+                    self._check_replicas()
+                continue
+            if message is None:
+                break
+            job_id, replica_id, result, seconds = message
+            with self.lock:
+                entry = self.futures.pop(job_id, None)
+                if entry is None:
+                    # already failed by _check_replicas
+                    continue
+                future, size, _ = entry
+                self.jobs[replica_id] += 1
+                self.clips[replica_id] += size
+                self.busy[replica_id] += seconds
+            METRICS.inc("fight_pool_clips_total", size, replica=str(replica_id))
+            METRICS.observe("fight_pool_forward_seconds", seconds, replica=str(replica_id))
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        '''
+        Per replica: cores, jobs, clips, busy seconds and utilization (busy share of the pool lifetime).
+        '''
+        elapsed = max(time.time() - self.started, 1e-9)
+        with self.lock:
+            return [{"replica": i, "cores": self.cores[i], "jobs": self.jobs[i], "clips": self.clips[i],
+                     "busy_s": round(self.busy[i], 3), "utilization": round(self.busy[i] / elapsed, 3)}
+                    for i in range(len(self.processes))]
+
+    def close(self):
+        self.closing = True
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join()
+        self.result_queue.put(None)
+        self.collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
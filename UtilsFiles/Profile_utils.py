@@ -0,0 +1,98 @@
+import os
+import io
+import time
+import pstats
+import signal
+import shutil
+import socket
+import cProfile
+import subprocess
+from torch.profiler import profile, ProfilerActivity
+
+
+class WindowProfiler:
+    '''
+    Profiles the first windows of predict_on_video with torch.profiler and optionally a Python profile.
+    Pass profiler.step as the on_window callback of predict_on_video, it stops by itself after the
+    requested number of windows and writes into output_dir:
+        <host>_<pid>.pt.trace.json  Chrome trace, also picked up by the TensorBoard profiler plugin.
+        operators.txt               Top-N operators by self CPU time, by input shape and by call stack.
+        python.speedscope.json      Python sampling profile when py-spy is installed, or
+        python.prof / python.txt    a cProfile profile when it is not.
+    Args:
+        windows: Number of windows to profile.
+        output_dir: Folder of the profiling artifacts.
+        python_profile: Also capture a Python profile.
+        top_n: Number of operators in the summary tables.
+    '''
+
+    def __init__(self, windows, output_dir, python_profile=False, top_n=20):
+        self.windows = windows
+        self.output_dir = output_dir
+        self.python_profile = python_profile
+        self.top_n = top_n
+        self.count = 0
+        self.prof = None
+        self.py_spy = None
+        self.cprofile = None
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.python_profile:
+            self._start_python()
+        # cProfile and the torch stack tracer both install the Python profile hook, only one can own it.
+        self.prof = profile(activities=[ProfilerActivity.CPU], record_shapes=True, with_stack=self.cprofile is None)
+        self.prof.start()
+        self.start_time = time.time()
+
+    def _start_python(self):
+        py_spy = shutil.which("py-spy")
+        if py_spy:
+            # py-spy samples this process from the outside, so it does not slow the model down.
+            self.py_spy = subprocess.Popen([py_spy, "record", "--pid", str(os.getpid()), "--rate", "100",
+                                            "--format", "speedscope",
+                                            "-o", os.path.join(self.output_dir, "python.speedscope.json")])
+        else:
+            print("py-spy not found, falling back to cProfile for the Python profile")
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def step(self, *args):
+        # on_window callback of predict_on_video.
+        if self.prof is None:
+            return
+        self.count += 1
+        if self.count >= self.windows:
+            self.stop()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        self.prof.stop()
+        elapsed = time.time() - self.start_time
+        if self.py_spy is not None:
+            self.py_spy.send_signal(signal.SIGINT)
+            self.py_spy.wait()
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(os.path.join(self.output_dir, "python.prof"))
+            text = io.StringIO()
+            pstats.Stats(self.cprofile, stream=text).sort_stats("cumulative").print_stats(self.top_n)
+            with open(os.path.join(self.output_dir, "python.txt"), "w") as f:
+                f.write(text.getvalue())
+
+        trace_path = os.path.join(self.output_dir, f"{socket.gethostname()}_{os.getpid()}.pt.trace.json")
+        self.prof.export_chrome_trace(trace_path)
+
+        sort_by = "self_cpu_time_total"
+        summary = self.prof.key_averages().table(sort_by=sort_by, row_limit=self.top_n)
+        with open(os.path.join(self.output_dir, "operators.txt"), "w") as f:
+            f.write(f"Profiled {self.count} windows in {elapsed:.3f} s\n\n")
+            f.write(summary)
+            f.write("\n\nBy input shape\n")
+            f.write(self.prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=self.top_n))
+            f.write("\n\nBy call stack\n")
+            f.write(self.prof.key_averages(group_by_stack_n=5).table(sort_by=sort_by, row_limit=self.top_n))
+        print(summary)
+        print(f"Profile of {self.count} windows written to {self.output_dir}")
+        self.prof = None
@@ -0,0 +1,165 @@
+import copy
+import time
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset, DataLoader
+
+from UtilsFiles.Fight_utils import device, mc3_18_blocks, build_pruned_mc3_18, train_model
+
+
+def channel_importance(block):
+    '''
+    Importance of the inner channels of a residual block: |BN gamma| of conv1 times the L1 norm of the conv2
+    weights reading that channel, i.e. how much the channel can move the block output.
+    '''
+    gamma = block.conv1[1].weight.detach().abs()
+    reads = block.conv2[0].weight.detach().abs().sum(dim=(0, 2, 3, 4))
+    return gamma * reads
+
+
+def prune_mc3_18(model, sparsity):
+    '''
+    This function will remove the least important inner channels of every residual block of an mc3_18.
+    Only the conv1 outputs / conv2 inputs of a block are pruned, so the residual connections keep their shape.
+    Args:
+        model: A fine-tuned (possibly already pruned) mc3_18.
+        sparsity: Fraction of the inner channels removed from every block, e.g. 0.5.
+    Returns:
+        pruned: A new model with the kept weights copied over.
+        channels: Number of channels kept per block, for build_pruned_mc3_18 / loadModel.
+    '''
+    keeps = []
+    for block in mc3_18_blocks(model):
+        importance = channel_importance(block)
+        n_keep = max(1, int(round(len(importance) * (1 - sparsity))))
+        keeps.append(torch.argsort(importance, descending=True)[:n_keep].sort().values)
+    channels = [len(keep) for keep in keeps]
+
+    pruned = build_pruned_mc3_18(channels)
+    state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    for (name, _), keep in zip(block_names(model), keeps):
+        keep = keep.cpu()
+        state[f"{name}.conv1.0.weight"] = state[f"{name}.conv1.0.weight"][keep]
+        for param in ("weight", "bias", "running_mean", "running_var"):
+            state[f"{name}.conv1.1.{param}"] = state[f"{name}.conv1.1.{param}"][keep]
+        state[f"{name}.conv2.0.weight"] = state[f"{name}.conv2.0.weight"][:, keep]
+    pruned.load_state_dict(state)
+    return pruned.to(device).eval(), channels
+
+
+def block_names(model):
+    # (state_dict prefix, block) of every residual block, e.g. ("layer2.0", block)
+    return [(f"layer{l}.{i}", block) for l in range(1, 5)
+            for i, block in enumerate(getattr(model, f"layer{l}"))]
+
+
+def count_flops(model, SEQUENCE_LENGTH=16, size=112):
+    '''
+    Count the multiply-accumulates of one clip through the Conv3d and Linear layers, returned as FLOPs (2 x MACs).
+    '''
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.kernel_size[2]
+        macs.append(output.numel() * kernel * module.in_channels // module.groups)
+
+    def linear_hook(module, inputs, output):
+        macs.append(output.numel() * module.in_features)
+
+    handles = [m.register_forward_hook(conv_hook) for m in model.modules() if isinstance(m, nn.Conv3d)]
+    handles += [m.register_forward_hook(linear_hook) for m in model.modules() if isinstance(m, nn.Linear)]
+    with torch.no_grad():
+        model(torch.zeros(1, 3, SEQUENCE_LENGTH, size, size, device=device))
+    for handle in handles:
+        handle.remove()
+    return 2 * sum(macs)
+
+
+def cpu_latency(model, SEQUENCE_LENGTH=16, batch_size=1, runs=10, warmup=2):
+    '''
+    Mean seconds of one forward pass of a batch of clips on the CPU.
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    inputs = torch.randn(batch_size, 3, SEQUENCE_LENGTH, 112, 112)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(inputs)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(inputs)
+    return (time.perf_counter() - start) / runs
+
+
+def accuracy(model, features, labels, batch_size=8):
+    correct = 0
+    with torch.no_grad():
+        for start in range(0, len(labels), batch_size):
+            outputs = model(features[start:start + batch_size].to(device))
+            correct += (outputs.argmax(1).cpu() == labels[start:start + batch_size]).sum().item()
+    return correct / max(len(labels), 1)
+
+
+def split_dataset(features, labels, val_split=0.2, test_split=0.2, seed=0):
+    '''
+    Shuffle the dataset into train, val and test splits. train_model keeps the best epoch on val, so only test
+    is held out: report accuracies on test.
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    order = torch.randperm(len(labels), generator=generator)
+    n_val = max(1, int(len(labels) * val_split))
+    n_test = max(1, int(len(labels) * test_split))
+    train, val, test = order[n_val + n_test:], order[:n_val], order[n_val:n_val + n_test]
+    return (features[train], labels[train]), (features[val], labels[val]), (features[test], labels[test])
+
+
+def fine_tune(model, train, val, num_epochs=3, lr=1e-4, batch_size=4):
+    '''
+    Briefly fine-tune a pruned model with the existing train_model loop.
+    '''
+    dataloaders = {
+        'train': DataLoader(TensorDataset(*train), batch_size=batch_size, shuffle=True),
+        'val': DataLoader(TensorDataset(*val), batch_size=batch_size),
+    }
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9)
+    model, _ = train_model(device, model, dataloaders, criterion, optimizer, num_epochs=num_epochs)
+    return model.eval()
+
+
+def prune_report(model, features, labels, sparsities, SEQUENCE_LENGTH=16, num_epochs=3, save_prefix=None):
+    '''
+    This function will prune the model at every sparsity level, fine-tune it briefly and report its FLOPs,
+    parameter count, CPU latency and accuracy on the test split, which fine-tuning does not use to pick its best
+    epoch. The unpruned model is only held out from it if it was not fine-tuned on features.
+    Each pruned model is saved as <save_prefix>_<sparsity>.pth, an architecture-plus-weights checkpoint that
+    loadModel rebuilds.
+    Args:
+        model: The fine-tuned mc3_18.
+        features, labels: The dataset, as returned by create_dataset.
+        sparsities: Fractions of the block channels to remove, 0 reports the unpruned model.
+    Returns:
+        rows: One dict per sparsity level.
+    '''
+    train, val, test = split_dataset(features, labels)
+    rows = []
+    for sparsity in sparsities:
+        if sparsity > 0:
+            pruned, channels = prune_mc3_18(model, sparsity)
+            pruned = fine_tune(pruned, train, val, num_epochs)
+        else:
+            pruned, channels = model, [block.conv1[0].out_channels for block in mc3_18_blocks(model)]
+
+        path = ""
+        if save_prefix and sparsity > 0:
+            path = f"{save_prefix}_{sparsity:g}.pth"
+            torch.save({"arch": "mc3_18_pruned", "channels": channels, "state_dict": pruned.state_dict()}, path)
+        rows.append({
+            "sparsity": sparsity,
+            "params": sum(p.numel() for p in pruned.parameters()),
+            "gflops": count_flops(pruned, SEQUENCE_LENGTH) / 1e9,
+            "cpu_latency_ms": cpu_latency(pruned, SEQUENCE_LENGTH) * 1000,
+            "test_accuracy": accuracy(pruned, *test),
+            "path": path,
+        })
+        print(rows[-1])
+    return rows
@@ -0,0 +1,163 @@
+import os
+import cv2
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from UtilsFiles.Metrics_utils import METRICS
+
+
+class IncidentRecorder:
+    '''
+    Bounded in-memory ring of recent frames that turns an alert into a short video clip, pre_seconds before
+    and post_seconds after the alert, without re-opening or re-decoding the source.
+    Frames are kept JPEG encoded (~30-60 KB for a 640x480 frame instead of 900 KB raw). The encoding runs on a
+    small pool of encoder threads, not on the capture thread: push() only copies the frame, and drops it
+    (fight_recorder_dropped_frames_total) when more than max_pending frames wait for an encoder. With block,
+    for video files, push() waits for an encoder instead, so clips have every frame and play back at fps.
+    The ring and the clip being recorded share the max_mb budget: the ring drops its oldest frames, so the
+    pre-roll is the smaller of pre_seconds and what fits, and a clip kept growing by repeated alerts is written
+    out in parts (<alert time>_part<n>.mp4) of at most half the budget.
+    Clips are decoded and written by a background thread, so the caller never waits on the video encoder.
+    Args:
+        output_dir: Folder of the clips, <alert time>.mp4.
+        fps: Frame rate of the source, used for the pre/post-roll lengths and the clip.
+        pre_seconds, post_seconds: Seconds kept before and recorded after an alert.
+        max_mb: Memory bound of the ring and the clip being recorded for this camera.
+        jpeg_quality: Quality of the buffered frames, 0 keeps raw frames (more memory, no encode cost).
+        stream: Label of the camera in the metrics.
+        encoders: Encoder threads.
+        max_pending: Frames waiting for an encoder before push() drops (or waits, with block).
+        block: Wait for an encoder instead of dropping frames, for offline inputs that can be read more slowly.
+    '''
+
+    def __init__(self, output_dir, fps=25.0, pre_seconds=5.0, post_seconds=5.0, max_mb=64, jpeg_quality=85,
+                 stream="stream", encoders=2, max_pending=8, block=False):
+        self.output_dir = output_dir
+        self.block = block
+        self.stream = stream
+        os.makedirs(output_dir, exist_ok=True)
+        self.fps = fps or 25.0
+        self.pre_frames = max(1, int(round(pre_seconds * self.fps)))
+        self.post_frames = max(1, int(round(post_seconds * self.fps)))
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.jpeg_quality = jpeg_quality
+        self.ring = deque()
+        self.ring_bytes = 0
+        # The incident being recorded: [path, frames, frames still to record after the last alert, bytes, part].
+        self.active = None
+        self.lock = threading.Lock()
+        self.encoder = ThreadPoolExecutor(encoders, thread_name_prefix="recorder-encode")
+        self.pending = threading.BoundedSemaphore(max_pending)
+        # encoded frames (futures) and alerts, in the order they were pushed
+        self.ordered = queue.Queue()
+        self.assembler = threading.Thread(target=self._assemble, daemon=True)
+        self.assembler.start()
+        self.jobs = queue.Queue()
+        self.writer = threading.Thread(target=self._write_clips, daemon=True)
+        self.writer.start()
+
+    def _encode(self, frame):
+        try:
+            if self.jpeg_quality:
+                ok, packet = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                return packet
+            return frame
+        finally:
+            self.pending.release()
+
+    def push(self, frame):
+        '''
+        Add the next frame of the source (BGR, as read by OpenCV).
+        '''
+        if not self.pending.acquire(blocking=self.block):
+            # the encoders are behind, drop the frame rather than hold up the capture
+            METRICS.inc("fight_recorder_dropped_frames_total", stream=self.stream)
+            return
+        # the caller may draw on the frame afterwards
+        self.ordered.put(self.encoder.submit(self._encode, frame.copy()))
+
+    def trigger(self):
+        '''
+        Start a clip with the buffered pre-roll, or extend the post-roll of the clip being recorded.
+        Thread safe, can be called from the inference threads. The alert applies after the frames pushed so far.
+        '''
+        self.ordered.put(None)
+
+    def _assemble(self):
+        while True:
+            item = self.ordered.get()
+            if item is None:
+                self._start_or_extend()
+            elif item == "close":
+                break
+            else:
+                self._add(item.result())
+
+    def _start_or_extend(self):
+        with self.lock:
+            if self.active is None:
+                timestamp = datetime.now().strftime("%Y-%B-%d_%H-%M-%S.%f")
+                path = os.path.join(self.output_dir, f"{timestamp}.mp4")
+                packets = list(self.ring)
+                self.active = [path, packets, self.post_frames, sum(p.nbytes for p in packets), 1]
+            else:
+                self.active[2] = self.post_frames
+
+    def _add(self, packet):
+        with self.lock:
+            self.ring.append(packet)
+            self.ring_bytes += packet.nbytes
+            if self.active is not None:
+                self.active[1].append(packet)
+                self.active[2] -= 1
+                self.active[3] += packet.nbytes
+                if self.active[2] <= 0:
+                    self.jobs.put(self.active[:2])
+                    self.active = None
+                elif self.active[3] > self.max_bytes // 2 and len(self.active[1]) > 1:
+                    # write what is recorded so far and continue in a new part
+                    self.jobs.put(self.active[:2])
+                    path, _, remaining, _, part = self.active
+                    path = path.rsplit("_part", 1)[0].rsplit(".mp4", 1)[0] + f"_part{part + 1}.mp4"
+                    self.active = [path, [], remaining, 0, part + 1]
+            clip_bytes = self.active[3] if self.active is not None else 0
+            while len(self.ring) > self.pre_frames or (self.ring_bytes + clip_bytes > self.max_bytes
+                                                       and len(self.ring) > 1):
+                self.ring_bytes -= self.ring.popleft().nbytes
+        METRICS.set("fight_recorder_buffer_bytes", self.ring_bytes + clip_bytes, stream=self.stream)
+
+    def _write_clips(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            path, packets = job
+            if not packets:
+                continue
+            frames = (cv2.imdecode(p, cv2.IMREAD_COLOR) if self.jpeg_quality else p for p in packets)
+            first = next(frames)
+            height, width = first.shape[:2]
+            video_writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (width, height))
+            video_writer.write(first)
+            for frame in frames:
+                video_writer.write(frame)
+            video_writer.release()
+            METRICS.inc("fight_incident_clips_total", stream=self.stream)
+            print(f"Incident clip saved: {path} ({len(packets)/self.fps:.1f}s)")
+
+    def close(self):
+        '''
+        Write the clip being recorded with the post-roll it has, and wait for the pending clips.
+        '''
+        self.ordered.put("close")
+        self.assembler.join()
+        self.encoder.shutdown()
+        with self.lock:
+            if self.active is not None:
+                self.jobs.put(self.active[:2])
+                self.active = None
+        self.jobs.put(None)
+        self.writer.join()
@@ -0,0 +1,237 @@
+import io
+import os
+import json
+import time
+import queue
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Future
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from UtilsFiles.Metrics_utils import METRICS
+from UtilsFiles.Fight_utils import (frames_extraction_uint8, transform_uint8_, normalize_clips, PredBatchProbs,
+                                    topKFromProbs)
+
+
+class OverloadedError(Exception):
+    '''Raised by DynamicBatcher.submit when a new request could not be answered within the latency SLO.'''
+
+
+class DynamicBatcher:
+    '''
+    Collects single clips from many request threads into batches for one warm model.
+    A batch is run as soon as it holds max_batch clips or the oldest clip has waited max_wait_ms.
+    Args:
+        model: The loaded model.
+        max_batch: Largest number of clips in one forward pass.
+        max_wait_ms: Longest time the first clip of a batch waits for more clips.
+        slo_ms: Latency target. Requests that would queue for longer are rejected with OverloadedError.
+    '''
+
+    def __init__(self, model, max_batch=8, max_wait_ms=10, slo_ms=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.slo = slo_ms / 1000.0 if slo_ms else None
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=1000)
+        self.batch_seconds = None
+        self.stats = {"requests": 0, "rejected": 0, "batches": 0, "clips": 0, "slo_violations": 0}
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def estimated_wait(self):
+        # Batches ahead of a new request times the moving average of the batch time.
+        if self.batch_seconds is None:
+            return 0.0
+        return (self.queue.qsize() // self.max_batch + 1) * self.batch_seconds + self.max_wait
+
+    def submit(self, clip):
+        '''
+        Queue one uint8 clip of shape [num_frames, 112, 112, 3] and return a Future of its class probabilities.
+        '''
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.slo is not None and self.estimated_wait() > self.slo:
+                self.stats["rejected"] += 1
+                raise OverloadedError(f"estimated wait {self.estimated_wait()*1000:.1f} ms is over the SLO")
+        future = Future()
+        self.queue.put((clip, future, time.time()))
+        METRICS.set("fight_queue_depth", self.queue.qsize(), stream="server")
+        return future
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            METRICS.set("fight_queue_depth", self.queue.qsize(), stream="server")
+            start = time.time()
+            # Clips with a different number of frames can not be stacked, run one forward per shape.
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[0].shape, []).append(item)
+            for items in groups.values():
+                try:
+                    with METRICS.timer("fight_forward_seconds", stream="server"):
+                        probs = PredBatchProbs(normalize_clips(np.stack([clip for clip, _, _ in items])), self.model)
+                except Exception as e:
+                    for _, future, _ in items:
+                        future.set_exception(e)
+                    continue
+                for (_, future, _), row in zip(items, probs):
+                    future.set_result(row)
+            end = time.time()
+            METRICS.inc("fight_windows_total", len(batch), stream="server")
+
+            with self.lock:
+                elapsed = end - start
+                self.batch_seconds = elapsed if self.batch_seconds is None else 0.9 * self.batch_seconds + 0.1 * elapsed
+                self.stats["batches"] += 1
+                self.stats["clips"] += len(batch)
+                for _, _, queued in batch:
+                    latency = end - queued
+                    self.latencies.append(latency)
+                    if self.slo is not None and latency > self.slo:
+                        self.stats["slo_violations"] += 1
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            result = dict(self.stats)
+        result["queue_depth"] = self.queue.qsize()
+        result["mean_batch_size"] = result["clips"] / result["batches"] if result["batches"] else 0.0
+        for q in (50, 90, 99):
+            result[f"latency_p{q}_ms"] = float(np.percentile(latencies, q)) if len(latencies) else 0.0
+        return result
+
+
+def decode_clip(body, content_type, SEQUENCE_LENGTH):
+    '''
+    Turn a request body into a uint8 clip.
+    A JSON body {"videoPath": ..., "startFrame": ..., "endFrame": ..., "sequenceLength": ...} samples a segment of a
+    video on this box, any other body is read as a .npy array of shape [num_frames, height, width, 3] in RGB order.
+    '''
+    if content_type.startswith("application/json"):
+        request = json.loads(body)
+        end_frame = request.get("endFrame")
+        clip = frames_extraction_uint8(request["videoPath"], int(request.get("sequenceLength", SEQUENCE_LENGTH)),
+                                       int(request.get("startFrame", 0)),
+                                       int(end_frame) if end_frame is not None else None)
+        if len(clip) == 0:
+            raise ValueError(f"could not read frames from {request['videoPath']}")
+        return clip
+
+    clip = np.load(io.BytesIO(body), allow_pickle=False)
+    if clip.ndim != 4 or clip.shape[-1] != 3:
+        raise ValueError(f"expected a clip of shape [num_frames, height, width, 3], got {clip.shape}")
+    if clip.shape[1:3] != (112, 112):
+        transform = transform_uint8_()
+        clip = np.stack([transform(image=frame)['image'] for frame in clip.astype(np.uint8)])
+    return clip.astype(np.uint8)
+
+
+def make_handler(batcher, SEQUENCE_LENGTH, k=2):
+    '''
+    Build the request handler class bound to one DynamicBatcher.
+    POST /predict returns {"prediction": [[class_name, prob], ...], "latency_ms": ...}, GET /metrics returns the
+    batcher metrics and GET /health returns {"status": "ok"}.
+    '''
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+
+        def address_string(self):
+            # Unix socket clients have no (host, port) address.
+            return str(self.client_address[0]) if self.client_address else "unix"
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send_json(200, batcher.metrics())
+            elif self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            start = time.time()
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                clip = decode_clip(body, self.headers.get("Content-Type", ""), SEQUENCE_LENGTH)
+                probs = batcher.submit(clip).result()
+            except OverloadedError as e:
+                self._send_json(503, {"error": str(e)})
+                return
+            except (ValueError, TypeError, KeyError, OSError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                # e.g. a model error raised by the batcher, answer instead of dropping the connection
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+            self._send_json(200, {"prediction": topKFromProbs(k, probs),
+                                  "latency_ms": round((time.time() - start) * 1000, 3)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceHandler
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def start_server(model, host="127.0.0.1", port=8000, unix_socket=None, SEQUENCE_LENGTH=16, max_batch=8,
+                 max_wait_ms=10, slo_ms=None):
+    '''
+    This function will serve the model over HTTP, or HTTP over a Unix socket, until interrupted.
+    Args:
+        model: The loaded model, kept warm for every request.
+        host, port: TCP address to listen on, ignored when unix_socket is given.
+        unix_socket: Path of a Unix socket to listen on instead of TCP.
+        SEQUENCE_LENGTH: Default number of frames sampled for video segment requests.
+        max_batch, max_wait_ms, slo_ms: Passed to DynamicBatcher.
+    '''
+    batcher = DynamicBatcher(model, max_batch, max_wait_ms, slo_ms)
+    handler = make_handler(batcher, SEQUENCE_LENGTH)
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, handler)
+        print(f"Serving on unix socket {unix_socket}")
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -0,0 +1,205 @@
+import cv2
+import time
+import queue
+import torch
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from UtilsFiles.Fight_utils import (loadModel, transform_uint8_, normalize_clips, PredBatchProbs,
+                                    topKFromProbs)
+
+# Slot states inside a ClipRing.
+SLOT_FREE = 0
+SLOT_READY = 1
+
+
+class ClipRing:
+    '''
+    A ring of preprocessed uint8 clips living in one multiprocessing.shared_memory block.
+    One decoder process writes clips into free slots and one inference process reads them in place,
+    so only the (stream_id, slot) pair goes through the control queue instead of the pickled frames.
+    Args:
+        slots: Number of clips the ring can hold.
+        SEQUENCE_LENGTH: Number of frames in one clip.
+        name: Name of an existing block to attach to. Leave as None to create a new block.
+        size: Height and width of the preprocessed frames.
+    '''
+
+    def __init__(self, slots, SEQUENCE_LENGTH, name=None, size=112):
+        self.shape = (slots, SEQUENCE_LENGTH, size, size, 3)
+        clip_bytes = int(np.prod(self.shape))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=clip_bytes + slots)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.clips = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.state = np.ndarray((slots,), dtype=np.uint8, buffer=self.shm.buf, offset=clip_bytes)
+        if name is None:
+            self.state[:] = SLOT_FREE
+
+    def free_slot(self):
+        # Return the index of a free slot or None when the reader is behind.
+        free = np.flatnonzero(self.state == SLOT_FREE)
+        return int(free[0]) if len(free) else None
+
+    def close(self, unlink=False):
+        # Drop the numpy views before closing, otherwise the buffer is still exported.
+        del self.clips, self.state
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def decoder_process(stream_id, streamingPath, ring_name, slots, SEQUENCE_LENGTH, skip, control_queue, stop_event):
+    '''
+    This function runs in its own process. It decodes one stream, resizes and crops every skip-th frame
+    straight into a free slot of the shared ring and announces the filled slot on the control queue.
+    Args:
+        stream_id: Index of the stream, sent back with every result.
+        streamingPath: Video file path or stream URL.
+        ring_name: Name of the ClipRing shared memory block created by the parent.
+        control_queue: Queue receiving (stream_id, slot, frame_index, dropped) messages.
+        stop_event: Event set by the parent to stop the decoder.
+    '''
+    ring = ClipRing(slots, SEQUENCE_LENGTH, name=ring_name)
+    transform = transform_uint8_()
+    video_reader = cv2.VideoCapture(streamingPath)
+    counter = 0
+    dropped = 0
+    slot = None
+    position = 0
+    while not stop_event.is_set():
+        ok, frame = video_reader.read()
+        if not ok:
+            break
+        if counter % skip == 0:
+            if slot is None:
+                slot = ring.free_slot()
+                if slot is None:
+                    # The inference process is behind, drop this frame rather than stall the camera.
+                    dropped += 1
+                    counter += 1
+                    continue
+                position = 0
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            ring.clips[slot, position] = transform(image=frame)['image']
+            position += 1
+            if position == SEQUENCE_LENGTH:
+                ring.state[slot] = SLOT_READY
+                control_queue.put((stream_id, slot, counter, dropped))
+                slot = None
+        counter += 1
+    video_reader.release()
+    # Tell the inference process this stream is finished.
+    control_queue.put((stream_id, None, counter, dropped))
+    ring.close()
+
+
+def inference_process(modelPath, ring_names, slots, SEQUENCE_LENGTH, control_queue, result_queue, max_batch=8):
+    '''
+    This function runs in its own process. It owns the only copy of the model, collects ready slots from
+    all rings into one batch, reads them zero-copy with torch.from_numpy and sends the top-k results back.
+    Args:
+        ring_names: Shared memory names of the rings, indexed by stream_id.
+        result_queue: Queue receiving (stream_id, frame_index, [(class_name, prob), ...]) messages.
+        max_batch: Largest number of clips run in one forward pass.
+    '''
+    model = loadModel(modelPath)
+    rings = [ClipRing(slots, SEQUENCE_LENGTH, name=name) for name in ring_names]
+    running = len(rings)
+    while running:
+        messages = [control_queue.get()]
+        while len(messages) < max_batch:
+            try:
+                messages.append(control_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        batch = [message[:3] for message in messages if message[1] is not None]
+        finished = [message for message in messages if message[1] is None]
+
+        if batch:
+            # torch.from_numpy shares memory with the ring, the only copy is the stack into the batch.
+            clips = torch.stack([torch.from_numpy(rings[stream_id].clips[slot]) for stream_id, slot, _ in batch])
+            for stream_id, slot, _ in batch:
+                rings[stream_id].state[slot] = SLOT_FREE
+            probs = PredBatchProbs(normalize_clips(clips), model)
+            for (stream_id, slot, frame_index), row in zip(batch, probs):
+                result_queue.put((stream_id, frame_index, topKFromProbs(2, row)))
+
+        # Report finished streams after their last results.
+        for stream_id, _, _, dropped in finished:
+            running -= 1
+            result_queue.put((stream_id, None, dropped))
+    for ring in rings:
+        ring.close()
+    result_queue.put(None)
+
+
+def start_multiprocess_streaming(modelPath, streamingPaths, SEQUENCE_LENGTH=16, skip=2, slots=4, max_batch=8,
+                                 on_result=None):
+    '''
+    This function will run one decoder process per stream and a single inference process that reads the
+    clips from shared memory, so the number of cameras scales across cores without pickling frames.
+    Args:
+        modelPath: Path of the fine-tuned model weights.
+        streamingPaths: List of video file paths or stream URLs.
+        slots: Number of clips buffered per stream before the decoder starts dropping frames.
+        on_result: Optional callback(stream_id, frame_index, topk) called in the parent for every result.
+    '''
+    ctx = mp.get_context("spawn")
+    control_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    stop_event = ctx.Event()
+    rings = [ClipRing(slots, SEQUENCE_LENGTH) for _ in streamingPaths]
+
+    inference = ctx.Process(target=inference_process,
+                            args=(modelPath, [ring.name for ring in rings], slots, SEQUENCE_LENGTH,
+                                  control_queue, result_queue, max_batch))
+    inference.start()
+    decoders = [ctx.Process(target=decoder_process,
+                            args=(stream_id, path, rings[stream_id].name, slots, SEQUENCE_LENGTH, skip,
+                                  control_queue, stop_event))
+                for stream_id, path in enumerate(streamingPaths)]
+    for decoder in decoders:
+        decoder.start()
+
+    start = time.time()
+    failed = None
+    try:
+        while True:
+            try:
+                message = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                # a crashed inference process (e.g. a bad model path) never sends the final None
+                if not inference.is_alive():
+                    failed = inference.exitcode
+                    break
+                continue
+            if message is None:
+                break
+            stream_id, frame_index, topk = message
+            if frame_index is None:
+                print(f"Stream {stream_id} finished, dropped frames: {topk}")
+                continue
+            if on_result is not None:
+                on_result(stream_id, frame_index, topk)
+            else:
+                print(stream_id, frame_index, topk)
+    except KeyboardInterrupt:
+        stop_event.set()
+    finally:
+        if failed is not None:
+            stop_event.set()
+        for decoder in decoders:
+            decoder.join(timeout=10)
+            if decoder.is_alive():
+                decoder.terminate()
+        inference.join()
+        for ring in rings:
+            ring.close(unlink=True)
+    if failed is not None:
+        raise RuntimeError(f"Inference process exited with code {failed}")
+    print(f"Time taken: {time.time()-start}")
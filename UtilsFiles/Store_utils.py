@@ -0,0 +1,283 @@
+import os
+import re
+import json
+import shutil
+import time
+import threading
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+
+from UtilsFiles.Fight_utils import CLASSES_LIST
+
+
+def camera_folder(camera):
+    # file system safe folder name of a camera (stream URLs contain / and :)
+    return re.sub(r'[^A-Za-z0-9._-]', '_', str(camera))
+
+
+def day_folder(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+class WindowStore:
+    '''
+    Columnar store of the class probabilities of every scored window, for re-thresholding and audits
+    without re-running the model.
+    On disk, in root:
+        <camera>/<YYYY-MM-DD>/<segment>/   one folder per day and camera (UTC), the time index of the store
+            start.f8, end.f8               window start and end, epoch seconds, float64, sorted by start
+            probs.f2                       [rows, len(CLASSES_LIST)] float16 probabilities
+            meta.json                      camera, model version, rows, time range and the max probability
+                                           of every class, so queries skip segments without reading them
+    Segments are immutable: rows are buffered per camera, day and model version and written as a new segment
+    (to a hidden folder renamed into place) every segment_rows rows, every flush_seconds, or on flush()/close().
+    Several processes can write the same store, every segment has its own name.
+    The small segments of a day are compacted into one segment per day and model version once the day has more
+    than compact_segments segments and when the camera's next day starts (see compact()), so a query opens
+    a few segments per camera-day whatever flush_seconds is.
+    Args:
+        root: Folder of the store, created if needed.
+        segment_rows: Rows buffered before a segment is written.
+        flush_seconds: Longest time rows stay buffered, bounds what a crash loses.
+        compact_segments: Segments of a day before they are compacted, 0 to compact a day only when the next one
+            starts or with compact().
+    '''
+
+    def __init__(self, root, segment_rows=65536, flush_seconds=60.0, compact_segments=32):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.segment_rows = segment_rows
+        self.flush_seconds = flush_seconds
+        self.compact_segments = compact_segments
+        self.buffers = {}
+        self.last_flush = time.time()
+        self.written = 0
+        self.lock = threading.Lock()
+        # meta.json of the segments already read by queries, segments never change
+        self.metas = {}
+        # last day folder written per camera folder, a closed day is compacted when the next one starts
+        self.open_days = {}
+
+    def append(self, camera, start, end, probs, model_version):
+        '''
+        Add one window: camera name, start and end (epoch seconds), class probabilities and model version.
+        '''
+        key = (str(camera), day_folder(start), model_version)
+        with self.lock:
+            buffer = self.buffers.setdefault(key, ([], [], []))
+            buffer[0].append(start)
+            buffer[1].append(end)
+            buffer[2].append(np.asarray(probs, dtype=np.float32))
+            if len(buffer[0]) >= self.segment_rows:
+                self._write(key, self.buffers.pop(key))
+            elif time.time() - self.last_flush > self.flush_seconds:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def _flush(self):
+        for key in list(self.buffers):
+            self._write(key, self.buffers.pop(key))
+        self.last_flush = time.time()
+
+    def _write(self, key, buffer):
+        camera, day, model_version = key
+        starts = np.array(buffer[0], dtype=np.float64)
+        order = np.argsort(starts, kind="stable")
+        folder = os.path.join(self.root, camera_folder(camera), day)
+        os.makedirs(folder, exist_ok=True)
+        self._write_segment(folder, camera, model_version, starts[order],
+                            np.array(buffer[1], dtype=np.float64)[order], np.stack(buffer[2])[order])
+
+        # with the default flush a live camera writes a small segment every minute, fold them into one
+        # segment per day so queries open a few segments per day instead of thousands
+        camera_path = os.path.dirname(folder)
+        previous = self.open_days.get(camera_path)
+        if previous is not None and previous < day:
+            self._compact_day(os.path.join(camera_path, previous))
+        if previous is None or previous < day:
+            self.open_days[camera_path] = day
+        if self.compact_segments and len(self._names(folder)) > self.compact_segments:
+            self._compact_day(folder)
+
+    def _write_segment(self, folder, camera, model_version, starts, ends, probs, prefix="", replaces=None):
+        probs = probs.astype(np.float16)
+        name = f"{prefix}{int(starts[0] * 1000)}-{os.getpid()}-{self.written}"
+        self.written += 1
+        tmp_path = os.path.join(folder, "." + name)
+        os.makedirs(tmp_path)
+        starts.tofile(os.path.join(tmp_path, "start.f8"))
+        ends.tofile(os.path.join(tmp_path, "end.f8"))
+        probs.tofile(os.path.join(tmp_path, "probs.f2"))
+        meta = {"camera": camera, "model": model_version, "rows": len(starts), "start": float(starts[0]),
+                "end": float(ends.max()), "classes": CLASSES_LIST,
+                "max_probs": probs.astype(np.float32).max(axis=0).tolist()}
+        if replaces:
+            meta["replaces"] = replaces
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        # the segment appears complete or not at all
+        os.rename(tmp_path, os.path.join(folder, name))
+
+    def compact(self, camera=None):
+        '''
+        Merge the segments of every day folder (of one camera or all cameras) into one segment per day and
+        model version. Writers compact a day once it has more than compact_segments segments and when the
+        next day starts, this catches up stores written by older versions or processes that were killed.
+        Returns:
+            Number of day folders compacted.
+        '''
+        compacted = 0
+        with self.lock:
+            for day_path in self._days(camera, None, None):
+                if len(self._names(day_path)) > 1:
+                    compacted += self._compact_day(day_path)
+        return compacted
+
+    def _compact_day(self, day_path):
+        '''
+        Merge the live segments of one day folder into one segment per model version. The merged segment lists
+        the segments it replaces in its meta.json, so readers skip either the merged segment's sources or
+        nothing, and the sources are deleted after it is in place. One process compacts a day at a time.
+        '''
+        lock_path = os.path.join(day_path, ".compact.lock")
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # left over by a compaction that was killed
+            if time.time() - os.path.getmtime(lock_path) < 600:
+                return 0
+            os.remove(lock_path)
+            return self._compact_day(day_path)
+        try:
+            names = self._names(day_path)
+            metas = {name: self._meta(os.path.join(day_path, name)) for name in names}
+            replaced = {old for meta in metas.values() for old in meta.get("replaces", [])}
+            # sources of an earlier merge killed before it deleted them
+            self._remove(day_path, [name for name in names if name in replaced])
+            by_model = {}
+            for name in names:
+                if name not in replaced:
+                    by_model.setdefault(metas[name]["model"], []).append(name)
+            merged = []
+            for model_version, sources in by_model.items():
+                if len(sources) < 2:
+                    continue
+                paths = [os.path.join(day_path, name) for name in sources]
+                starts = np.concatenate([np.fromfile(os.path.join(p, "start.f8"), dtype=np.float64) for p in paths])
+                ends = np.concatenate([np.fromfile(os.path.join(p, "end.f8"), dtype=np.float64) for p in paths])
+                probs = np.concatenate([np.fromfile(os.path.join(p, "probs.f2"), dtype=np.float16).reshape(
+                    metas[name]["rows"], len(metas[name]["classes"])) for p, name in zip(paths, sources)])
+                order = np.argsort(starts, kind="stable")
+                self._write_segment(day_path, metas[sources[0]]["camera"], model_version, starts[order],
+                                    ends[order], probs[order], prefix="c", replaces=sources)
+                merged += sources
+            self._remove(day_path, merged)
+            return 1 if merged else 0
+        finally:
+            os.remove(lock_path)
+
+    def _remove(self, day_path, names):
+        for name in names:
+            path = os.path.join(day_path, name)
+            self.metas.pop(path, None)
+            shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def _names(day_path):
+        return sorted(name for name in os.listdir(day_path) if not name.startswith("."))
+
+    def _days(self, camera, start, end):
+        cameras = [camera_folder(camera)] if camera is not None else sorted(os.listdir(self.root))
+        # a window is filed under the day it starts, one starting just before start can still overlap it
+        first_day = day_folder(start - 3600) if start is not None else None
+        last_day = day_folder(end) if end is not None else None
+        for camera_dir in cameras:
+            camera_path = os.path.join(self.root, camera_dir)
+            if not os.path.isdir(camera_path):
+                continue
+            for day in sorted(os.listdir(camera_path)):
+                if (first_day and day < first_day) or (last_day and day > last_day):
+                    continue
+                yield os.path.join(camera_path, day)
+
+    def _segments(self, day_path):
+        # segments merged into a compacted segment are skipped until the compaction deletes them
+        names = self._names(day_path)
+        metas = {name: self._meta(os.path.join(day_path, name)) for name in names}
+        replaced = {old for meta in metas.values() for old in meta.get("replaces", [])}
+        return [(os.path.join(day_path, name), metas[name]) for name in names if name not in replaced]
+
+    def _meta(self, path):
+        meta = self.metas.get(path)
+        if meta is None:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = self.metas[path] = json.load(f)
+        return meta
+
+    def query(self, camera=None, start=None, end=None, class_name='fight', min_prob=None, model_version=None):
+        '''
+        This function will return the windows of a camera (or all cameras) overlapping [start, end] whose
+        class_name probability is >= min_prob, e.g. all windows with p(fight) > 0.7 on one camera last week.
+        Day folders outside the range and segments whose time range or max probability cannot match are
+        skipped without reading their columns, the columns of the others are memory-mapped.
+        Args:
+            camera: Camera name as given to append(), None for every camera.
+            start, end: Epoch seconds or datetime, None for no bound.
+            class_name, min_prob: Probability filter, None keeps every window.
+            model_version: Only windows scored by this model version.
+        Returns:
+            DataFrame with camera, start, end, model and one p_<class> column per class, sorted by start.
+        '''
+        start = start.timestamp() if isinstance(start, datetime) else start
+        end = end.timestamp() if isinstance(end, datetime) else end
+        class_index = CLASSES_LIST.index(class_name)
+        parts = []
+        for day_path in self._days(camera, start, end):
+            for attempt in range(3):
+                try:
+                    day_parts = [self._read(path, meta, start, end, class_index, min_prob, model_version)
+                                 for path, meta in self._segments(day_path)]
+                    break
+                except FileNotFoundError:
+                    # a compaction replaced segments of this day while they were read, list it again
+                    if attempt == 2:
+                        raise
+            parts += [part for part in day_parts if part is not None]
+        if not parts:
+            return pd.DataFrame(columns=["camera", "start", "end", "model"] + [f"p_{c}" for c in CLASSES_LIST])
+        return pd.concat(parts, ignore_index=True).sort_values("start", kind="stable").reset_index(drop=True)
+
+    @staticmethod
+    def _read(path, meta, start, end, class_index, min_prob, model_version):
+        if (start is not None and meta["end"] < start) or (end is not None and meta["start"] > end):
+            return None
+        if min_prob is not None and meta["max_probs"][class_index] < min_prob:
+            return None
+        if model_version is not None and meta["model"] != model_version:
+            return None
+        rows = meta["rows"]
+        starts = np.memmap(os.path.join(path, "start.f8"), dtype=np.float64, mode="r", shape=(rows,))
+        # starts are sorted, the end bound is a binary search
+        last = np.searchsorted(starts, end, side="right") if end is not None else rows
+        ends = np.memmap(os.path.join(path, "end.f8"), dtype=np.float64, mode="r", shape=(rows,))[:last]
+        probs = np.memmap(os.path.join(path, "probs.f2"), dtype=np.float16, mode="r",
+                          shape=(rows, len(meta["classes"])))[:last]
+        mask = np.ones(last, dtype=bool)
+        if start is not None:
+            mask &= ends >= start
+        if min_prob is not None:
+            mask &= probs[:, class_index] >= min_prob
+        if not mask.any():
+            return None
+        part = {"camera": meta["camera"], "start": np.asarray(starts[:last][mask]),
+                "end": np.asarray(ends[mask]), "model": meta["model"]}
+        for i, name in enumerate(meta["classes"]):
+            part[f"p_{name}"] = probs[mask, i].astype(np.float32)
+        return pd.DataFrame(part)
@@ -0,0 +1,354 @@
+import cv2
+import time
+import queue
+import random
+import asyncio
+import threading
+from collections import deque
+
+from UtilsFiles.Metrics_utils import METRICS
+from UtilsFiles.Fight_utils import StreamPipeline, frame_time_ms, model_version, stream_name
+
+
+class StreamHealth:
+    '''
+    Connection and health state of one supervised stream, updated by the supervisor.
+    state is one of connecting, running, degraded (FPS below min_fps_ratio of the nominal FPS), stalled
+    (no frame for stall_seconds), reconnecting (waiting for the backoff) and stopped.
+    '''
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.state = "connecting"
+        self.nominal_fps = 0.0
+        self.frames = 0
+        self.connections = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.stalls = 0
+        self.fps_drops = 0
+        self.last_frame = None
+        self.connected_at = None
+        self.last_error = None
+        # arrival time of the frames of the last fps_window seconds
+        self.arrivals = deque()
+        # timestamps keep increasing across reconnects (a file restarts at 0)
+        self.time_offset_ms = 0.0
+        self.last_pts_ms = 0.0
+
+    def fps(self, now, fps_window):
+        while self.arrivals and self.arrivals[0] < now - fps_window:
+            self.arrivals.popleft()
+        if self.connected_at is None:
+            return 0.0
+        return len(self.arrivals) / max(1e-6, min(fps_window, now - self.connected_at))
+
+    def as_dict(self, now=None, fps_window=5.0):
+        now = now or time.time()
+        return {"stream": self.name, "source": stream_name(self.source), "state": self.state,
+                "fps": round(self.fps(now, fps_window), 2), "nominal_fps": round(self.nominal_fps, 2),
+                "frames": self.frames, "reconnects": self.reconnects, "stalls": self.stalls,
+                "fps_drops": self.fps_drops,
+                "last_frame_age": round(now - self.last_frame, 2) if self.last_frame else None,
+                "last_error": self.last_error}
+
+
+class StreamReader:
+    '''
+    Daemon thread running the blocking calls of one stream connection (open, read, release) in order, each
+    resolving an asyncio future on the loop through call_soon_threadsafe.
+    A daemon thread never keeps the process alive, so a read hanging on a dead camera is abandoned with its
+    reader: the release queued after it runs if the read ever returns, and the thread then exits.
+    '''
+
+    def __init__(self, loop, name):
+        self.loop = loop
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"stream-{name}", daemon=True)
+        self.thread.start()
+
+    def call(self, func, *args):
+        future = self.loop.create_future()
+        self.jobs.put((future, func, args))
+        return future
+
+    def close(self):
+        self.jobs.put(None)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, func, args = job
+            try:
+                result, error = func(*args), None
+            except Exception as e:
+                result, error = None, e
+            try:
+                self.loop.call_soon_threadsafe(self._resolve, future, result, error)
+            except RuntimeError:
+                # the loop is closed, nobody waits for this call any more
+                pass
+
+    @staticmethod
+    def _resolve(future, result, error):
+        # a future given up by asyncio.wait_for is already cancelled
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+class StreamSupervisor:
+    '''
+    Keep many stream sources (RTSP URLs, cameras, or local video files standing in for them) read with
+    one asyncio event loop.
+    Every stream gets a StreamReader daemon thread for its blocking open and read calls, so a hung camera
+    never blocks the loop, the other streams or the exit of the process. Each frame is passed to
+    on_frame(name, frame, pts_ms) on that thread, so preprocessing stays off the loop too.
+    A failed open, a failed read (an empty frame from a dropped connection, or the end of a file) or a read
+    hanging for stall_seconds closes the capture and reconnects after an exponential backoff with jitter:
+    backoff_base * 2^failures, capped at backoff_max, reset once frames arrive again. A hung read's
+    reader is abandoned and releases its capture if the read returns.
+    A health check every check_seconds marks streams stalled or degraded (measured FPS over fps_window below
+    min_fps_ratio of the nominal FPS), and every status_seconds the status of all streams is printed.
+    The status is also exported through METRICS: fight_stream_up, fight_stream_fps, fight_stream_reconnects_total,
+    fight_stream_stalls_total and fight_stream_fps_drops_total.
+    Args:
+        sources: Dict of stream name to source, or a list of sources named by stream_name().
+        on_frame: Called with (name, frame, pts_ms) for every frame read.
+        realtime: Pace reads at the nominal FPS, to make local files behave like live cameras.
+        max_failures: Stop a stream after this many failed connections in a row, None retries forever.
+        nominal_fps: Expected FPS, defaults to the FPS reported by each source.
+    '''
+
+    def __init__(self, sources, on_frame=None, stall_seconds=10.0, min_fps_ratio=0.5, fps_window=5.0,
+                 backoff_base=1.0, backoff_max=60.0, check_seconds=1.0, status_seconds=10.0, realtime=False,
+                 max_failures=None, nominal_fps=None):
+        if not isinstance(sources, dict):
+            sources = {stream_name(source): source for source in sources}
+        self.streams = {name: StreamHealth(name, source) for name, source in sources.items()}
+        self.on_frame = on_frame
+        self.stall_seconds = stall_seconds
+        self.min_fps_ratio = min_fps_ratio
+        self.fps_window = fps_window
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.check_seconds = check_seconds
+        self.status_seconds = status_seconds
+        self.realtime = realtime
+        self.max_failures = max_failures
+        self.fixed_fps = nominal_fps
+        self.loop = None
+        self.stop_event = None
+
+    def backoff(self, failures):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** max(0, failures - 1))
+        # jitter so cameras behind one dropped switch do not all reconnect at once
+        return delay * random.uniform(0.8, 1.2)
+
+    def _open(self, source):
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            capture.release()
+            raise ConnectionError(f"cannot open {stream_name(source)}")
+        return capture, capture.get(cv2.CAP_PROP_FPS)
+
+    def _read(self, health, capture, counter, fps):
+        ok, frame = capture.read()
+        if not ok or frame is None:
+            return False
+        pts_ms = health.time_offset_ms + frame_time_ms(capture, counter, fps)
+        health.last_pts_ms = pts_ms
+        if self.on_frame is not None:
+            self.on_frame(health.name, frame, pts_ms)
+        return True
+
+    async def _sleep(self, seconds):
+        # sleep unless the supervisor is stopped first
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run_stream(self, health):
+        loop = asyncio.get_running_loop()
+        while not self.stop_event.is_set():
+            reader = StreamReader(loop, health.name)
+            capture = None
+            hung = False
+            try:
+                health.state = "connecting"
+                capture, fps = await asyncio.wait_for(reader.call(self._open, health.source), self.stall_seconds)
+                health.nominal_fps = self.fixed_fps or fps or 25.0
+                health.connections += 1
+                health.connected_at = time.time()
+                health.arrivals.clear()
+                METRICS.set("fight_stream_up", 1, stream=health.name)
+                counter = 0
+                next_time = time.monotonic()
+                while not self.stop_event.is_set():
+                    ok = await asyncio.wait_for(reader.call(self._read, health, capture, counter, fps),
+                                                self.stall_seconds)
+                    if not ok:
+                        raise ConnectionError("read failed")
+                    counter += 1
+                    now = time.time()
+                    health.frames += 1
+                    health.last_frame = now
+                    health.arrivals.append(now)
+                    health.failures = 0
+                    if health.state in ("connecting", "stalled"):
+                        health.state = "running"
+                    METRICS.inc("fight_frames_total", stream=health.name)
+                    if self.realtime:
+                        next_time += 1.0 / health.nominal_fps
+                        delay = next_time - time.monotonic()
+                        if delay > 0:
+                            await self._sleep(delay)
+                        else:
+                            next_time = time.monotonic()
+            except asyncio.TimeoutError:
+                hung = True
+                health.stalls += 1
+                health.state = "stalled"
+                health.last_error = f"no frame for {self.stall_seconds}s"
+                METRICS.inc("fight_stream_stalls_total", stream=health.name)
+            except Exception as error:
+                health.last_error = str(error)
+            finally:
+                if capture is not None:
+                    # queued after the read, so a hung read releases its capture if it ever returns
+                    released = reader.call(capture.release)
+                    if not hung:
+                        await released
+                reader.close()
+            METRICS.set("fight_stream_up", 0, stream=health.name)
+            if self.stop_event.is_set():
+                break
+            # the next connection continues the timestamps of this one
+            health.time_offset_ms = health.last_pts_ms + 1000.0 / (health.nominal_fps or 25.0)
+            health.failures += 1
+            if self.max_failures is not None and health.failures > self.max_failures:
+                break
+            health.state = "reconnecting"
+            delay = self.backoff(health.failures)
+            print(f"{health.name}: {health.last_error}, reconnecting in {delay:.1f}s")
+            await self._sleep(delay)
+            health.reconnects += 1
+            METRICS.inc("fight_stream_reconnects_total", stream=health.name)
+        health.state = "stopped"
+
+    def check(self, now=None):
+        '''
+        Update the health state of every stream: stalled without frames for stall_seconds, degraded when the
+        FPS measured over fps_window drops below min_fps_ratio of the nominal FPS.
+        '''
+        now = now or time.time()
+        for health in self.streams.values():
+            fps = health.fps(now, self.fps_window)
+            METRICS.set("fight_stream_fps", fps, stream=health.name)
+            if health.state not in ("running", "degraded", "stalled"):
+                continue
+            if health.last_frame is not None and now - health.last_frame > self.stall_seconds:
+                health.state = "stalled"
+            elif now - health.connected_at >= self.fps_window and fps < self.min_fps_ratio * health.nominal_fps:
+                if health.state != "degraded":
+                    health.fps_drops += 1
+                    METRICS.inc("fight_stream_fps_drops_total", stream=health.name)
+                health.state = "degraded"
+            elif health.last_frame is not None:
+                health.state = "running"
+
+    def status(self):
+        '''
+        Returns:
+            List with the status of every stream as a dict: state, measured and nominal FPS, frames,
+            reconnects, stalls, FPS drops, seconds since the last frame and the last error.
+        '''
+        now = time.time()
+        return [health.as_dict(now, self.fps_window) for health in self.streams.values()]
+
+    def print_status(self):
+        for status in self.status():
+            print(f"{status['stream']}: {status['state']} fps={status['fps']}/{status['nominal_fps']} "
+                  f"frames={status['frames']} reconnects={status['reconnects']} stalls={status['stalls']}")
+
+    async def _monitor(self):
+        last_status = time.time()
+        while not self.stop_event.is_set():
+            await self._sleep(self.check_seconds)
+            self.check()
+            if self.status_seconds and time.time() - last_status >= self.status_seconds:
+                last_status = time.time()
+                self.print_status()
+
+    async def run(self, duration=None):
+        '''
+        Supervise every stream until stop() is called, duration seconds have passed, or every stream
+        stopped after max_failures failed connections.
+        Returns:
+            The final status of the streams.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        tasks = [asyncio.create_task(self._run_stream(health)) for health in self.streams.values()]
+        monitor = asyncio.create_task(self._monitor())
+        streams = asyncio.gather(*tasks)
+        try:
+            await asyncio.wait_for(asyncio.shield(streams), duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.stop_event.set()
+            await streams
+            await monitor
+        return self.status()
+
+    def stop(self):
+        # thread safe, e.g. from a signal handler or another thread
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+
+class StreamInference:
+    '''
+    on_frame callback of a StreamSupervisor running the start_streaming pipeline (a StreamPipeline) on every
+    stream. Call close() once the supervisor returned, before closing the recorders, the window store or the
+    model: it waits for the windows still in flight.
+    Args:
+        recorders: Optional dict of stream name to IncidentRecorder.
+    '''
+
+    def __init__(self, model, SEQUENCE_LENGTH=16, cache=None, recorders=None, sample_hz=None, window_seconds=None,
+                 buffer_windows=2, window_store=None):
+        self.model = model
+        self.SEQUENCE_LENGTH = SEQUENCE_LENGTH
+        self.cache = cache
+        self.recorders = recorders or {}
+        self.sample_hz = sample_hz
+        self.window_seconds = window_seconds
+        self.buffer_windows = buffer_windows
+        self.window_store = window_store
+        self.version = (getattr(model, 'version', None) or model_version(model)) if window_store is not None else None
+        self.pipelines = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, name, frame, pts_ms):
+        pipeline = self.pipelines.get(name)
+        if pipeline is None:
+            with self.lock:
+                pipeline = self.pipelines.get(name)
+                if pipeline is None:
+                    pipeline = self.pipelines[name] = StreamPipeline(
+                        self.model, name, self.SEQUENCE_LENGTH, self.cache, self.recorders.get(name), self.sample_hz,
+                        self.window_seconds, self.buffer_windows, self.window_store, self.version)
+        pipeline.push(frame, pts_ms)
+
+    def close(self):
+        for pipeline in list(self.pipelines.values()):
+            pipeline.close()
@@ -0,0 +1,125 @@
+import os
+import cv2
+import json
+import time
+import itertools
+import numpy as np
+
+from UtilsFiles.Fight_utils import transform_uint8_, normalize_clips, PredBatchProbs, CLASSES_LIST
+from UtilsFiles.Evaluate_utils import file_checksum
+
+
+def build_frame_store(video_path, store_dir):
+    '''
+    This function will decode a video once into a memory-mapped uint8 array of its resized and center cropped
+    frames ([num_frames, 112, 112, 3], ~37 KB per frame), so any sampling of the video can be scored later
+    without decoding or resizing again. Already built stores are reused.
+    Returns:
+        frames: Read-only np.memmap of the frames.
+        meta: dict with the number of frames and the fps of the video.
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    name = f"{os.path.splitext(os.path.basename(video_path))[0]}_{file_checksum(video_path)}"
+    frames_path = os.path.join(store_dir, name + ".u8")
+    meta_path = os.path.join(store_dir, name + ".json")
+
+    if not os.path.isfile(meta_path):
+        video_reader = cv2.VideoCapture(video_path)
+        fps = video_reader.get(cv2.CAP_PROP_FPS)
+        transform = transform_uint8_()
+        count = 0
+        with open(frames_path + ".tmp", "wb") as f:
+            while True:
+                ok, frame = video_reader.read()
+                if not ok:
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                f.write(np.ascontiguousarray(transform(image=frame)['image'], dtype=np.uint8).tobytes())
+                count += 1
+        video_reader.release()
+        os.replace(frames_path + ".tmp", frames_path)
+        with open(meta_path, "w") as f:
+            json.dump({"video": video_path, "frames": count, "fps": fps}, f)
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta["frames"] == 0:
+        return np.zeros((0, 112, 112, 3), dtype=np.uint8), meta
+    frames = np.memmap(frames_path, dtype=np.uint8, mode="r", shape=(meta["frames"], 112, 112, 3))
+    return frames, meta
+
+
+def window_starts(num_frames, SEQUENCE_LENGTH, skip, stride):
+    # First frame of every full window, a window takes SEQUENCE_LENGTH frames one every skip frames.
+    span = (SEQUENCE_LENGTH - 1) * skip + 1
+    return np.arange(0, max(num_frames - span + 1, 0), stride)
+
+
+def score_config(stores, model, SEQUENCE_LENGTH, skip, stride, batch_size=8):
+    '''
+    Score every window of one (SEQUENCE_LENGTH, skip, stride) configuration on the frame stores.
+    Windows of all videos are put in batches of batch_size for the model.
+    Returns:
+        window_probs: list, per video, of the [num_windows, num_classes] probabilities.
+        seconds: Time spent gathering and scoring.
+    '''
+    start = time.time()
+    offsets = np.arange(SEQUENCE_LENGTH) * skip
+    jobs = [(v, s) for v, (frames, _) in enumerate(stores)
+            for s in window_starts(len(frames), SEQUENCE_LENGTH, skip, stride)]
+    window_probs = [[] for _ in stores]
+    for b in range(0, len(jobs), batch_size):
+        batch = jobs[b:b + batch_size]
+        clips = np.stack([stores[v][0][s + offsets] for v, s in batch])
+        probs = PredBatchProbs(normalize_clips(clips), model)
+        for (v, _), row in zip(batch, probs):
+            window_probs[v].append(row)
+    window_probs = [np.array(p).reshape(-1, len(CLASSES_LIST)) for p in window_probs]
+    return window_probs, time.time() - start
+
+
+def sweep(videos, model, store_dir, sequence_lengths, skips, strides=(0,), threshold=0.5, batch_size=8):
+    '''
+    This function will evaluate every (SEQUENCE_LENGTH, skip, stride) combination against decode-once frame stores.
+    A video is detected as a fight when any of its windows has a fight probability >= threshold, like the
+    alerts of predict_on_video. A stride of 0 means back to back windows (SEQUENCE_LENGTH * skip), the
+    predict_on_video behaviour.
+    Args:
+        videos: List of (video_path, label) pairs.
+        model: The loaded model.
+        store_dir: Folder of the frame stores.
+    Returns:
+        rows: One dict per configuration with the detection metrics and compute cost.
+    '''
+    start = time.time()
+    stores = [build_frame_store(path, store_dir) for path, _ in videos]
+    print(f"Frame stores ready in {time.time()-start:.1f}s")
+    labels = np.array([label for _, label in videos])
+    fight_index = CLASSES_LIST.index('fight')
+    minutes = sum(meta["frames"] / (meta["fps"] or 25.0) for _, meta in stores) / 60.0
+
+    rows = []
+    for SEQUENCE_LENGTH, skip, stride in itertools.product(sequence_lengths, skips, strides):
+        stride = stride or SEQUENCE_LENGTH * skip
+        window_probs, seconds = score_config(stores, model, SEQUENCE_LENGTH, skip, stride, batch_size)
+        scored = np.array([len(p) > 0 for p in window_probs])
+        detected = np.array([len(p) > 0 and p[:, fight_index].max() >= threshold for p in window_probs])
+        positive = labels == fight_index
+        tp = int((detected & positive & scored).sum())
+        fp = int((detected & ~positive & scored).sum())
+        fn = int((~detected & positive & scored).sum())
+        tn = int((~detected & ~positive & scored).sum())
+        windows = int(sum(len(p) for p in window_probs))
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        rows.append({
+            "sequence_length": SEQUENCE_LENGTH, "skip": skip, "stride": stride,
+            "videos": int(scored.sum()), "accuracy": (tp + tn) / max(int(scored.sum()), 1),
+            "precision": precision, "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            "windows": windows, "frames_through_model": windows * SEQUENCE_LENGTH,
+            "windows_per_video_minute": windows / minutes if minutes else 0.0,
+            "seconds": seconds,
+        })
+        print(rows[-1])
+    return rows
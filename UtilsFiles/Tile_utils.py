@@ -0,0 +1,195 @@
+import os
+import cv2
+import numpy as np
+import pandas as pd
+
+from UtilsFiles.Metrics_utils import METRICS
+from UtilsFiles.Fight_utils import (normalize_clips, PredBatchProbs, TimestampSampler, window_length, frame_time_ms,
+                                    alert_folder_check, save_alert_image_csv, write_csv_atomic, CLASSES_LIST)
+
+
+def parse_tiles(text):
+    # "3x2" -> (3 columns, 2 rows)
+    cols, rows = text.lower().split('x')
+    return int(cols), int(rows)
+
+
+class TiledClips:
+    '''
+    Preallocated uint8 clips of the overlapping regions of a wide frame, so a fight in a corner of a 4K view
+    is seen at the model resolution instead of being shrunk with the whole frame or cropped out.
+    Each decoded frame is resized once, keeping its aspect ratio, to a small working image in which every region
+    is exactly 171x128 (the resize of transform_()), converted to RGB once, and every region clip gets the center
+    112x112 of its region as a view of that image. Regions therefore keep the 171:128 shape of their box in the
+    frame instead of being stretched to it. The working image is sized so the grid covers the frame with at least
+    overlap, the regions are spread evenly over it, so the overlap grows along the dimension with room to spare.
+    On a frame too tall or too wide for the grid, regions are added along the long dimension to keep it covered.
+    The working image uses INTER_AREA: from a 4K frame the linear resize of transform_() skips most pixels and
+    aliases, area averaging is closer to what the model saw on its low resolution training videos. The working
+    image is a few times the model resolution, the full view is resized from it with the linear interpolation of
+    transform_().
+    With full_view the whole frame, resized like transform_(), is one more region.
+    Args:
+        width, height: Frame size of the source.
+        cols, rows: Grid of regions.
+        overlap: Least share of a region overlapping its neighbour, so a fight on a border is whole in one region.
+        SEQUENCE_LENGTH: Frames per window.
+        full_view: Also score the whole frame as region 0.
+    '''
+
+    def __init__(self, width, height, cols=3, rows=2, overlap=0.25, SEQUENCE_LENGTH=16, full_view=True, size=112):
+        # source pixels per working pixel: the smallest 171x128 regions whose grid covers the frame, a
+        # region can't be larger than the frame
+        scale = max(width / (171 * (1 + (cols - 1) * (1 - overlap))), height / (128 * (1 + (rows - 1) * (1 - overlap))))
+        scale = min(scale, width / 171, height / 128)
+        self.work_size = (max(171, int(round(width / scale))), max(128, int(round(height / scale))))
+        self.work = np.empty((self.work_size[1], self.work_size[0], 3), dtype=np.uint8)
+        self.full = np.empty((128, 171, 3), dtype=np.uint8)
+        self.full_view = full_view
+        top, left = (128 - size) // 2, (171 - size) // 2
+        scale_x, scale_y = width / self.work_size[0], height / self.work_size[1]
+        xs = self._offsets(self.work_size[0], 171, cols, overlap)
+        ys = self._offsets(self.work_size[1], 128, rows, overlap)
+        # crop of every region in the working image and its box in the source frame
+        self.crops = []
+        self.boxes = [(0, 0, width, height)] if full_view else []
+        for y in ys:
+            for x in xs:
+                self.crops.append((y + top, x + left))
+                self.boxes.append((int(x * scale_x), int(y * scale_y), min(width, int(round((x + 171) * scale_x))),
+                                   min(height, int(round((y + 128) * scale_y)))))
+        self.size = size
+        self.full_crop = (top, left)
+        self.clips = np.zeros((len(self.boxes), SEQUENCE_LENGTH, size, size, 3), dtype=np.uint8)
+
+    @staticmethod
+    def _offsets(length, region, count, overlap):
+        # a grid the frame is too narrow or too short for (3x2 on a portrait view): no duplicate regions where
+        # one spans the frame, and enough regions to cover the frame with overlap
+        if length <= region:
+            return [0]
+        count = max(count, int(np.ceil((length - region - 1) / (region * (1 - overlap)))) + 1)
+        # evenly spread, the first and the last region touch the borders
+        return [int(round(i * (length - region) / (count - 1))) for i in range(count)]
+
+    def push(self, frame, position):
+        '''
+        Write the regions of one BGR frame at position of the window.
+        '''
+        cv2.resize(frame, self.work_size, dst=self.work, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.work, cv2.COLOR_BGR2RGB, dst=self.work)
+        region = 0
+        if self.full_view:
+            # the whole frame from the working image, not a second resize of the full resolution frame
+            cv2.resize(self.work, (171, 128), dst=self.full, interpolation=cv2.INTER_LINEAR)
+            top, left = self.full_crop
+            self.clips[0, position] = self.full[top:top + self.size, left:left + self.size]
+            region = 1
+        for top, left in self.crops:
+            self.clips[region, position] = self.work[top:top + self.size, left:left + self.size]
+            region += 1
+
+
+def predict_tiles(clips, model):
+    '''
+    This function will score all the region clips of one window in a single batched forward pass.
+    Args:
+        clips: uint8 array [regions, num_frames, 112, 112, 3], e.g. TiledClips.clips.
+        model: The loaded model.
+    Returns:
+        probs: numpy array [regions, len(CLASSES_LIST)].
+        verdict: Class probabilities of the window, the max over the regions of every class.
+    '''
+    probs = PredBatchProbs(normalize_clips(clips), model)
+    return probs, probs.max(axis=0)
+
+
+def predict_on_video_tiled(video_file_path, output_folder_path, model, SEQUENCE_LENGTH=16, skip=2, cols=3, rows=2,
+                           overlap=0.25, full_view=True, threshold=0.5, showInfo=False, sample_hz=None,
+                           window_seconds=None, recorder=None):
+    '''
+    This function will perform fight detection like predict_on_video, on overlapping regions of every frame
+    (see TiledClips) scored together in one batch per window. A window is a fight when any region reaches
+    threshold, the fight regions are boxed in the output video and the alert images.
+    The probability of every region of every window is written to Tiles.csv in the output folder.
+    Args:
+        cols, rows, overlap, full_view: Regions of the frame, see TiledClips.
+        threshold: Fight probability of a region that raises an alert.
+    Returns:
+        DataFrame of Tiles.csv: window, frame, region, its box in the frame and the class probabilities.
+    '''
+    video_reader = cv2.VideoCapture(video_file_path)
+    width = int(video_reader.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(video_reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = video_reader.get(cv2.CAP_PROP_FPS)
+    alert_folder_check(output_folder_path)
+    video_writer = cv2.VideoWriter(f"{output_folder_path}/Output_video.mp4", cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                   (width, height))
+
+    SEQUENCE_LENGTH = window_length(sample_hz, window_seconds, SEQUENCE_LENGTH)
+    sampler = TimestampSampler(sample_hz) if sample_hz else None
+    tiles = TiledClips(width, height, cols, rows, overlap, SEQUENCE_LENGTH, full_view)
+    print(f"Scoring {len(tiles.boxes)} regions per window")
+    fight_index = CLASSES_LIST.index('fight')
+    stream = os.path.basename(video_file_path)
+    report_rows = []
+    fight_boxes = []
+    position = 0
+    counter = 0
+    windows = 0
+    s_no = 1
+    while video_reader.isOpened():
+        with METRICS.timer("fight_decode_seconds", stream=stream):
+            ok, frame = video_reader.read()
+        if not ok:
+            break
+        METRICS.inc("fight_frames_total", stream=stream)
+        if sampler is not None:
+            selected = sampler.select(frame_time_ms(video_reader, counter, fps))
+        else:
+            selected = counter % skip == 0
+        if selected:
+            with METRICS.timer("fight_preprocess_seconds", stream=stream):
+                tiles.push(frame, position)
+            position += 1
+
+        if position == SEQUENCE_LENGTH:
+            with METRICS.timer("fight_forward_seconds", stream=stream):
+                probs, verdict = predict_tiles(tiles.clips, model)
+            METRICS.inc("fight_windows_total", stream=stream)
+            for region, (box, region_probs) in enumerate(zip(tiles.boxes, probs)):
+                row = {"window": windows, "frame": counter, "region": region, "x0": box[0], "y0": box[1],
+                       "x1": box[2], "y1": box[3]}
+                row.update({f"p_{name}": float(p) for name, p in zip(CLASSES_LIST, region_probs)})
+                report_rows.append(row)
+            fight_boxes = [box for box, p in zip(tiles.boxes, probs[:, fight_index]) if p >= threshold]
+            if showInfo:
+                print(f"Window {windows}: max p(fight) {verdict[fight_index]:.3f} in {len(fight_boxes)} regions")
+            if fight_boxes:
+                for x0, y0, x1, y1 in fight_boxes:
+                    cv2.rectangle(frame, (x0, y0), (x1 - 1, y1 - 1), (0, 0, 255), 3)
+                cv2.putText(frame, "fight", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+                with METRICS.timer("fight_alert_write_seconds", stream=stream):
+                    save_alert_image_csv(frame, s_no, output_folder_path, counter)
+                s_no += 1
+                if recorder is not None:
+                    recorder.trigger()
+                METRICS.inc("fight_alerts_total", stream=stream)
+            position = 0
+            windows += 1
+        elif fight_boxes:
+            # keep the boxes of the last window on the following frames, like the label of predict_on_video
+            for x0, y0, x1, y1 in fight_boxes:
+                cv2.rectangle(frame, (x0, y0), (x1 - 1, y1 - 1), (0, 0, 255), 3)
+            cv2.putText(frame, "fight", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+        counter += 1
+        video_writer.write(frame)
+        if recorder is not None:
+            recorder.push(frame)
+    video_reader.release()
+    video_writer.release()
+
+    columns = ["window", "frame", "region", "x0", "y0", "x1", "y1"] + [f"p_{name}" for name in CLASSES_LIST]
+    report = pd.DataFrame(report_rows, columns=columns)
+    write_csv_atomic(report, f"{output_folder_path}/Tiles.csv")
+    return report
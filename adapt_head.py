@@ -0,0 +1,42 @@
+# import required packages
+import torch
+from UtilsFiles.Fight_utils import loadModel, CLASSES_LIST
+from UtilsFiles.Embedding_utils import cache_embeddings, train_head
+import argparse
+import time
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Retrain the fc head of the Fight Detection model on cached embeddings')
+parser.add_argument('--modelPath')
+parser.add_argument('--datasetDir', default='dataset')
+parser.add_argument('--cacheDir', default='embeddings_cache')
+parser.add_argument('--outputPath', help='where to save the adapted model weights')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--clipsPerVideo', type=int, default=1)
+parser.add_argument('--epochs', type=int, default=50)
+parser.add_argument('--lr', type=float, default=1e-3)
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    model = loadModel(args.modelPath)
+
+    start = time.time()
+    features, labels, _ = cache_embeddings(args.datasetDir, CLASSES_LIST, args.sequenceLength, model,
+                                           args.cacheDir, args.clipsPerVideo)
+    print(f"Embeddings ready in {time.time()-start:.1f}s")
+
+    start = time.time()
+    model, _ = train_head(model, features, labels, args.epochs, args.lr)
+    print(f"Head trained in {time.time()-start:.1f}s")
+
+    # the saved weights load with loadModel like the original model
+    torch.save(model.state_dict(), args.outputPath)
+    print(f"Saved {args.outputPath}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# import required packages
+from UtilsFiles.Archive_utils import process_archive
+import argparse
+import time
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Resumable, sharded Fight Detection over long archive videos')
+parser.add_argument('--modelPath')
+parser.add_argument('--inputPath')
+parser.add_argument('--outputPath')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--skip', type=int, default=2)
+parser.add_argument('--shards', type=int, default=1, help='number of time shards processed in parallel')
+parser.add_argument('--workers', type=int, help='worker processes, defaults to one per shard up to the core count')
+parser.add_argument('--checkpointEvery', type=int, default=100, help='windows between checkpoints')
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    start = time.time()
+    alerts = process_archive(args.modelPath, args.inputPath, args.outputPath, args.sequenceLength, args.skip,
+                             args.shards, args.workers, args.checkpointEvery)
+    print(f"{len(alerts)} alerts, report: {args.outputPath}/Report.csv")
+    print(f"Time taken: {time.time()-start}")
+
+
+if __name__ == '__main__':
+    main()
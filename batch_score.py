@@ -0,0 +1,59 @@
+# import required packages
+import os
+from UtilsFiles.Lease_utils import plan_shards, run_worker, run_local_workers, merge_results
+import argparse
+import time
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.mpg', '.mpeg', '.ts')
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Score an archive of videos on several machines through a shared directory')
+parser.add_argument('--step', choices=['plan', 'work', 'merge', 'local'], default='local',
+                    help='plan the shards, run a worker, merge the results, or all three with local worker processes')
+parser.add_argument('--sharedDir', help='directory every worker sees, e.g. an NFS mount')
+parser.add_argument('--inputDir', help='videos to score (searched recursively), for the plan step')
+parser.add_argument('--shardSize', type=int, default=10, help='videos per shard')
+parser.add_argument('--modelPath')
+parser.add_argument('--worker', help='name of this worker, defaults to <host>-<pid>')
+parser.add_argument('--workers', type=int, default=2, help='local worker processes for --step=local')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--skip', type=int, default=2)
+parser.add_argument('--threshold', type=float, default=0.5)
+parser.add_argument('--leaseSeconds', type=float, default=60.0, help='a crashed worker loses its shard after this')
+parser.add_argument('--output', help='merged CSV, defaults to <sharedDir>/report.csv')
+
+
+def list_videos(folder):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(folder) for name in names
+                  if name.lower().endswith(VIDEO_EXTENSIONS))
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.step in ('plan', 'local'):
+        shards = plan_shards(args.sharedDir, list_videos(args.inputDir), args.shardSize)
+        print(f"{sum(len(s) for s in shards)} videos in {len(shards)} shards")
+    if args.step == 'work':
+        done = run_worker(args.sharedDir, args.modelPath, args.worker, args.sequenceLength, args.skip,
+                          args.threshold, args.leaseSeconds)
+        print(f"Scored shards: {done}")
+    if args.step == 'local':
+        run_local_workers(args.sharedDir, args.modelPath, args.workers, args.sequenceLength, args.skip,
+                          args.threshold, args.leaseSeconds)
+    if args.step in ('merge', 'local'):
+        output = args.output or os.path.join(args.sharedDir, 'report.csv')
+        merged, missing, failed = merge_results(args.sharedDir, output)
+        print(f"{len(merged)} videos merged into {output}")
+        if missing:
+            print(f"Shards without results yet: {missing}")
+        if failed:
+            print(f"Videos that could not be scored: {failed}")
+    print(f"Time taken: {time.time()-start}")
+
+
+if __name__ == '__main__':
+    main()
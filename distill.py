@@ -0,0 +1,43 @@
+# import required packages
+import pandas as pd
+from UtilsFiles.Fight_utils import loadModel, create_dataset, CLASSES_LIST
+from UtilsFiles.Distill_utils import distill_student, save_student, distill_report
+import argparse
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Distill the Fight Detection mc3_18 into a small (2+1)D student')
+parser.add_argument('--modelPath', help='the fine-tuned mc3_18 teacher')
+parser.add_argument('--datasetDir', default='dataset')
+parser.add_argument('--outputPath', default='student.pth', help='where to save the student, loads with loadModel')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--width', type=int, default=16, help='channels of the first student stage')
+parser.add_argument('--frames', type=int, default=8, help='frames the student looks at')
+parser.add_argument('--epochs', type=int, default=10)
+parser.add_argument('--lr', type=float, default=1e-3)
+parser.add_argument('--temperature', type=float, default=4.0)
+parser.add_argument('--alpha', type=float, default=0.5, help='weight of the distillation loss')
+parser.add_argument('--output', default='distill_report.csv')
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    teacher = loadModel(args.modelPath)
+    features, labels = create_dataset(args.datasetDir, CLASSES_LIST, args.sequenceLength)
+    student, test = distill_student(teacher, features, labels, args.width, args.frames, args.epochs, args.lr,
+                                    temperature=args.temperature, alpha=args.alpha)
+    save_student(student, args.outputPath)
+    print(f"Saved {args.outputPath}")
+
+    # reload to check the saved student round trips through loadModel
+    student = loadModel(args.outputPath)
+    rows = distill_report({"teacher": teacher, "student": student}, test, args.sequenceLength)
+    table = pd.DataFrame(rows)
+    table.to_csv(args.output, index=False)
+    print(table.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
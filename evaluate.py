@@ -0,0 +1,47 @@
+# import required packages
+import json
+from UtilsFiles.Fight_utils import CLASSES_LIST
+from UtilsFiles.Evaluate_utils import list_labeled_videos, predict_dataset, evaluation_report, save_confusion_matrix
+import argparse
+import time
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Evaluate the Fight Detection model on a labeled video tree')
+parser.add_argument('--modelPath')
+parser.add_argument('--datasetDir', default='dataset', help='folder with one sub folder of videos per class')
+parser.add_argument('--cacheDir', default='eval_cache')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--skip', type=int, default=2)
+parser.add_argument('--clipsPerVideo', type=int, default=1)
+parser.add_argument('--workers', type=int, help='worker processes, defaults to one per core')
+parser.add_argument('--batchSize', type=int, default=8, help='clips per forward pass, across videos')
+parser.add_argument('--threshold', type=float, action='append', help='fight threshold, repeatable, default 0.5')
+parser.add_argument('--output', default='evaluation/confusionMatrix', help='confusion matrix path without extension')
+parser.add_argument('--reportPath', help='also write the metrics to this JSON file')
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    videos = list_labeled_videos(args.datasetDir, CLASSES_LIST)
+    start = time.time()
+    predictions, model_calls = predict_dataset(args.modelPath, videos, args.cacheDir, args.sequenceLength,
+                                               args.skip, args.clipsPerVideo, args.workers, args.batchSize)
+    print(f"Predictions ready in {time.time()-start:.1f}s ({model_calls} videos through the model)")
+
+    reports = []
+    for threshold in args.threshold or [0.5]:
+        report = evaluation_report(videos, predictions, threshold)
+        reports.append(report)
+        print(json.dumps(report))
+    save_confusion_matrix(reports[0]["confusion_matrix"], args.output)
+
+    if args.reportPath:
+        with open(args.reportPath, 'w') as f:
+            json.dump(reports, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
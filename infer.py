@@ -1,7 +1,22 @@
 # import required packages
 import torch
-from UtilsFiles.Fight_utils import loadModel, predict_on_video,start_streaming
+from UtilsFiles.Fight_utils import loadModel, predict_on_video,start_streaming, model_version, stream_name
+from UtilsFiles.SharedMemory_utils import start_multiprocess_streaming
+from UtilsFiles.Metrics_utils import start_metrics_server, start_json_dump
+from UtilsFiles.Profile_utils import WindowProfiler
+from UtilsFiles.Index_utils import EmbeddingIndex
+from UtilsFiles.Cache_utils import ResultCache
+from UtilsFiles.Pool_utils import InferencePool
+from UtilsFiles.Recorder_utils import IncidentRecorder
+from UtilsFiles.Store_utils import WindowStore
+from UtilsFiles.Supervisor_utils import StreamSupervisor, StreamInference
+from UtilsFiles.Tile_utils import predict_on_video_tiled, parse_tiles
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import asyncio
+import cv2
+import os
 import time
 
 
@@ -16,25 +31,244 @@ parser.add_argument('--outputPath')
 parser.add_argument('--sequenceLength', type=int, default=16)
 parser.add_argument('--skip', type=int, default=2)
 parser.add_argument('--showInfo', action='store_true')
+# sample frames by timestamp so compute does not depend on the camera FPS, replaces --skip
+parser.add_argument('--sampleHz', type=float, help='frames sampled per second of video')
+parser.add_argument('--windowSeconds', type=float, help='window duration, sets sequenceLength = sampleHz * windowSeconds')
+# with --streaming, decode every comma separated inputPath in its own process and share one model
+parser.add_argument('--multiProcess', action='store_true')
+# expose per-stage latency histograms and counters, both are off by default
+parser.add_argument('--metricsPort', type=int, help='serve Prometheus metrics on this port')
+parser.add_argument('--metricsJson', help='periodically dump the metrics to this JSON file')
+parser.add_argument('--metricsInterval', type=float, default=10.0)
+# profile the first windows of the video with torch.profiler
+parser.add_argument('--profileWindows', type=int, default=0, help='number of windows to profile, 0 disables profiling')
+parser.add_argument('--profileDir', default='profile')
+parser.add_argument('--profilePython', action='store_true', help='also capture a Python profile (py-spy if installed)')
+parser.add_argument('--profileTopN', type=int, default=20)
+# store the embedding of every scored window for similar incident search (see search.py)
+parser.add_argument('--embeddingIndex', help='folder of the embedding index')
+# skip the model for windows already seen (frozen cameras, looped feeds, re-submitted files)
+parser.add_argument('--resultCache', action='store_true')
+parser.add_argument('--resultCachePath', help='JSON file to load the result cache from and save it to')
+parser.add_argument('--resultCacheSize', type=int, default=100000, help='max number of cached windows')
+# compile the model with torch.compile, the compiled kernels are cached on disk for later starts
+parser.add_argument('--compile', action='store_true')
+parser.add_argument('--compileCacheDir', default='compile_cache')
+# run the model as N replicas pinned to disjoint cores, several comma separated inputPaths are run at once
+parser.add_argument('--replicas', type=int, default=0, help='number of model replica processes, 0 runs one model')
+parser.add_argument('--threadsPerReplica', type=int, help='cores per replica, defaults to an even split')
+# save a clip around every alert from an in-memory ring of recent frames, in <outputPath>/incident clips
+parser.add_argument('--incidentClips', action='store_true')
+parser.add_argument('--preRoll', type=float, default=5.0, help='seconds kept before an alert')
+parser.add_argument('--postRoll', type=float, default=5.0, help='seconds recorded after an alert')
+parser.add_argument('--recorderMb', type=float, default=64, help='memory bound of the frame ring per camera')
+# keep the probabilities of every window in a columnar store, queried with query.py
+parser.add_argument('--windowStore', help='folder of the window probability store')
+parser.add_argument('--camera', help='camera name in the store, defaults to the file name or the stream URL without credentials')
+parser.add_argument('--videoStartTime', type=datetime.fromisoformat,
+                    help='wall-clock time of the first frame, e.g. 2024-07-18T17:30:00, defaults to now')
+parser.add_argument('--recorderQuality', type=int, default=85, help='JPEG quality of buffered frames, 0 keeps raw frames')
+# with --streaming, supervise every comma separated inputPath: reconnect with backoff and check their health
+parser.add_argument('--supervise', action='store_true')
+parser.add_argument('--stallSeconds', type=float, default=10.0, help='a stream without frames this long is reconnected')
+parser.add_argument('--minFpsRatio', type=float, default=0.5, help='a stream below this share of its FPS is degraded')
+parser.add_argument('--maxBackoff', type=float, default=60.0, help='longest wait between reconnects')
+parser.add_argument('--statusSeconds', type=float, default=10.0, help='print the stream status this often')
+parser.add_argument('--runSeconds', type=float, help='stop after this long, runs until Ctrl+C by default')
+parser.add_argument('--realtime', action='store_true', help='read local files at their FPS, as live cameras')
+# score overlapping regions of wide high resolution views in one batch per window
+parser.add_argument('--tiles', type=parse_tiles, help='grid of regions as COLSxROWS, e.g. 3x2')
+parser.add_argument('--tileOverlap', type=float, default=0.25, help='share of a region overlapping its neighbour')
+parser.add_argument('--noFullView', action='store_true', help='do not also score the whole frame')
+parser.add_argument('--tileThreshold', type=float, default=0.5, help='fight probability of a region raising an alert')
 
 
 
 
+def make_model(args):
+    if args.replicas > 0:
+        return InferencePool(args.modelPath, args.replicas, args.threadsPerReplica, args.compile, args.sequenceLength,
+                             args.compileCacheDir)
+    return loadModel(args.modelPath, args.compile, args.sequenceLength, compile_cache_dir=args.compileCacheDir)
+
+
+def close_model(model):
+    if isinstance(model, InferencePool):
+        for replica in model.stats():
+            print(f"Replica: {replica}")
+        model.close()
+
+
+def make_cache(args, model):
+    if not (args.resultCache or args.resultCachePath):
+        return None
+    version = model.version if isinstance(model, InferencePool) else model_version(model)
+    return ResultCache(version, args.resultCacheSize, args.resultCachePath)
+
+
+def make_recorder(args, path, output_folder, block=False):
+    # block for video files: the clips keep every frame, a live stream drops frames instead of falling behind
+    if not args.incidentClips:
+        return None
+    video = cv2.VideoCapture(path)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    return IncidentRecorder(os.path.join(output_folder or '.', 'incident clips'), fps, args.preRoll, args.postRoll,
+                            args.recorderMb, args.recorderQuality, stream=os.path.basename(stream_name(path)),
+                            block=block)
+
+
+def close_recorder(recorder):
+    if recorder is not None:
+        recorder.close()
+
+
+def run_video(args, model, cache, path, output_folder, window_store=None):
+    recorder = make_recorder(args, path, output_folder, block=True)
+    predict_on_video(path, output_folder, model, args.sequenceLength, args.skip, args.showInfo, cache=cache,
+                     recorder=recorder, sample_hz=args.sampleHz, window_seconds=args.windowSeconds,
+                     window_store=window_store, time_origin=video_start_time(args))
+    close_recorder(recorder)
+
+
+def video_start_time(args):
+    return args.videoStartTime.timestamp() if args.videoStartTime else None
+
+
+def close_store(window_store):
+    if window_store is not None:
+        window_store.close()
+
+
+def save_cache(cache):
+    if cache is not None:
+        print(f"Result cache: {cache.stats()}")
+        cache.save()
+
+
+def reject_unsupported(args, mode, names):
+    # options the code path of mode does not implement, rather than silently ignoring them
+    for name in names:
+        if getattr(args, name) != parser.get_default(name):
+            parser.error(f'--{name} is not supported with {mode}')
+
+
 def main():
     # parsing args
     args = parser.parse_args()
 
-    model = loadModel(args.modelPath)
-    # Perform Fight Detection on the Test Video.
+    if args.streaming and args.multiProcess:
+        reject_unsupported(args, '--streaming --multiProcess',
+                           ['supervise', 'replicas', 'compile', 'resultCache', 'resultCachePath', 'windowStore',
+                            'incidentClips', 'sampleHz', 'windowSeconds', 'embeddingIndex', 'profileWindows', 'tiles'])
+    elif args.streaming:
+        reject_unsupported(args, '--streaming', ['embeddingIndex', 'profileWindows', 'tiles'])
+    elif args.tiles:
+        reject_unsupported(args, '--tiles', ['resultCache', 'resultCachePath', 'windowStore', 'profileWindows',
+                                             'embeddingIndex'])
+    if args.replicas > 0 and args.embeddingIndex:
+        parser.error('--embeddingIndex needs the model in this process, it cannot be used with --replicas')
+    if args.compile and args.embeddingIndex:
+        parser.error('--embeddingIndex reads the features inside the model, it cannot be used with --compile')
+
+    if args.metricsPort:
+        start_metrics_server(args.metricsPort)
+    stop_json_dump = start_json_dump(args.metricsJson, args.metricsInterval) if args.metricsJson else None
+
+    window_store = WindowStore(args.windowStore) if args.windowStore else None
+
+    if args.streaming==True and args.multiProcess==True:
+        start_multiprocess_streaming(args.modelPath, args.inputPath.split(','), args.sequenceLength, args.skip)
+
+    elif args.streaming==True and args.supervise==True:
+        model = make_model(args)
+        cache = make_cache(args, model)
+        paths = args.inputPath.split(',')
+        recorders = {stream_name(path): make_recorder(args, path, args.outputPath) for path in paths}
+        inference = StreamInference(model, args.sequenceLength, cache, recorders, args.sampleHz, args.windowSeconds,
+                                    window_store=window_store)
+        supervisor = StreamSupervisor(paths, inference, args.stallSeconds, args.minFpsRatio,
+                                      backoff_max=args.maxBackoff, status_seconds=args.statusSeconds,
+                                      realtime=args.realtime)
+        try:
+            asyncio.run(supervisor.run(args.runSeconds))
+        except KeyboardInterrupt:
+            pass
+        supervisor.print_status()
+        # the windows in flight still use the recorders, the store and the model
+        inference.close()
+        for recorder in recorders.values():
+            close_recorder(recorder)
+        save_cache(cache)
+        close_model(model)
+
+    elif args.streaming==True:
+        model = make_model(args)
+        cache = make_cache(args, model)
+        recorder = make_recorder(args, args.inputPath, args.outputPath)
+        start_streaming(model,args.inputPath,cache,recorder,args.sampleHz,args.windowSeconds,args.sequenceLength,
+                        window_store=window_store, camera=args.camera)
+        close_recorder(recorder)
+        save_cache(cache)
+        close_model(model)
+
+    elif args.tiles:
+        model = make_model(args)
+        start=time.time()
+        recorder = make_recorder(args, args.inputPath, args.outputPath, block=True)
+        report = predict_on_video_tiled(args.inputPath, args.outputPath, model, args.sequenceLength, args.skip,
+                                        *args.tiles, args.tileOverlap, not args.noFullView, args.tileThreshold,
+                                        args.showInfo, args.sampleHz, args.windowSeconds, recorder)
+        close_recorder(recorder)
+        print(f"{report['window'].nunique()} windows of {report['region'].nunique()} regions, "
+              f"report: {args.outputPath}/Tiles.csv")
+        print(f"Time taken: {time.time()-start}")
+        close_model(model)
+
+    elif args.replicas > 0 and ',' in args.inputPath:
+        # one thread per video, their windows are spread across the replicas
+        model = make_model(args)
+        cache = make_cache(args, model)
+        paths = args.inputPath.split(',')
+        start=time.time()
+        with ThreadPoolExecutor(len(paths)) as executor:
+            jobs = [executor.submit(run_video, args, model, cache, path,
+                                    os.path.join(args.outputPath, os.path.splitext(os.path.basename(path))[0]),
+                                    window_store)
+                    for path in paths]
+            for job in jobs:
+                job.result()
+        print(f"Time taken: {time.time()-start}")
+        save_cache(cache)
+        close_model(model)
 
-    if args.streaming==True:
-        start_streaming(model,args.inputPath)
-        
     else:
+        model = make_model(args)
+        cache = make_cache(args, model)
+        # Perform Fight Detection on the Test Video.
+        profiler = None
+        if args.profileWindows > 0:
+            profiler = WindowProfiler(args.profileWindows, args.profileDir, args.profilePython, args.profileTopN)
+            profiler.start()
         start=time.time()
-        predict_on_video(args.inputPath, args.outputPath, model, args.sequenceLength, args.skip, args.showInfo)
+        embedding_index = EmbeddingIndex(args.embeddingIndex) if args.embeddingIndex else None
+        recorder = make_recorder(args, args.inputPath, args.outputPath, block=True)
+        predict_on_video(args.inputPath, args.outputPath, model, args.sequenceLength, args.skip, args.showInfo,
+                         on_window=profiler.step if profiler else None, embedding_index=embedding_index, cache=cache,
+                         recorder=recorder, sample_hz=args.sampleHz, window_seconds=args.windowSeconds,
+                         window_store=window_store, camera=args.camera, time_origin=video_start_time(args))
+        close_recorder(recorder)
         end = time.time()
+        if profiler is not None:
+            # the video may have had fewer windows than requested
+            profiler.stop()
         print(f"Time taken: {end-start}")
+        save_cache(cache)
+        close_model(model)
+
+    close_store(window_store)
+    if stop_json_dump is not None:
+        stop_json_dump()
 
 
 if __name__ == '__main__':
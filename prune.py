@@ -0,0 +1,36 @@
+# import required packages
+import pandas as pd
+from UtilsFiles.Fight_utils import loadModel, create_dataset, CLASSES_LIST
+from UtilsFiles.Prune_utils import prune_report
+import argparse
+
+
+def float_list(text):
+    return [float(v) for v in text.split(',')]
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Structured channel pruning of the Fight Detection mc3_18')
+parser.add_argument('--modelPath')
+parser.add_argument('--datasetDir', default='dataset')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--sparsities', type=float_list, default=[0, 0.25, 0.5, 0.75])
+parser.add_argument('--epochs', type=int, default=3, help='fine-tuning epochs after pruning')
+parser.add_argument('--savePrefix', default='mc3_18_pruned', help='pruned models are saved as <prefix>_<sparsity>.pth')
+parser.add_argument('--output', default='prune_report.csv')
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    model = loadModel(args.modelPath)
+    features, labels = create_dataset(args.datasetDir, CLASSES_LIST, args.sequenceLength)
+    rows = prune_report(model, features, labels, args.sparsities, args.sequenceLength, args.epochs, args.savePrefix)
+    table = pd.DataFrame(rows)
+    table.to_csv(args.output, index=False)
+    print(table.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# import required packages
+from UtilsFiles.Store_utils import WindowStore
+from datetime import datetime, timedelta
+import pandas as pd
+import argparse
+import time
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Query the per-window probabilities of the Fight Detection window store')
+parser.add_argument('--windowStore', help='folder of the store written by infer.py --windowStore')
+parser.add_argument('--camera', help='camera name, all cameras when not given')
+parser.add_argument('--since', type=datetime.fromisoformat, help='e.g. 2024-07-18 or 2024-07-18T17:30:00')
+parser.add_argument('--until', type=datetime.fromisoformat)
+parser.add_argument('--lastDays', type=float, help='shortcut for --since=<now - lastDays>')
+parser.add_argument('--className', default='fight')
+parser.add_argument('--minProb', type=float, help='only windows with p(className) >= minProb')
+parser.add_argument('--modelVersion')
+parser.add_argument('--output', help='write the windows to this CSV')
+parser.add_argument('--compact', action='store_true', help='merge the segments of every day before the query')
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    since = args.since
+    if args.lastDays:
+        since = datetime.now() - timedelta(days=args.lastDays)
+    store = WindowStore(args.windowStore)
+    if args.compact:
+        start = time.time()
+        days = store.compact(args.camera)
+        print(f"Compacted {days} days in {time.time()-start:.1f} s")
+    start = time.time()
+    windows = store.query(args.camera, since, args.until, args.className, args.minProb, args.modelVersion)
+    print(f"{len(windows)} windows in {(time.time()-start)*1000:.1f} ms")
+    windows.insert(1, "time", pd.to_datetime(windows["start"], unit="s"))
+    if args.output:
+        windows.to_csv(args.output, index=False)
+    else:
+        print(windows.to_string(index=False, max_rows=50))
+
+
+if __name__ == '__main__':
+    main()
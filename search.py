@@ -0,0 +1,58 @@
+# import required packages
+import numpy as np
+from UtilsFiles.Fight_utils import loadModel, frames_extraction_uint8, normalize_clips, PredBatchProbsEmbeddings
+from UtilsFiles.Index_utils import EmbeddingIndex
+import argparse
+import time
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Search past windows that look like a given clip or alert')
+parser.add_argument('--indexDir')
+parser.add_argument('--queryId', type=int, action='append', help='id of an indexed window to use as query, repeatable')
+parser.add_argument('--videoPath', help='video (segment) to use as query, needs --modelPath')
+parser.add_argument('--startFrame', type=int, default=0)
+parser.add_argument('--endFrame', type=int)
+parser.add_argument('--modelPath')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--k', type=int, default=10)
+parser.add_argument('--nprobe', type=int, default=8)
+parser.add_argument('--buildIvfpq', action='store_true', help='(re)build the IVF/PQ layer before searching')
+parser.add_argument('--nlist', type=int, default=256)
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    index = EmbeddingIndex(args.indexDir)
+    if args.buildIvfpq:
+        start = time.time()
+        index.build_ivfpq(nlist=args.nlist)
+        print(f"IVF/PQ layer built in {time.time()-start:.2f}s")
+
+    queries = []
+    if args.queryId:
+        queries.extend(np.asarray(index.vectors[i], dtype=np.float32) for i in args.queryId)
+    if args.videoPath:
+        model = loadModel(args.modelPath)
+        clip = frames_extraction_uint8(args.videoPath, args.sequenceLength, args.startFrame, args.endFrame)
+        _, embeddings = PredBatchProbsEmbeddings(normalize_clips(clip[None]), model)
+        queries.append(embeddings[0])
+    if not queries:
+        parser.error('give --queryId or --videoPath')
+
+    start = time.time()
+    ids, scores = index.search(np.stack(queries), args.k, nprobe=args.nprobe)
+    results = [index.records([i for i in ids[q] if i >= 0]) for q in range(len(queries))]
+    print(f"Searched {len(index)} windows in {(time.time()-start)*1000:.2f} ms")
+
+    for q, records in enumerate(results):
+        print(f"Query {q}:")
+        for record, score in zip(records, scores[q]):
+            print(f"  {score:.4f}  id={record['id']} video={record['video']} frame={record['frame']} "
+                  f"time={record['timestamp']} label={record['label']} prob={record['prob']} image={record['image']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+# import required packages
+import torch
+from UtilsFiles.Fight_utils import loadModel
+from UtilsFiles.Server_utils import start_server
+import argparse
+
+
+torch.backends.cudnn.benchmark = True
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Fight Detection Inference Server')
+parser.add_argument('--modelPath')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--unixSocket', help='serve on this unix socket path instead of host:port')
+parser.add_argument('--sequenceLength', type=int, default=16)
+parser.add_argument('--maxBatchSize', type=int, default=8)
+parser.add_argument('--maxWaitMs', type=float, default=10)
+parser.add_argument('--sloMs', type=float, help='reject requests that would wait longer than this')
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    model = loadModel(args.modelPath)
+    start_server(model, args.host, args.port, args.unixSocket, args.sequenceLength,
+                 args.maxBatchSize, args.maxWaitMs, args.sloMs)
+
+
+if __name__ == '__main__':
+    main()
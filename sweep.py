@@ -0,0 +1,40 @@
+# import required packages
+import pandas as pd
+from UtilsFiles.Fight_utils import loadModel, CLASSES_LIST
+from UtilsFiles.Evaluate_utils import list_labeled_videos
+from UtilsFiles.Sweep_utils import sweep
+import argparse
+
+
+def int_list(text):
+    return [int(v) for v in text.split(',')]
+
+
+# fetching the arguments from the commandline
+parser = argparse.ArgumentParser(description='Sweep sequenceLength/skip/stride on decode-once frame stores')
+parser.add_argument('--modelPath')
+parser.add_argument('--datasetDir', default='dataset', help='folder with one sub folder of videos per class')
+parser.add_argument('--storeDir', default='frame_store')
+parser.add_argument('--sequenceLengths', type=int_list, default=[8, 16])
+parser.add_argument('--skips', type=int_list, default=[1, 2, 4])
+parser.add_argument('--strides', type=int_list, default=[0], help='0 means back to back windows')
+parser.add_argument('--threshold', type=float, default=0.5)
+parser.add_argument('--batchSize', type=int, default=8)
+parser.add_argument('--output', default='sweep.csv')
+
+
+def main():
+    # parsing args
+    args = parser.parse_args()
+
+    model = loadModel(args.modelPath)
+    videos = list_labeled_videos(args.datasetDir, CLASSES_LIST)
+    rows = sweep(videos, model, args.storeDir, args.sequenceLengths, args.skips, args.strides,
+                 args.threshold, args.batchSize)
+    table = pd.DataFrame(rows)
+    table.to_csv(args.output, index=False)
+    print(table.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import time
+import multiprocessing as mp
+
+from UtilsFiles.Lease_utils import ShardLease, plan_shards, load_shards, merge_results, write_json_atomic
+
+
+def _try_acquire(shared_dir, worker, start, queue):
+    lease = ShardLease(shared_dir, 0, worker, ttl=30.0)
+    # every process tries at the same moment
+    time.sleep(max(0.0, start - time.time()))
+    won = lease.acquire()
+    queue.put((worker, won, lease.generation))
+    lease.release()
+
+
+def _plan(shared_dir, videos, queue):
+    queue.put(plan_shards(shared_dir, videos, shard_size=2))
+
+
+def _run(target, args_list):
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    processes = [ctx.Process(target=target, args=args + (queue,)) for args in args_list]
+    for process in processes:
+        process.start()
+    results = [queue.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join(timeout=30)
+    return results
+
+
+def test_one_winner_per_generation(tmp_path):
+    plan_shards(str(tmp_path), ["a.mp4"])
+    start = time.time() + 1.0
+    results = _run(_try_acquire, [(str(tmp_path), f"w{i}", start) for i in range(8)])
+    winners = [worker for worker, won, _ in results if won]
+    assert len(winners) == 1
+    assert [generation for _, won, generation in results if won] == [0]
+    assert sorted(os.listdir(tmp_path / "leases")) == ["00000.lease.0"]
+
+
+def test_takeover_after_expiry(tmp_path):
+    plan_shards(str(tmp_path), ["a.mp4"])
+    first = ShardLease(str(tmp_path), 0, "first", ttl=0.6)
+    assert first.acquire()
+    # a crashed worker stops renewing, release() stops the heartbeat the same way
+    first.release()
+    second = ShardLease(str(tmp_path), 0, "second", ttl=0.6)
+    assert not second.acquire()
+    assert first.held()
+    time.sleep(0.8)
+    results = _run(_try_acquire, [(str(tmp_path), f"w{i}", time.time() + 0.5) for i in range(4)])
+    assert [generation for _, won, generation in results if won] == [1]
+    assert not first.held()
+
+
+def test_renewed_lease_is_not_taken(tmp_path):
+    plan_shards(str(tmp_path), ["a.mp4"])
+    holder = ShardLease(str(tmp_path), 0, "holder", ttl=0.6)
+    assert holder.acquire()
+    try:
+        time.sleep(1.5)
+        assert not ShardLease(str(tmp_path), 0, "other", ttl=0.6).acquire()
+        assert holder.held()
+    finally:
+        holder.release()
+
+
+def test_concurrent_plans_agree(tmp_path):
+    videos = [f"{i}.mp4" for i in range(5)]
+    results = _run(_plan, [(str(tmp_path), videos)] * 6)
+    assert all(shards == [["0.mp4", "1.mp4"], ["2.mp4", "3.mp4"], ["4.mp4"]] for shards in results)
+    assert load_shards(str(tmp_path)) == results[0]
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".tmp")] == []
+
+
+def test_merge_reports_failed_videos(tmp_path):
+    plan_shards(str(tmp_path), ["a.mp4", "b.mp4"])
+    write_json_atomic(str(tmp_path / "results" / "00000.json"), {"shard": 0, "worker": "w", "videos": [
+        {"video": "a.mp4", "frames": 10, "fps": 25.0, "windows": 1, "fight_max": 0.9, "fight_mean": 0.9,
+         "label": "fight", "alert_frames": [9]},
+        {"video": "b.mp4", "error": "Cannot open b.mp4"}]})
+    merged, missing, failed = merge_results(str(tmp_path), str(tmp_path / "report.csv"))
+    assert missing == [] and failed == ["b.mp4"]
+    assert list(merged["video"]) == ["a.mp4", "b.mp4"]
+    assert merged.loc[0, "alert_frames"] == "9"
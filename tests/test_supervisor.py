@@ -0,0 +1,152 @@
+import time
+import asyncio
+import threading
+
+import numpy as np
+
+from UtilsFiles.Supervisor_utils import StreamSupervisor
+
+
+class FakeCapture:
+    '''
+    Capture of a fake camera: frames_per_connection frames, then a failed read like a dropped connection.
+    With hang_after, the read after that many frames blocks like a camera that stops answering.
+    '''
+
+    def __init__(self, frames_per_connection=5, hang_after=None, hang_seconds=2.0):
+        self.frames = frames_per_connection
+        self.hang_after = hang_after
+        self.hang_seconds = hang_seconds
+        self.read_count = 0
+        self.released = threading.Event()
+
+    def read(self):
+        if self.hang_after is not None and self.read_count == self.hang_after:
+            time.sleep(self.hang_seconds)
+        self.read_count += 1
+        if self.read_count > self.frames:
+            return False, None
+        return True, np.zeros((4, 4, 3), dtype=np.uint8)
+
+    def get(self, prop):
+        return 0
+
+    def release(self):
+        self.released.set()
+
+
+class FakeSupervisor(StreamSupervisor):
+    '''
+    StreamSupervisor whose sources are factories of FakeCapture (or exceptions for failed opens) instead of URLs.
+    '''
+
+    def __init__(self, sources, **kwargs):
+        kwargs.setdefault("status_seconds", 0)
+        super().__init__(sources, **kwargs)
+        self.captures = []
+
+    def _open(self, source):
+        capture = source()
+        self.captures.append(capture)
+        return capture, 100.0
+
+
+def run(supervisor, duration):
+    start = time.time()
+    status = asyncio.run(supervisor.run(duration))
+    return {s["stream"]: s for s in status}, time.time() - start
+
+
+def test_backoff_doubles_and_is_capped():
+    supervisor = StreamSupervisor([], backoff_base=1.0, backoff_max=8.0)
+    for failures, delay in [(1, 1.0), (2, 2.0), (3, 4.0), (4, 8.0), (10, 8.0)]:
+        for _ in range(20):
+            assert 0.8 * delay <= supervisor.backoff(failures) <= 1.2 * delay
+
+
+def test_reconnects_after_dropped_connection_with_increasing_timestamps():
+    pts = []
+    supervisor = FakeSupervisor({"cam": lambda: FakeCapture(5)},
+                                on_frame=lambda name, frame, pts_ms: pts.append(pts_ms),
+                                backoff_base=0.05, backoff_max=0.1)
+    status, _ = run(supervisor, 1.0)
+    assert status["cam"]["reconnects"] >= 2
+    assert status["cam"]["frames"] == len(pts) >= 10
+    assert status["cam"]["state"] == "stopped"
+    assert all(b > a for a, b in zip(pts, pts[1:]))
+    assert all(capture.released.is_set() for capture in supervisor.captures)
+
+
+def test_failed_opens_stop_after_max_failures():
+    def refuse():
+        raise ConnectionError("connection refused")
+    supervisor = FakeSupervisor({"cam": refuse}, backoff_base=0.01, backoff_max=0.02, max_failures=3)
+    status, seconds = run(supervisor, 10.0)
+    # one first connection and max_failures retries, then the stream stops and run() returns early
+    assert status["cam"]["reconnects"] == 3
+    assert status["cam"]["state"] == "stopped"
+    assert status["cam"]["last_error"] == "connection refused"
+    assert seconds < 5.0
+
+
+def test_hung_read_is_a_stall_and_does_not_block_the_other_streams():
+    supervisor = FakeSupervisor({"hung": lambda: FakeCapture(1000, hang_after=3, hang_seconds=3.0),
+                                 "live": lambda: FakeCapture(1000)},
+                                stall_seconds=0.3, backoff_base=5.0, backoff_max=5.0, realtime=True)
+    states = []
+
+    async def watch():
+        task = asyncio.create_task(supervisor.run(1.5))
+        while not task.done():
+            states.append(supervisor.streams["hung"].state)
+            await asyncio.sleep(0.05)
+        return await task
+
+    start = time.time()
+    status = {s["stream"]: s for s in asyncio.run(watch())}
+    assert time.time() - start < 2.5
+    assert status["hung"]["stalls"] == 1 and status["hung"]["frames"] == 3
+    # the stall closes the connection at once, the stream then waits for its backoff
+    assert status["hung"]["last_error"] == "no frame for 0.3s"
+    assert "running" in states and "reconnecting" in states and status["hung"]["state"] == "stopped"
+    assert status["live"]["stalls"] == 0 and status["live"]["frames"] > 50
+    # the abandoned reader releases its capture once the hung read returns
+    assert supervisor.captures[0].released.wait(5.0)
+
+
+def test_check_state_transitions():
+    supervisor = StreamSupervisor({"cam": "fake"}, stall_seconds=2.0, fps_window=1.0, min_fps_ratio=0.5)
+    health = supervisor.streams["cam"]
+    now = 1000.0
+    health.state, health.nominal_fps, health.connected_at = "running", 10.0, now - 5.0
+
+    # 10 frames in the last second: running
+    health.arrivals.extend(now - 0.1 * i for i in range(10, 0, -1))
+    health.last_frame = now - 0.1
+    supervisor.check(now)
+    assert health.state == "running" and health.fps_drops == 0
+
+    # 2 frames in the last second, below half the nominal 10 fps: degraded, counted once
+    now += 1.0
+    health.arrivals.extend([now - 0.5, now - 0.1])
+    health.last_frame = now - 0.1
+    supervisor.check(now)
+    supervisor.check(now)
+    assert health.state == "degraded" and health.fps_drops == 1
+
+    # back to full rate: running again
+    now += 1.0
+    health.arrivals.extend(now - 0.1 * i for i in range(10, 0, -1))
+    health.last_frame = now - 0.1
+    supervisor.check(now)
+    assert health.state == "running"
+
+    # no frame for more than stall_seconds: stalled
+    now += 3.0
+    supervisor.check(now)
+    assert health.state == "stalled"
+
+    # streams that are not connected are left alone
+    health.state = "reconnecting"
+    supervisor.check(now)
+    assert health.state == "reconnecting"